@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+import logging
+
+import numpy as np
+from brainflow.board_shim import BoardShim
+
+from ring_buffer import RingBuffer
+
+
+class BoardReader:
+    # Pulls only the samples that arrived since the last poll out of
+    # BrainFlow's buffer (get_board_data_count + get_board_data) into our own
+    # preallocated ring buffer, and watches the package counter row for gaps.
+    # Most boards count packages modulo 256, for larger gaps the drop count is
+    # only exact up to that modulo.
+    # On a shared_ring.SharedBoard nothing is copied, new blocks and windows
+    # are views into the shared ring of the acquisition daemon.
+    def __init__(self, board_shim, capacity, counter_modulo=256):
+        self.board_shim = board_shim
+        self.board_id = board_shim.get_board_id()
+        self.num_rows = BoardShim.get_num_rows(self.board_id)
+        self.package_num_channel = BoardShim.get_package_num_channel(self.board_id)
+        self.timestamp_channel = BoardShim.get_timestamp_channel(self.board_id)
+        self.counter_modulo = counter_modulo
+        self.ring = getattr(board_shim, 'ring', None)
+        if self.ring is None:
+            self.buffer = RingBuffer(self.num_rows, capacity)
+        elif capacity > self.ring.safe_span:
+            raise ValueError(f"window of {capacity} samples does not fit the shared ring of {self.ring.capacity}")
+        self.last_counter = None
+        # board timestamp of the newest sample, for sample to output latencies
+        self.last_timestamp = None
+        self.samples_received = 0
+        self.samples_dropped = 0
+        self.polls = 0
+
+    def poll(self):
+        # returns the new samples (all rows), possibly with zero columns
+        self.polls += 1
+        if self.ring is not None:
+            return self._poll_shared()
+        count = self.board_shim.get_board_data_count()
+        if count == 0:
+            return np.empty(shape=(self.num_rows, 0), dtype=float)
+        block = self.board_shim.get_board_data(count)
+        self._check_counter(block[self.package_num_channel])
+        self.buffer.append(block)
+        self.last_timestamp = block[self.timestamp_channel, -1]
+        self.samples_received += block.shape[1]
+        return block
+
+    def _poll_shared(self):
+        if self.board_shim.check_writer():
+            # a new daemon, its ring and counters start over
+            self.ring = self.board_shim.ring
+            self.last_counter = None
+        seq, block, lost = self.ring.since(self.board_shim.next_seq)
+        self.board_shim.next_seq = seq
+        if lost:
+            # overwritten in the ring before we got to them, counted here
+            # rather than from the (modulo) counter gap
+            self.samples_dropped += lost
+            self.last_counter = None
+        if block.shape[1] == 0:
+            return block
+        self._check_counter(block[self.package_num_channel])
+        self.last_timestamp = block[self.timestamp_channel, -1]
+        self.samples_received += block.shape[1]
+        return block
+
+    def _check_counter(self, counters):
+        if self.last_counter is not None:
+            steps = np.diff(counters, prepend=self.last_counter).astype(np.int64) % self.counter_modulo
+        else:
+            steps = np.diff(counters).astype(np.int64) % self.counter_modulo
+        # a step of one is the next package, zero is a repeated counter
+        dropped = int(np.sum(steps[steps > 1] - 1))
+        if dropped:
+            self.samples_dropped += dropped
+            logging.debug(f"board {self.board_id}: {dropped} samples dropped, {self.samples_dropped} total")
+        self.last_counter = counters[-1]
+
+    def window(self, n):
+        # view of the last n samples of every row, zero padded until n arrived
+        if self.ring is not None:
+            return self.ring.latest(n)[1]
+        return self.buffer.latest(n)
+
+    def drop_rate(self):
+        total = self.samples_received + self.samples_dropped
+        return self.samples_dropped / total if total else 0.0
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import signal
+import threading
+import time
+
+from brainflow.board_shim import BoardShim, BrainFlowInputParams
+
+from shared_ring import SharedRingWriter, DEFAULT_NAME
+
+# Opens the board once (by default the multicast stream of the ingest
+# scripts) and writes its samples into a shared memory ring, see
+# shared_ring.py. Viewers, recorder and feature service then attach with
+# --shm instead of each opening its own BrainFlow session:
+#
+#   python acquisition_daemon.py &
+#   python base_viz.py --shm brainflow_eeg
+#   python record.py --shm brainflow_eeg
+#
+# SIGTERM (systemd stop) and SIGINT shut down cleanly and remove the ring.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--board-id', type=int, default=-2)
+    parser.add_argument('--ip-address', type=str, default='224.0.0.1')
+    parser.add_argument('--ip-port', type=int, default=6666)
+    parser.add_argument('--other-info', type=str, default='8')
+    parser.add_argument('--serial-port', type=str, default='')
+    parser.add_argument('--name', type=str, default=DEFAULT_NAME, help='shared memory name readers attach to')
+    parser.add_argument('--buffer-seconds', type=float, default=60.0, help='samples kept in the shared ring')
+    parser.add_argument('--poll-ms', type=int, default=10)
+    parser.add_argument('--stats-interval', type=float, default=10.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    params = BrainFlowInputParams()
+    params.ip_address = args.ip_address
+    params.ip_port = args.ip_port
+    params.other_info = args.other_info
+    params.serial_port = args.serial_port
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    board_shim = BoardShim(args.board_id, params)
+    writer = None
+    try:
+        board_shim.prepare_session()
+        board_id = board_shim.get_board_id()
+        capacity = int(args.buffer_seconds * BoardShim.get_sampling_rate(board_id))
+        writer = SharedRingWriter(args.name, board_id, capacity)
+        # BrainFlow's own buffer only has to bridge one poll
+        board_shim.start_stream(max(capacity // 4, 1000))
+        logging.info(f"Writing board {board_id} to shared memory {args.name}, {capacity} samples")
+        last_stats = time.monotonic()
+        last_seq = 0
+        while not stop.wait(args.poll_ms / 1000.0):
+            count = board_shim.get_board_data_count()
+            if count:
+                writer.write(board_shim.get_board_data(count))
+            else:
+                writer.beat()
+            now = time.monotonic()
+            if args.stats_interval and now - last_stats >= args.stats_interval:
+                logging.info(f"{(writer.seq - last_seq) / (now - last_stats):.1f} samples/s, {writer.seq} total")
+                last_stats = now
+                last_seq = writer.seq
+    except BaseException as e:
+        logging.warning('Exception', exc_info=True)
+    finally:
+        logging.info('End')
+        if writer is not None:
+            writer.close()
+        if board_shim.is_prepared():
+            logging.info('Releasing session')
+            board_shim.release_session()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,20 @@ from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds, Brai
 from brainflow.data_filter import DataFilter, FilterTypes, NoiseTypes, AggOperations, WindowFunctions, DetrendOperations
 from brainflow.ml_model import MLModel, BrainFlowMetrics, BrainFlowClassifiers, BrainFlowModelParams
 
+from pipeline import ProcessingThread, LoadShedder
+from ring_buffer import ScratchBuffers
+from acquisition import BoardReader
+from shared_ring import SharedBoard
+from render import PlotRenderer
+from filters import compile_chain
+
+# 50 Hz noise removal, 0.5 Hz high pass, 60 Hz low pass
+EEG_VIEW_FILTERS = [
+    ('noise', NoiseTypes.FIFTY.value),
+    ('highpass', 0.5, 1),
+    ('lowpass', 60.0, 1),
+]
+
 class Graph:
     def __init__(self, board_shim):
         self.board_id = board_shim.get_board_id()
@@ -20,21 +34,34 @@ class Graph:
         self.eeg_channels = BoardShim.get_eeg_channels(self.board_id)
         self.sampling_rate = BoardShim.get_sampling_rate(self.board_id)
         self.update_speed_ms = 100
+        self.processing_speed_ms = 100
         self.window_size = 4
         self.num_points = self.window_size * self.sampling_rate
         self.num_points_big = self.window_size * self.sampling_rate * 2
+        self.reader = BoardReader(board_shim, self.num_points_big)
+        self.eeg_window = np.zeros(shape=(len(self.eeg_channels), self.num_points_big), dtype=float)
+        self.eeg_chain = compile_chain(EEG_VIEW_FILTERS, self.sampling_rate)
+        self.scratch = ScratchBuffers((19,self.num_points))
 
         self.app = QtGui.QApplication([])
         self.win = pg.GraphicsWindow(title='BrainFlow Plot',size=(1600, 1200))
 
         # self.nfft = DataFilter.get_nearest_power_of_two(self.sampling_rate)
 
+        # only the plots can give way when the machine can't keep up
+        self.shedder = LoadShedder(self.processing_speed_ms, ['skip_render', 'reduce_channels'])
         self._init_timeseries()
 
+        self.last_rendered = 0
+        self.worker = ProcessingThread(self.process, self.processing_speed_ms, shedder=self.shedder,
+                                       release_fn=self.scratch.release)
+        self.worker.start()
+
         timer = QtCore.QTimer()
         timer.timeout.connect(self.update)
         timer.start(self.update_speed_ms)
         QtGui.QApplication.instance().exec_()
+        self.worker.stop()
 
 
     def _init_timeseries(self):
@@ -54,20 +81,34 @@ class Graph:
             self.curves.append(curve)
         print("Initialized Time series with", len(self.eeg_channels), "Channels")
         print("Rendering", len(self.curves), "Curves")
+        # refiltered from scratch every tick, so decimated in full
+        self.renderer = PlotRenderer(self.win, self.shedder)
+        self.renderer.add_group('eeg', self.plots, self.curves)
+
 
+    def process(self):
+        # pull only the new samples, then copy just the EEG rows of the window
+        self.reader.poll()
+        data = np.take(self.reader.window(self.num_points_big), self.eeg_channels, axis=0, out=self.eeg_window)
+        filtered_data = self.scratch.next()
+        # all channels at once, same result as the DataFilter calls per channel
+        self.eeg_chain.apply(data, out=data)
+        filtered_data[self.eeg_channels] = data[:, -self.num_points:]
+
+        return filtered_data
 
     def update(self):
-        data = self.board_shim.get_current_board_data(self.num_points_big)
-        filtered_data = np.ndarray(shape=(19,self.num_points), dtype=float)
-        for count, channel in enumerate(self.eeg_channels):
-            # plot timeseries
-            DataFilter.remove_environmental_noise(data[channel], self.sampling_rate, NoiseTypes.FIFTY.value)
-            DataFilter.perform_highpass(data[channel], self.sampling_rate, 0.5, 1,
-                                      FilterTypes.BUTTERWORTH.value, 1)
-            DataFilter.perform_lowpass(data[channel], self.sampling_rate, 60.0, 1,
-                                      FilterTypes.BUTTERWORTH.value, 1)
-            filtered_data[channel] = np.array(data[channel][-self.num_points:])
-            self.curves[count].setData(filtered_data[channel])
+        # held while rendering, the processing thread doesn't refill the array meanwhile
+        seq, filtered_data = self.worker.latest.hold()
+        try:
+            if seq != self.last_rendered:
+                self.last_rendered = seq
+                if not self.renderer.skip_frame():
+                    start = time.perf_counter()
+                    self.renderer.render('eeg', filtered_data[self.eeg_channels])
+                    self.renderer.frame_done(time.perf_counter() - start)
+        finally:
+            self.worker.latest.release()
 
         self.app.processEvents()
 
@@ -76,6 +117,10 @@ def main():
     BoardShim.enable_dev_board_logger()
     logging.basicConfig(level=logging.DEBUG)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shm', type=str, default=None, help='read from the shared ring of acquisition_daemon.py')
+    args = parser.parse_args()
+
     params = BrainFlowInputParams()
     params.other_info = '8'
     params.ip_address = '224.0.0.1'
@@ -84,8 +129,13 @@ def main():
     # params.other_info = '8'
     # params.file = '/home/a0n/Unicorn-Suite-Hybrid-Black/MNE-Testdump.gtec'
 
+    # stays None when SharedBoard fails, e.g. without a running acquisition daemon
+    board_shim = None
     try:
-        board_shim = BoardShim(-2, params)
+        if args.shm:
+            board_shim = SharedBoard(args.shm)
+        else:
+            board_shim = BoardShim(-2, params)
         board_shim.prepare_session()
         board_shim.start_stream(450000)
         g = Graph(board_shim)
@@ -93,7 +143,7 @@ def main():
         logging.warning('Exception', exc_info=True)
     finally:
         logging.info('End')
-        if board_shim.is_prepared():
+        if board_shim is not None and board_shim.is_prepared():
             logging.info('Releasing session')
             board_shim.release_session()
 
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+import argparse
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from brainflow.board_shim import BoardShim, BoardIds
+
+from filters import FILTER_CONFIG, load_filter_config, compile_chain
+from spectral import SlidingWelch, AVG_BANDS, avg_band_nfft, relative_band_stats
+from features import fill_feature_vector
+from quality import QualityMonitor, QUALITY_CONFIG, load_quality_config
+from inference import MODELS
+from recording import RecordingReader, read_recording
+
+# Recomputes what FeaturePipeline.process would have produced for a recording,
+# as fast as the machine allows. The file is read in chunks and run through the
+# same streaming filters, then the Welch segments, window PSDs and per channel
+# band powers of all ticks are computed in batches on a process pool. The raw
+# and filtered recording is held in memory for that, about 220 MB per hour of
+# Unicorn data.
+#
+# Ticks are assumed to be evenly spaced (every tick_ms worth of samples). The
+# window PSD only changes when a Welch segment completes, so band powers are
+# computed once per distinct set of segments and repeated for the ticks in
+# between. The signal quality (quality.py) is then replayed tick by tick as
+# the live pipeline does it: unusable windows hold the last features and
+# predictions, usable ones use the good channels only and move the feature
+# vector by the quality score. The models run on the pool again, only for the
+# ticks whose feature vector changed.
+
+_models = None
+
+
+def _init_worker():
+    global _models
+    from brainflow.ml_model import MLModel, BrainFlowModelParams
+    _models = []
+    for _, metric, classifier in MODELS:
+        model = MLModel(BrainFlowModelParams(metric, classifier))
+        model.prepare()
+        _models.append(model)
+
+
+def _band_powers_for_segments(eeg, first_segment, completed, sampling_rate, nfft, num_points):
+    # eeg (after the band power filters) starts at the first sample of segment
+    # first_segment
+    welch = SlidingWelch(eeg.shape[0], sampling_rate, nfft, num_points)
+    count = completed[-1] - first_segment
+    power = welch.segment_power(eeg, count)
+    cumulative = np.concatenate((np.zeros((1,) + power.shape[1:]), np.cumsum(power, axis=0)))
+
+    # mean of the last num_segments completed segments for every distinct tick
+    ends = completed - first_segment
+    starts = np.maximum(completed - welch.num_segments, 0) - first_segment
+    counts = np.maximum(ends - starts, 1)
+    psd = (cumulative[ends] - cumulative[starts]) / counts[:, None, None]
+
+    # (ticks x channels x bands)
+    return welch.band_powers(AVG_BANDS, psd)
+
+
+def _predict(feature_vectors):
+    predictions = np.zeros(shape=(len(feature_vectors), len(_models)), dtype=float)
+    for i, feature_vector in enumerate(feature_vectors):
+        for count, model in enumerate(_models):
+            predictions[i, count] = model.predict(feature_vector)
+    return predictions
+
+
+def _apply_quality(quality, raw, filtered, accel, gyro, tick_ends, tick_samples, powers):
+    # what FeaturePipeline.process does with the band powers of every tick,
+    # returns the quality score, whether the window was usable and the feature
+    # vector after the tick
+    score = np.zeros(len(tick_ends))
+    usable = np.zeros(len(tick_ends), dtype=bool)
+    feature_vectors = np.zeros((len(tick_ends), 2 * len(AVG_BANDS)))
+    feature_vector = np.zeros(2 * len(AVG_BANDS))
+    new_features = np.zeros(2 * len(AVG_BANDS))
+    for tick, end in enumerate(tick_ends):
+        start = end - tick_samples
+        quality.update(raw[:, start:end], filtered[:, start:end], accel[:, start:end], gyro[:, start:end])
+        score[tick] = quality.score
+        usable[tick] = quality.usable
+        if quality.usable:
+            fill_feature_vector(new_features, relative_band_stats(powers[tick][quality.good]))
+            feature_vector += quality.score * (new_features - feature_vector)
+        feature_vectors[tick] = feature_vector
+    return score, usable, feature_vectors
+
+
+def _features_frame(sample, timestamp, quality, feature_vectors, predictions):
+    columns = {'sample': sample, 'timestamp': timestamp, 'quality': quality}
+    for count, (name, _, _) in enumerate(AVG_BANDS):
+        columns[f"avg_{name}"] = feature_vectors[:, count]
+    for count, (name, _, _) in enumerate(AVG_BANDS):
+        columns[f"std_{name}"] = feature_vectors[:, len(AVG_BANDS) + count]
+    for count, (name, _, _) in enumerate(MODELS):
+        columns[name] = predictions[:, count]
+    return pd.DataFrame(columns)
+
+
+def _no_features():
+    # the columns without rows, for recordings shorter than one tick
+    return _features_frame(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), np.zeros((0, 2 * len(AVG_BANDS))),
+                           np.zeros((0, len(MODELS))))
+
+
+def compute_features(path, board_id=BoardIds.UNICORN_BOARD.value, tick_ms=100, window_size=4, workers=None,
+                     ticks_per_job=2000, filter_config=None, quality_config=None):
+    sampling_rate = BoardShim.get_sampling_rate(board_id)
+    eeg_channels = BoardShim.get_eeg_channels(board_id)
+    accel_channels = BoardShim.get_accel_channels(board_id)
+    gyro_channels = BoardShim.get_gyro_channels(board_id)
+    timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+    num_points = window_size * sampling_rate
+    nfft = avg_band_nfft(sampling_rate, num_points)
+    hop = SlidingWelch(1, sampling_rate, nfft, num_points).hop
+
+    # same causal filters with the same initial state as the live pipeline,
+    # carried across chunks
+    if filter_config is None and path.endswith('.bfrec'):
+        # the filters the recording was made with, if it says
+        reader = RecordingReader(path)
+        filter_config = reader.header.get('metadata', {}).get('filters')
+        reader.close()
+    # recordings made before a group existed get its default chain
+    chains = dict(FILTER_CONFIG, **(filter_config or {}))
+    eeg_filter = compile_chain(chains['eeg'], sampling_rate).streaming(len(eeg_channels), 1)
+    band_power_filter = compile_chain(chains['band_power'], sampling_rate).streaming(len(eeg_channels), 1)
+    accel_filter = compile_chain(chains['accel'], sampling_rate).streaming(len(accel_channels), 1)
+    gyro_filter = compile_chain(chains['gyro'], sampling_rate).streaming(len(gyro_channels), 1)
+    num_eeg = len(eeg_channels)
+    num_accel = len(accel_channels)
+    raw_chunks = []
+    filtered_chunks = []
+    band_power_chunks = []
+    accel_chunks = []
+    gyro_chunks = []
+    timestamp_chunks = []
+    for chunk in read_recording(path, board_id, eeg_channels + accel_channels + gyro_channels + [timestamp_channel]):
+        raw_chunks.append(np.ascontiguousarray(chunk[:num_eeg]))
+        filtered_chunks.append(eeg_filter.process(raw_chunks[-1]))
+        band_power_chunks.append(band_power_filter.process(filtered_chunks[-1]))
+        accel_chunks.append(accel_filter.process(np.ascontiguousarray(chunk[num_eeg:num_eeg + num_accel])))
+        gyro_chunks.append(gyro_filter.process(np.ascontiguousarray(chunk[num_eeg + num_accel:-1])))
+        timestamp_chunks.append(chunk[-1])
+    if not filtered_chunks:
+        logging.info("no samples in the recording")
+        return _no_features()
+    raw = np.concatenate(raw_chunks, axis=1)
+    filtered = np.concatenate(filtered_chunks, axis=1)
+    band_power_input = np.concatenate(band_power_chunks, axis=1)
+    accel = np.concatenate(accel_chunks, axis=1)
+    gyro = np.concatenate(gyro_chunks, axis=1)
+    timestamps = np.concatenate(timestamp_chunks)
+    total = filtered.shape[1]
+    logging.info(f"{total} samples ({total / sampling_rate:.0f} s) read and filtered")
+
+    tick_samples = max(1, int(round(sampling_rate * tick_ms / 1000)))
+    tick_ends = np.arange(tick_samples, total + 1, tick_samples)
+    if len(tick_ends) == 0:
+        return _no_features()
+    completed = np.where(tick_ends >= nfft, (tick_ends - nfft) // hop + 1, 0)
+    distinct, tick_index = np.unique(completed, return_inverse=True)
+
+    num_segments = SlidingWelch(1, sampling_rate, nfft, num_points).num_segments
+    # ticks before the first complete Welch segment get zero band powers, what
+    # SlidingWelch.psd() returns live; only the others need a job
+    pending = distinct[distinct > 0]
+    jobs = []
+    # spawned, not forked: a forked worker would inherit models the caller
+    # prepared already, and BrainFlow refuses to prepare them a second time
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        for start in range(0, len(pending), ticks_per_job):
+            part = pending[start:start + ticks_per_job]
+            first_segment = max(int(part[0]) - num_segments, 0)
+            last_sample = (int(part[-1]) - 1) * hop + nfft
+            region = band_power_input[:, first_segment * hop:last_sample]
+            jobs.append(pool.submit(_band_powers_for_segments, region, first_segment, part,
+                                    sampling_rate, nfft, num_points))
+        no_segments = [np.zeros((len(distinct) - len(pending), num_eeg, len(AVG_BANDS)))]
+        powers = np.concatenate(no_segments + [job.result() for job in jobs])[tick_index]
+
+        quality = QualityMonitor(num_eeg, num_accel, len(gyro_channels), **(quality_config or QUALITY_CONFIG))
+        score, usable, feature_vectors = _apply_quality(quality, raw, filtered, accel, gyro, tick_ends, tick_samples,
+                                                        powers)
+        logging.info(f"{quality.bad_windows} of {len(tick_ends)} ticks without a usable quality window")
+
+        # the models run on usable ticks whose vector changed, the other ticks
+        # keep the last predictions (zeros before the first one)
+        changed = usable.copy()
+        changed[1:] &= np.any(feature_vectors[1:] != feature_vectors[:-1], axis=1)
+        ticks = np.flatnonzero(changed)
+        jobs = [pool.submit(_predict, feature_vectors[ticks[start:start + ticks_per_job]])
+                for start in range(0, len(ticks), ticks_per_job)]
+        predicted = np.concatenate([job.result() for job in jobs] + [np.zeros((1, len(MODELS)))])
+
+    # index of the last prediction of every tick, the zero row at the end before the first
+    last = np.maximum.accumulate(np.where(changed, np.cumsum(changed) - 1, -1))
+    predictions = predicted[last]
+    return _features_frame(tick_ends, timestamps[tick_ends - 1], score, feature_vectors, predictions)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str, help='bfrec recording or BrainFlow file streamer dump')
+    parser.add_argument('--output', type=str, default=None, help='csv file for the features, default <file>.features.csv')
+    parser.add_argument('--board-id', type=int, default=BoardIds.UNICORN_BOARD.value, help='board the recording was made with')
+    parser.add_argument('--tick-ms', type=int, default=100)
+    parser.add_argument('--window-size', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--filter-config', type=str, default=None, help='json file with the filter chain per channel group')
+    parser.add_argument('--quality-config', type=str, default=None, help='json file with the signal quality thresholds')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    features = compute_features(args.file, args.board_id, args.tick_ms, args.window_size, args.workers,
+                                filter_config=load_filter_config(args.filter_config) if args.filter_config else None,
+                                quality_config=load_quality_config(args.quality_config))
+    output = args.output or args.file + '.features.csv'
+    features.to_csv(output, index=False)
+    logging.info(f"{len(features)} ticks written to {output} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
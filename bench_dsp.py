@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+import argparse
+import itertools
+import json
+import logging
+import time
+import tracemalloc
+
+import numpy as np
+
+from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds
+
+from filters import StreamingFilterBank, EEG_FILTERS, BAND_POWER_FILTERS
+from spectral import SlidingWelch, AVG_BANDS, avg_band_nfft
+from features import FeaturePipeline, fill_feature_vector
+from sinks import SinkHub
+from inference import MODELS, shared_model
+from recording import read_recording
+
+# Benchmarks of the per tick DSP path (filter, PSD, band powers, predict),
+# run as fast as possible on prerecorded input instead of in real time.
+#
+#   python bench_dsp.py                                 synthetic board input
+#   python bench_dsp.py --recording Testdump.bfrec      recorded input
+#   python bench_dsp.py --json out.json --compare baseline.json
+#
+# Every combination of --channels, --window-sizes and --update-ms is run for
+# --ticks ticks (EEG rows are tiled to reach the channel count). Reported per
+# tick: wall and CPU time (mean, p95), bytes allocated by Python and NumPy
+# (tracemalloc, measured in a separate pass because tracing slows everything
+# down) and the throughput in channels * samples per second. --pipeline also
+# runs the whole FeaturePipeline of the source board, with a SinkHub without
+# sinks so nothing goes out to the broker, the servos or Tidal.
+
+
+def synthetic_data(seconds):
+    # the synthetic board only produces data in real time, collect it once
+    board_shim = BoardShim(BoardIds.SYNTHETIC_BOARD.value, BrainFlowInputParams())
+    try:
+        board_shim.prepare_session()
+        board_shim.start_stream(450000)
+        time.sleep(seconds)
+        return BoardIds.SYNTHETIC_BOARD.value, board_shim.get_board_data()
+    finally:
+        if board_shim.is_prepared():
+            board_shim.release_session()
+
+
+def recorded_data(path, board_id):
+    return board_id, np.concatenate(list(read_recording(path, board_id)), axis=1)
+
+
+class ReplayBoard:
+    # stands in for a BoardShim, hands out block_size samples of the source
+    # data (looped) on every poll
+    def __init__(self, board_id, data, block_size):
+        self.board_id = board_id
+        self.data = data
+        self.block_size = block_size
+        self.position = 0
+
+    def get_board_id(self):
+        return self.board_id
+
+    def get_board_data_count(self):
+        return self.block_size
+
+    def get_board_data(self, num_samples=None):
+        index = np.arange(self.position, self.position + (num_samples or self.block_size)) % self.data.shape[1]
+        self.position += len(index)
+        return self.data[:, index]
+
+
+class DspTick:
+    # the DSP of FeaturePipeline.process for an arbitrary number of channels
+    def __init__(self, num_channels, sampling_rate, window_size):
+        num_points = window_size * sampling_rate
+        nfft = avg_band_nfft(sampling_rate, num_points)
+        self.eeg_filter = StreamingFilterBank(EEG_FILTERS, sampling_rate, num_channels, num_points)
+        self.band_power_filter = StreamingFilterBank(BAND_POWER_FILTERS, sampling_rate, num_channels, num_points)
+        self.spectral = SlidingWelch(num_channels, sampling_rate, nfft, num_points)
+        self.feature_vector = np.zeros(2 * len(AVG_BANDS), dtype=float)
+        self.models = [shared_model(metric, classifier) for _, metric, classifier in MODELS]
+
+    def __call__(self, block):
+        self.spectral.push(self.band_power_filter.process(self.eeg_filter.process(block)))
+        psd = self.spectral.psd()
+        bands = self.spectral.avg_band_powers(AVG_BANDS, psd)
+        fill_feature_vector(self.feature_vector, bands)
+        return [model.predict(self.feature_vector) for model in self.models]
+
+
+def _blocks(data, block_size, ticks):
+    for tick in range(ticks):
+        index = np.arange(tick * block_size, (tick + 1) * block_size) % data.shape[1]
+        yield np.ascontiguousarray(data[:, index])
+
+
+def measure(tick_fn, blocks, warmup):
+    blocks = list(blocks)
+    for block in blocks[:warmup]:
+        tick_fn(block)
+    wall = np.zeros(len(blocks) - warmup)
+    cpu = np.zeros(len(blocks) - warmup)
+    for count, block in enumerate(blocks[warmup:]):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        tick_fn(block)
+        cpu[count] = time.process_time() - start_cpu
+        wall[count] = time.perf_counter() - start_wall
+    return wall, cpu
+
+
+def measure_allocations(tick_fn, blocks, warmup):
+    blocks = list(blocks)
+    for block in blocks[:warmup]:
+        tick_fn(block)
+    tracemalloc.start()
+    try:
+        allocated = np.zeros(len(blocks) - warmup)
+        for count, block in enumerate(blocks[warmup:]):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            tick_fn(block)
+            _, peak = tracemalloc.get_traced_memory()
+            allocated[count] = peak - before
+    finally:
+        tracemalloc.stop()
+    return allocated
+
+
+def summarize(name, config, wall, cpu, allocated, channel_samples):
+    return dict(name=name, **config,
+                wall_ms=float(wall.mean() * 1000), wall_p95_ms=float(np.percentile(wall, 95) * 1000),
+                cpu_ms=float(cpu.mean() * 1000), cpu_p95_ms=float(np.percentile(cpu, 95) * 1000),
+                alloc_kb=float(allocated.mean() / 1024),
+                throughput=float(channel_samples / wall.mean()))
+
+
+def bench_dsp(data, board_id, channels, window_size, update_ms, ticks, warmup):
+    sampling_rate = BoardShim.get_sampling_rate(board_id)
+    eeg = data[BoardShim.get_eeg_channels(board_id)]
+    eeg = np.tile(eeg, (-(-channels // eeg.shape[0]), 1))[:channels]
+    block_size = max(1, sampling_rate * update_ms // 1000)
+    config = dict(channels=channels, window_size=window_size, update_ms=update_ms)
+    wall, cpu = measure(DspTick(channels, sampling_rate, window_size), _blocks(eeg, block_size, ticks + warmup), warmup)
+    allocated = measure_allocations(DspTick(channels, sampling_rate, window_size),
+                                    _blocks(eeg, block_size, ticks + warmup), warmup)
+    return summarize('dsp', config, wall, cpu, allocated, channels * block_size)
+
+
+def bench_pipeline(data, board_id, window_size, update_ms, ticks, warmup):
+    sampling_rate = BoardShim.get_sampling_rate(board_id)
+    channels = len(BoardShim.get_eeg_channels(board_id))
+    block_size = max(1, sampling_rate * update_ms // 1000)
+    config = dict(channels=channels, window_size=window_size, update_ms=update_ms)
+
+    # a hub without sinks, the outputs of the ticks go nowhere
+    sinks = SinkHub({'sinks': []})
+
+    def make_tick():
+        pipeline = FeaturePipeline(ReplayBoard(board_id, data, block_size), name='bench', window_size=window_size,
+                                   processing_speed_ms=update_ms, verbose=False, stats_interval=0, sinks=sinks)
+        # nothing holds the result, so its scratch arrays go straight back
+        return lambda block: pipeline.release(pipeline.process())
+
+    try:
+        wall, cpu = measure(make_tick(), itertools.repeat(None, ticks + warmup), warmup)
+        allocated = measure_allocations(make_tick(), itertools.repeat(None, ticks + warmup), warmup)
+    finally:
+        sinks.stop()
+    return summarize('pipeline', config, wall, cpu, allocated, channels * block_size)
+
+
+def _key(result):
+    return (result['name'], result['channels'], result['window_size'], result['update_ms'])
+
+
+def print_results(results, baseline=None, tolerance=0.2):
+    baseline = {_key(result): result for result in baseline or []}
+    print(f"{'bench':<9}{'ch':>4}{'win s':>6}{'tick ms':>8}{'wall ms':>9}{'p95':>8}{'cpu ms':>8}{'p95':>8}"
+          f"{'alloc kB':>10}{'Mch*smp/s':>11}")
+    regressions = 0
+    for result in results:
+        line = (f"{result['name']:<9}{result['channels']:>4}{result['window_size']:>6}{result['update_ms']:>8}"
+                f"{result['wall_ms']:>9.3f}{result['wall_p95_ms']:>8.3f}{result['cpu_ms']:>8.3f}{result['cpu_p95_ms']:>8.3f}"
+                f"{result['alloc_kb']:>10.1f}{result['throughput'] / 1e6:>11.2f}")
+        reference = baseline.get(_key(result))
+        if reference:
+            change = result['cpu_ms'] / reference['cpu_ms'] - 1.0
+            line += f"  {change:+.0%} cpu"
+            if change > tolerance:
+                line += '  REGRESSION'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    BoardShim.disable_board_logger()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recording', type=str, default=None, help='bfrec or file streamer dump used as input')
+    parser.add_argument('--board-id', type=int, default=BoardIds.UNICORN_BOARD.value, help='board of a file streamer dump')
+    parser.add_argument('--synthetic-seconds', type=float, default=5.0, help='synthetic board data to collect')
+    parser.add_argument('--channels', type=str, default='8,16,64')
+    parser.add_argument('--window-sizes', type=str, default='4')
+    parser.add_argument('--update-ms', type=str, default='50,100')
+    parser.add_argument('--ticks', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--pipeline', action='store_true', help='also run the whole FeaturePipeline')
+    parser.add_argument('--json', type=str, default=None, help='write the results to this file')
+    parser.add_argument('--compare', type=str, default=None, help='results of an earlier --json run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='cpu time increase counted as a regression')
+    args = parser.parse_args()
+
+    if args.recording:
+        board_id, data = recorded_data(args.recording, args.board_id)
+    else:
+        board_id, data = synthetic_data(args.synthetic_seconds)
+
+    channels = [int(value) for value in args.channels.split(',')]
+    window_sizes = [int(value) for value in args.window_sizes.split(',')]
+    update_ms = [int(value) for value in args.update_ms.split(',')]
+
+    results = []
+    for window_size, speed in itertools.product(window_sizes, update_ms):
+        for num_channels in channels:
+            results.append(bench_dsp(data, board_id, num_channels, window_size, speed, args.ticks, args.warmup))
+        if args.pipeline:
+            results.append(bench_pipeline(data, board_id, window_size, speed, args.ticks, args.warmup))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline, args.tolerance)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        raise SystemExit(f"{regressions} benchmarks slower than the baseline")
+
+
+if __name__ == '__main__':
+    main()
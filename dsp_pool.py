@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from filters import compile_chain
+from spectral import SlidingWelch, AVG_BANDS
+
+# Filtering and spectral work of the pipelines on a pool of worker processes,
+# so several boards and high density caps use all cores instead of sharing
+# one GIL with Qt and the outputs. Work is split into shards: one channel
+# group (eeg, accel, gyro, or a slice of a large EEG group) of one board.
+# A shard always runs on the same worker, which keeps its filter and Welch
+# state between ticks.
+#
+# Every shard has one shared memory block:
+#   header   int64 [input_seq, output_seq, input_count, low_resolution, total]
+#   input    channels x max_block   new raw samples of the tick
+#   window   channels x window      filtered window, newest sample last
+#   powers   channels x AVG_BANDS   band powers (spectral shards only)
+# submit() writes the new samples and bumps input_seq, the worker processes
+# them, writes window (and powers) and sets output_seq to input_seq; total is
+# the number of samples the shard has filtered, so results of several shards
+# are only merged when they cover the same samples.
+INPUT_SEQ, OUTPUT_SEQ, INPUT_COUNT, LOW_RESOLUTION, TOTAL = range(5)
+HEADER_FIELDS = 8
+
+
+def _layout(num_channels, max_block, window, spectral):
+    layout = [('header', (HEADER_FIELDS,), np.int64),
+              ('input', (num_channels, max_block), np.float64),
+              ('window', (num_channels, window), np.float64)]
+    if spectral:
+        layout.append(('powers', (num_channels, len(AVG_BANDS)), np.float64))
+    return layout
+
+
+def _size(layout):
+    return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in layout)
+
+
+def _arrays(buf, layout):
+    arrays = {}
+    offset = 0
+    for key, shape, dtype in layout:
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return arrays
+
+
+class ShardDsp:
+    # what a worker does for one shard, the same steps FeaturePipeline runs
+    # locally: streaming filters, then for EEG the band power filters and the
+    # sliding Welch PSD
+    def __init__(self, config):
+        self.config = config
+        self.block = shared_memory.SharedMemory(name=config['memory'])
+        self.arrays = _arrays(self.block.buf, _layout(config['channels'], config['max_block'], config['window'],
+                                                         config['nfft'] is not None))
+        self.filter = compile_chain(config['filters'], config['sampling_rate']).streaming(config['channels'], config['window'])
+        self.band_power_filter = None
+        if config['nfft'] is not None:
+            self.band_power_filter = compile_chain(config['band_power_filters'], config['sampling_rate']).streaming(
+                config['channels'], config['window'])
+        self.low_resolution = False
+        self.spectral = self._welch(False)
+
+    def _welch(self, low_resolution):
+        config = self.config
+        if config['nfft'] is None:
+            return None
+        if low_resolution:
+            return SlidingWelch(config['channels'], config['sampling_rate'], config['nfft'] // 2, config['window'], overlap=0)
+        return SlidingWelch(config['channels'], config['sampling_rate'], config['nfft'], config['window'])
+
+    def run(self):
+        header = self.arrays['header']
+        seq = header[INPUT_SEQ]
+        if seq <= header[OUTPUT_SEQ]:
+            return False
+        low_resolution = bool(header[LOW_RESOLUTION])
+        if self.spectral is not None and low_resolution != self.low_resolution:
+            # like FeaturePipeline, start the new resolution from the filtered window
+            self.low_resolution = low_resolution
+            self.spectral = self._welch(low_resolution)
+            self.spectral.push(self.band_power_filter.latest(self.config['window']))
+        filtered = self.filter.process(self.arrays['input'][:, :header[INPUT_COUNT]])
+        self.filter.buffer.copy_latest(self.config['window'], self.arrays['window'])
+        if self.spectral is not None:
+            self.spectral.push(self.band_power_filter.process(filtered))
+            self.arrays['powers'][:] = self.spectral.band_powers(AVG_BANDS)
+        header[TOTAL] += filtered.shape[1]
+        header[OUTPUT_SEQ] = seq
+        return True
+
+    def close(self):
+        self.arrays = None
+        self.block.close()
+
+
+def _worker_main(configs, wake, done, ready, stop):
+    # Ctrl-C and systemd's SIGTERM reach the whole process group, the pool is
+    # stopped by its owner. Without the owner the worker stops on its own.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = os.getppid()
+    shards = []
+    ready.set()
+    try:
+        while not stop.is_set() and os.getppid() == parent:
+            # a semaphore, an Event.set() would hang on a worker killed while waiting
+            if not wake.acquire(timeout=0.1):
+                continue
+            # a pipe rather than a queue, a config sent before the wake is
+            # always there when the worker looks
+            while configs.poll():
+                shards.append(ShardDsp(configs.recv()))
+            ran = False
+            for shard in shards:
+                try:
+                    ran = shard.run() or ran
+                except Exception:
+                    logging.warning('DSP shard failed', exc_info=True)
+            if ran:
+                # wakes every board waiting on a shard of this worker
+                with done:
+                    done.notify_all()
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+class Shard:
+    # main process side of one shard
+    def __init__(self, name, channels, layout, worker):
+        self.name = name
+        self.channels = channels
+        self.memory = shared_memory.SharedMemory(create=True, size=_size(layout))
+        self.arrays = _arrays(self.memory.buf, layout)
+        for array in self.arrays.values():
+            array.fill(0)
+        self.header = self.arrays['header']
+        self.worker = worker
+        self.seq = 0
+
+
+class DspPool:
+    # Worker processes plus their shards. A FeaturePipeline given a pool
+    # registers its channel groups with add_board and runs each tick with
+    # process, which waits until every shard of the board is done.
+    def __init__(self, workers=None, timeout=1.0, start_timeout=30.0):
+        self.context = multiprocessing.get_context('spawn')
+        self.num_workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.timeout = timeout
+        self.stop_event = self.context.Event()
+        self.workers = []
+        self.shards = []
+        for count in range(self.num_workers):
+            receiver, configs = self.context.Pipe(duplex=False)
+            wake = self.context.Semaphore(0)
+            done = self.context.Condition()
+            ready = self.context.Event()
+            process = self.context.Process(target=_worker_main, name=f"dsp-{count}",
+                                           args=(receiver, wake, done, ready, self.stop_event), daemon=True)
+            process.start()
+            receiver.close()
+            self.workers.append((process, configs, wake, done, ready))
+        # spawned workers first import numpy and scipy, the first tick shouldn't
+        # run into the timeout because of that
+        for process, configs, wake, done, ready in self.workers:
+            if not ready.wait(start_timeout):
+                self.stop()
+                raise RuntimeError(f"dsp worker {process.name} did not start")
+
+    def add_shard(self, name, channels, sampling_rate, filters, window, max_block, nfft=None, band_power_filters=None):
+        # with nfft the shard also computes band powers, of its filtered
+        # samples run through band_power_filters
+        layout = _layout(len(channels), max_block, window, nfft is not None)
+        worker = len(self.shards) % self.num_workers
+        shard = Shard(name, channels, layout, worker)
+        band_power_specs = list(band_power_filters.specs) if band_power_filters is not None else []
+        self.workers[worker][1].send(dict(memory=shard.memory.name, channels=len(channels), max_block=max_block,
+                                         window=window, sampling_rate=sampling_rate, filters=list(filters.specs),
+                                         nfft=nfft, band_power_filters=band_power_specs))
+        self.shards.append(shard)
+        return shard
+
+    def add_board(self, name, groups, sampling_rate, filter_chains, window, max_block, nfft, eeg_shard_channels=16):
+        # groups: group name -> board rows. EEG groups larger than
+        # eeg_shard_channels are split, so a 64 channel cap uses four workers.
+        shards = {}
+        for group, rows in groups.items():
+            if not len(rows):
+                continue
+            spectral = nfft if group == 'eeg' else None
+            band_power_filters = filter_chains['band_power'] if group == 'eeg' else None
+            step = eeg_shard_channels if group == 'eeg' else len(rows)
+            shards[group] = [self.add_shard(f"{name}/{group}/{start}", rows[start:start + step], sampling_rate,
+                                            filter_chains[group], window, max_block, spectral, band_power_filters)
+                             for start in range(0, len(rows), step)]
+        return BoardShards(self, shards, max_block, window)
+
+    def submit(self, shard, block, low_resolution=False):
+        # block holds all rows of the board, the shard's rows go straight into
+        # its shared input
+        header = shard.header
+        np.take(block, shard.channels, axis=0, out=shard.arrays['input'][:, :block.shape[1]])
+        header[INPUT_COUNT] = block.shape[1]
+        header[LOW_RESOLUTION] = low_resolution
+        shard.seq += 1
+        header[INPUT_SEQ] = shard.seq
+
+    def wake(self, shards):
+        for worker in {shard.worker for shard in shards}:
+            self.workers[worker][2].release()
+
+    def wait(self, shards):
+        # blocks on the done condition of the shard's worker, notified after
+        # every pass of the worker, until the shard caught up with its input
+        deadline = time.perf_counter() + self.timeout
+        for shard in shards:
+            done = self.workers[shard.worker][3]
+            while shard.header[OUTPUT_SEQ] < shard.seq:
+                remaining = deadline - time.perf_counter()
+                # acquired with a timeout, a worker killed while notifying
+                # must not hang the tick
+                if remaining <= 0 or not done.acquire(timeout=remaining):
+                    raise TimeoutError(f"dsp shard {shard.name} did not finish in {self.timeout} s")
+                try:
+                    done.wait_for(lambda: shard.header[OUTPUT_SEQ] >= shard.seq, deadline - time.perf_counter())
+                finally:
+                    done.release()
+
+    def stop(self):
+        self.stop_event.set()
+        for process, configs, wake, done, ready in self.workers:
+            wake.release()
+            process.join(1.0)
+            configs.close()
+        for shard in self.shards:
+            shard.arrays = shard.header = None
+            shard.memory.close()
+            shard.memory.unlink()
+        self.shards = []
+
+
+class BoardShards:
+    # the shards of one board, fed and merged once per tick
+    def __init__(self, pool, shards, max_block, max_backlog):
+        self.pool = pool
+        self.shards = shards
+        self.max_block = max_block
+        self.all = [shard for group in shards.values() for shard in group]
+        # samples a timed out tick could not submit, they go first next tick
+        self.backlog = None
+        self.max_backlog = max_backlog
+        self.samples_dropped = 0
+
+    def process(self, new_data, low_resolution=False):
+        # new_data: all rows of the samples since the last tick, more than
+        # max_block (after a stall) goes through in several rounds. Without new
+        # samples the shards keep their last results. After a timeout the round
+        # in flight is finished first and the rounds not submitted yet are
+        # carried into the next call, so every shard still sees every sample.
+        # Only a backlog beyond max_backlog samples is dropped (oldest first),
+        # like the board buffer drops samples after a long stall. Returns the
+        # samples that went through, backlog included.
+        if self.backlog is not None:
+            new_data = np.concatenate((self.backlog, new_data), axis=1)
+            self.backlog = None
+        start = 0
+        try:
+            self.pool.wait(self.all)
+            while start < new_data.shape[1]:
+                block = new_data[:, start:start + self.max_block]
+                for shard in self.all:
+                    self.pool.submit(shard, block, low_resolution)
+                start += block.shape[1]
+                self.pool.wake(self.all)
+                self.pool.wait(self.all)
+        except TimeoutError:
+            rest = new_data[:, start:]
+            if rest.shape[1] > self.max_backlog:
+                self.samples_dropped += rest.shape[1] - self.max_backlog
+                logging.warning(f"dsp backlog over {self.max_backlog} samples, {self.samples_dropped} dropped so far")
+                rest = rest[:, -self.max_backlog:]
+            if rest.shape[1]:
+                self.backlog = rest.copy()
+            raise
+        totals = {int(shard.header[TOTAL]) for shard in self.all}
+        if len(totals) > 1:
+            raise RuntimeError(f"dsp shards out of step: {sorted(totals)} samples")
+        return new_data
+
+    def window(self, group, out):
+        # filtered window of a whole group, slices in channel order
+        row = 0
+        for shard in self.shards.get(group, []):
+            count = len(shard.channels)
+            out[row:row + count] = shard.arrays['window']
+            row += count
+        return out
+
+    def powers(self, group='eeg'):
+        return np.concatenate([shard.arrays['powers'] for shard in self.shards[group]])
@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+import json
+import logging
+import time
+import numpy as np
+
+from brainflow.board_shim import BoardShim
+
+from filters import FILTER_CONFIG, compile_filter_config
+from ring_buffer import RingBuffer, ScratchBuffers
+from acquisition import BoardReader
+from spectral import SlidingWelch, AVG_BANDS, avg_band_nfft, relative_band_stats
+from metrics import Metrics
+from inference import default_inference
+from sinks import default_sinks
+from quality import QualityMonitor, QUALITY_CONFIG
+
+# Outputs go through the SinkHub of sinks.py, which decides by topic where
+# they end up (MQTT broker, crystal.local servos, Tidal OSC, ...).
+
+def send_message_to_tidal(name, value):
+    # publish.single(f"/brain/{name}", str(value), hostname="crystal.local")
+    default_sinks().publish(f"/ctrl/{name}", value)
+
+def send_message_to_servo(number, value):
+    default_sinks().publish(f"/servos/{str(number)}", value)
+
+def send_message_to_mqtt(path, value):
+    default_sinks().publish(path, value)
+
+def feature_vector_topics(prefix=""):
+    # mirror 10 gets the last feature, mirror 1 the first
+    return [f"{prefix}/mirror/{count + 1}/position" for count in range(10)]
+
+def send_feature_vector_to_mqtt(features, prefix="", sinks=None, timestamp=None):
+    messages = [(topic, feature, timestamp) for topic, feature in zip(feature_vector_topics(prefix), features)]
+    (sinks or default_sinks()).publish_many(messages)
+
+def fill_feature_vector(feature_vector, bands):
+    # the vector both models get: avg then std band powers as
+    # get_avg_band_powers returns them (spectral.relative_band_stats), which is
+    # what BrainFlow's models are trained on. Shared with batch_features.py
+    feature_vector[:len(bands[0])] = bands[0]
+    feature_vector[len(bands[0]):] = bands[1]
+    return feature_vector
+
+class FeaturePipeline:
+    # acquisition -> filtering -> band powers -> MLModel -> MQTT/OSC for one
+    # board, without any Qt. With a name, MQTT topics are published under
+    # /<name>/... and Tidal control names get a <name>_ prefix. Stage timings
+    # and sample to output latencies go into self.metrics, a summary is
+    # published to <prefix>/pipeline/stats every stats_interval seconds.
+    # Predictions come from an InferenceStage (shared by all pipelines of the
+    # process unless one is passed), the tick waits at most inference_timeout
+    # for them and otherwise goes on with the previous ones. Outputs go to the
+    # process wide SinkHub unless one is passed. Under load a LoadShedder
+    # (pipeline.py) can lower the PSD resolution and coalesce the controls.
+    # With a DspPool (dsp_pool.py) filters and PSD run on its worker processes.
+    # A QualityMonitor (quality.py) gates band powers, models and outputs on
+    # the signal quality of the last second.
+    def __init__(self, board_shim, name=None, window_size=4, processing_speed_ms=100, history_seconds=None, verbose=True,
+                 stats_interval=10.0, filter_config=None, inference=None, inference_timeout=None, sinks=None,
+                 shedder=None, dsp_pool=None, quality_config=None):
+        self.board_id = board_shim.get_board_id()
+        self.board_shim = board_shim
+        self.name = name
+        self.topic_prefix = f"/{name}" if name else ""
+        # OSC sinks turn /<name>/ctrl/<control> into a <name>_<control> control
+        self.ctrl_topic = f"{self.topic_prefix}/ctrl/"
+        self.verbose = verbose
+        self.eeg_channels = BoardShim.get_eeg_channels(self.board_id)
+        self.accel_channels = BoardShim.get_accel_channels(self.board_id)
+        self.gyro_channels = BoardShim.get_gyro_channels(self.board_id)
+        self.feature_bands = [1,2,3,4,5,6,7,8,9,10]
+        self.sampling_rate = BoardShim.get_sampling_rate(self.board_id)
+        self.processing_speed_ms = processing_speed_ms
+        self.window_size = window_size
+        self.num_points = self.window_size * self.sampling_rate
+        self.num_points_big = self.window_size * self.sampling_rate * 2
+        self.reader = BoardReader(board_shim, self.num_points_big)
+        # filter chains per channel group, designed once at startup; groups
+        # missing from filter_config keep the default chain
+        self.filter_chains = compile_filter_config(dict(FILTER_CONFIG, **(filter_config or {})), self.sampling_rate)
+        self.eeg_filter = self.filter_chains['eeg'].streaming(len(self.eeg_channels), self.num_points)
+        self.accel_filter = self.filter_chains['accel'].streaming(len(self.accel_channels), self.num_points)
+        self.gyro_filter = self.filter_chains['gyro'].streaming(len(self.gyro_channels), self.num_points)
+        # the filters get_avg_band_powers applies, between the EEG and the PSD
+        self.band_power_filter = self.filter_chains['band_power'].streaming(len(self.eeg_channels), self.num_points)
+        # per tick histories, one column per processing tick
+        self.history_seconds = history_seconds or self.window_size
+        self.history_size = int(self.history_seconds*(1000 / self.processing_speed_ms))
+        self.filtered_feature_data = RingBuffer(len(self.feature_bands), self.history_size)
+        self.feature_vector = np.zeros(len(self.feature_bands), dtype=float)
+        self.new_features = np.zeros(len(self.feature_bands), dtype=float)
+
+        self.mental_states = ['relaxed','concentrated']
+        self.mental_state_data = RingBuffer(len(self.mental_states), self.history_size)
+        self.mental_state_values = np.zeros(len(self.mental_states), dtype=float)
+
+        # scratch arrays handed to the renderer, reused instead of reallocated each tick
+        # once the renderer released them (release())
+        self.eeg_scratch = ScratchBuffers((len(self.eeg_channels), self.num_points))
+        self.accel_scratch = ScratchBuffers((len(self.accel_channels), self.num_points))
+        self.gyro_scratch = ScratchBuffers((len(self.gyro_channels), self.num_points))
+        self.mental_state_scratch = ScratchBuffers((len(self.mental_states), self.history_size))
+
+        self.lastMoveTime = time.time()
+        self.inference = inference or default_inference()
+        self.inference_slot = self.inference.slot(name or id(self))
+        self.inference_timeout = processing_speed_ms / 2000.0 if inference_timeout is None else inference_timeout
+        self.relaxation_index = self.inference.names.index('relaxation')
+        self.concentration_index = self.inference.names.index('concentration')
+        self.predictions = np.zeros(len(self.inference.names), dtype=float)
+        self.stale_predictions = 0
+        self.lastDirection = -1
+
+        # the segment length get_avg_band_powers would use on the window
+        self.nfft = avg_band_nfft(self.sampling_rate, self.num_points)
+        self.spectral = SlidingWelch(len(self.eeg_channels), self.sampling_rate, self.nfft, self.num_points)
+        self.shedder = shedder
+        self.low_resolution = False
+        self.ticks = 0
+        self.quality = QualityMonitor(len(self.eeg_channels), len(self.accel_channels), len(self.gyro_channels),
+                                      **(quality_config or QUALITY_CONFIG))
+        self.dsp = None
+        if dsp_pool is not None:
+            groups = {'eeg': self.eeg_channels, 'accel': self.accel_channels, 'gyro': self.gyro_channels}
+            self.dsp = dsp_pool.add_board(name or str(id(self)), groups, self.sampling_rate, self.filter_chains,
+                                          self.num_points, self.num_points, self.nfft)
+            # windows of the last tick the shards finished, reused when they time out
+            self.dsp_windows = {group: np.zeros(shape=(len(rows), self.num_points), dtype=float)
+                                for group, rows in groups.items()}
+        self.dsp_timeouts = 0
+
+        self.sinks = sinks or default_sinks()
+        self.mirror_topics = feature_vector_topics(self.topic_prefix)
+        self.messages = []
+
+        self.metrics = Metrics({'board': name or str(self.board_id)})
+        self.stats_interval = stats_interval
+        self.last_stats = time.time()
+
+    def _observe_age(self, name):
+        # how old the newest sample is when its features are handed to the
+        # sinks, the sinks record the age when they actually send
+        if self.reader.last_timestamp is not None:
+            self.metrics.observe(name, max(time.time() - self.reader.last_timestamp, 0.0))
+
+    def _update_resolution(self):
+        # on a switch the new SlidingWelch starts from the filtered window (before
+        # this tick's samples), so the PSD stays continuous. Costs one full
+        # window of FFTs.
+        low = self.shedder is not None and self.shedder.active('low_psd_resolution')
+        if low == self.low_resolution:
+            return
+        self.low_resolution = low
+        if low:
+            self.spectral = SlidingWelch(len(self.eeg_channels), self.sampling_rate, self.nfft // 2, self.num_points, overlap=0)
+        else:
+            self.spectral = SlidingWelch(len(self.eeg_channels), self.sampling_rate, self.nfft, self.num_points)
+        self.spectral.push(self.band_power_filter.latest(self.num_points))
+
+    def _ctrl(self, name, value):
+        self.messages.append((self.ctrl_topic + name, value, self.reader.last_timestamp))
+
+    def stats(self):
+        return {
+            'stages': self.metrics.snapshot(),
+            'samples_received': self.reader.samples_received,
+            'samples_dropped': self.reader.samples_dropped,
+            'dsp_samples_dropped': self.dsp.samples_dropped if self.dsp is not None else 0,
+            'dsp_timeouts': self.dsp_timeouts,
+            'stale_predictions': self.stale_predictions,
+            'inference_alive': self.inference.alive(),
+            'sinks': self.sinks.stats(),
+            'degradation': self.shedder.state() if self.shedder is not None else 'normal',
+            'quality': self.quality.state(),
+        }
+
+    def release(self, result):
+        # hands the scratch arrays of a process() result back once no reader needs them
+        self.eeg_scratch.release(result['eeg'])
+        self.accel_scratch.release(result['accel'])
+        self.gyro_scratch.release(result['gyro'])
+        self.mental_state_scratch.release(result['mental_states'])
+
+    def publish_stats(self):
+        self.sinks.publish(f"{self.topic_prefix}/pipeline/stats", json.dumps(self.stats()))
+
+    def _pool_dsp(self, new_data, clock):
+        # the same steps as _local_dsp, on the shards of this board
+        low = self.shedder is not None and self.shedder.active('low_psd_resolution')
+        self.low_resolution = low
+        # samples held back by a timed out tick come first. A timeout skips
+        # one update: the plots keep the last windows, features and
+        # predictions their last values, the shards get the samples again
+        # next tick.
+        try:
+            new_data = self.dsp.process(new_data, low)
+        except TimeoutError as error:
+            self.dsp_timeouts += 1
+            self.metrics.set('dsp_timeouts', self.dsp_timeouts)
+            logging.warning(f"{error}, skipping this update")
+            new_data = None
+        if new_data is not None:
+            for group, window in self.dsp_windows.items():
+                self.dsp.window(group, window)
+        filtered_data = self.eeg_scratch.next()
+        accel_data = self.accel_scratch.next()
+        gyro_data = self.gyro_scratch.next()
+        filtered_data[...] = self.dsp_windows['eeg']
+        accel_data[...] = self.dsp_windows['accel']
+        gyro_data[...] = self.dsp_windows['gyro']
+        clock.lap('dsp')
+        if new_data is not None:
+            # the new samples are the end of the filtered windows
+            start = self.num_points - min(new_data.shape[1], self.num_points)
+            self.quality.update(new_data[self.eeg_channels, start - self.num_points:], filtered_data[:, start:],
+                                accel_data[:, start:], gyro_data[:, start:])
+        clock.lap('quality')
+        if new_data is None or not self.quality.usable:
+            return filtered_data, accel_data, gyro_data, None
+        return filtered_data, accel_data, gyro_data, self.dsp.powers()
+
+    def _local_dsp(self, new_data, clock):
+        self._update_resolution()
+        raw_eeg = new_data[self.eeg_channels]
+        new_eeg = self.eeg_filter.process(raw_eeg)
+        new_accel = self.accel_filter.process(new_data[self.accel_channels])
+        new_gyro = self.gyro_filter.process(new_data[self.gyro_channels])
+        clock.lap('filter')
+        self.quality.update(raw_eeg, new_eeg, new_accel, new_gyro)
+        clock.lap('quality')
+        # FFTs only for the Welch segments completed by the new samples
+        self.spectral.push(self.band_power_filter.process(new_eeg))
+
+        filtered_data = self.eeg_filter.buffer.copy_latest(self.num_points, self.eeg_scratch.next())
+        accel_data = self.accel_filter.buffer.copy_latest(self.num_points, self.accel_scratch.next())
+        gyro_data = self.gyro_filter.buffer.copy_latest(self.num_points, self.gyro_scratch.next())
+        # no PSD for windows that only hold artefacts
+        if not self.quality.usable:
+            return filtered_data, accel_data, gyro_data, None
+
+        # one PSD per tick, the band powers of the models come from it
+        psd = self.spectral.psd()
+        clock.lap('psd')
+        # print(filtered_data)
+
+        # if np.average(abs(accel_data[0][-1])) > 0.05:
+        #     # send_message_to_mqtt("/themotor/move", str(int(np.average(accel_data[0][-1])*5000)))
+        #     print(np.average(accel_data[0][-1]))
+
+        # print(f"feature band {self.feature_bands}")
+
+        #     if count == 2:
+        #         movement = np.average(data[channel][-100:])
+        #         if abs(movement) > 20:
+        #             send_message_to_mqtt("/theground/rotation", str(int(movement*10000)))
+
+            # if count == 0:
+            #     movement = np.average(data[channel][-100:])
+            #     if abs(movement) > 20:
+            #         send_message_to_mqtt("/themotor/move", str(int(movement*100)))
+
+
+            # if count == 1:
+            #     movement = np.average(data[channel][-100:])
+            #     if abs(movement) > 20:
+            #         send_message_to_mqtt("/thesun/rotation", str(int(movement*10000)))
+
+            # print(np.average(data[channel][-100:]))
+
+        return filtered_data, accel_data, gyro_data, self.spectral.band_powers(AVG_BANDS, psd)
+
+    def process(self):
+        clock = self.metrics.clock()
+        # only the samples that arrived since the last tick go through the filters
+        new_data = self.reader.poll()
+        clock.lap('fetch')
+        if self.dsp is not None:
+            filtered_data, accel_data, gyro_data, powers = self._pool_dsp(new_data, clock)
+        else:
+            filtered_data, accel_data, gyro_data, powers = self._local_dsp(new_data, clock)
+        # the plots remove the mean, the window itself stays append only
+        eeg_means = np.mean(filtered_data, axis=1, keepdims=True)
+        # powers is None when the quality window is not usable, features and
+        # predictions then hold their last values
+        usable = powers is not None
+        if usable:
+            # get_avg_band_powers statistics over the good channels only
+            bands = relative_band_stats(powers[self.quality.good])
+            clock.lap('band_power')
+            if self.verbose:
+                print(f"AvgBand: {bands[0]}, StdBand: {bands[1]}")
+
+        # send_message_to_mqtt("/servos/1", bands[1][0])
+        # send_message_to_mqtt("/servos/2", bands[1][1])
+        # send_message_to_mqtt("/servos/0", bands[1][2])
+        # send_message_to_mqtt("/servos/5", 1.0 - bands[1][3])
+        # send_message_to_mqtt("/servos/6", 1.0 - bands[1][4])
+
+
+        # send_message_to_mqtt("/servos/3", bands[0][0])
+        # send_message_to_mqtt("/servos/4", bands[0][1])
+
+        # send_message_to_mqtt("/servos/0", 1.0 - bands[1][1])
+        
+
+        self.messages.clear()
+        feature_vector = self.feature_vector
+        if usable:
+            # with some bad channels the vector only moves part of the way
+            fill_feature_vector(self.new_features, bands)
+            feature_vector += self.quality.score * (self.new_features - feature_vector)
+            for topic, feature in zip(self.mirror_topics, feature_vector):
+                self.messages.append((topic, feature, self.reader.last_timestamp))
+
+        # print(f"feature_vector {feature_vector}")
+
+
+        self.filtered_feature_data.append_column(feature_vector)
+
+        # for count, channel in enumerate(self.feature_bands):
+        #     self.curves[count+len(self.eeg_channels)+len(self.accel_channels)+len(self.gyro_channels)].setData(self.filtered_feature_data.latest(self.history_size)[count])
+        # print(len(self.filtered_feature_data[0]))
+
+        # print(f"Feature: {feature_vector[:,None]}")
+        # print(feature_vector)
+        #calc concentration
+        # concentration_params = BrainFlowModelParams(BrainFlowMetrics.CONCENTRATION.value, BrainFlowClassifiers.KNN.value)
+        # concentration = MLModel(concentration_params)
+        # concentration.prepare()
+        # print('Concentration: %f' % concentration_value)
+        # concentration.release()
+        if usable:
+            seq = self.inference.submit(self.inference_slot, feature_vector)
+            predictions, fresh = self.inference.result(self.inference_slot, seq, self.inference_timeout,
+                                                       out=self.predictions)
+            if not fresh:
+                self.stale_predictions += 1
+        else:
+            # nothing for the models to see, the last predictions stay
+            predictions, _ = self.inference.result(self.inference_slot, out=self.predictions)
+        concentration_value = predictions[self.concentration_index]
+        relaxation_value = predictions[self.relaxation_index]
+        clock.lap('predict')
+        # relaxation.release()
+        # print(f"Relaxation: {relaxation_value}, Concentration: {concentration_value}")
+
+        # send_message_to_mqtt("/mirror/10/position", bands[1][0]);
+
+        self.mental_state_values[0] = relaxation_value
+        self.mental_state_values[1] = concentration_value
+        self.mental_state_data.append_column(self.mental_state_values)
+        
+        # send_message_to_tidal('concentration', concentration_value)
+        # send_message_to_tidal('relaxation', relaxation_value)
+        # send_message_to_servo(2,relaxation_value)
+        # send_message_to_mqtt("/thelight/1/brightness", concentration_value)
+        # send_message_to_mqtt("/thesun/light/1/brightness", relaxation_value)
+        # send_message_to_mqtt("/thesun/light/2/brightness", relaxation_value)
+        # timeNow = time.time()
+        # if (relaxation_value < 0.3 and (timeNow - self.lastMoveTime) > 3.5):
+        #     self.lastMoveTime = timeNow
+        #     print("move")
+        #     if self.lastDirection == -1:
+        #         # send_message_to_mqtt("/themotor/move", "-" + str(random.randrange(1000,10000)))
+        #         self.lastDirection = 1
+        #     elif self.lastDirection == 1:
+        #         # send_message_to_mqtt("/themotor/move", str(random.randrange(1000,10000)))
+        #         self.lastDirection = -1
+        if self.verbose:
+            print("relax " + str(relaxation_value));
+
+            print("con " + str(concentration_value));
+        # the mirrors go out every usable tick, under load the controls every
+        # other one. On bad windows only the quality goes out.
+        self.ticks += 1
+        self._ctrl('quality', round(self.quality.score, 3))
+        if usable and not (self.shedder is not None and self.shedder.active('coalesce_outputs') and self.ticks % 2):
+            self._ctrl('relaxation', relaxation_value)
+            self._ctrl('concentration', concentration_value)
+            self._ctrl('irelaxation', int(relaxation_value*100))
+            self._ctrl('iconcentration', int(concentration_value*10))
+
+            self._ctrl('alpha', bands[0][0])
+            self._ctrl('beta', bands[0][1])
+            self._ctrl('theta', bands[0][2])
+            self._ctrl('delta', bands[0][3])
+            self._ctrl('gamma', bands[0][4])
+
+            self._ctrl('ialpha', int(bands[0][0]*10))
+            self._ctrl('ibeta', int(bands[0][1]*10))
+            self._ctrl('itheta', int(bands[0][2]*10))
+            self._ctrl('idelta', int(bands[0][3]*10))
+            self._ctrl('igamma', int(bands[0][4]*10))
+        # mirrors and controls of the tick in one go, sending happens on the sink tasks
+        self.sinks.publish_many(self.messages)
+        clock.lap('output')
+        self._observe_age('sample_to_output')
+        clock.total('tick')
+        self.metrics.set('signal_quality', round(self.quality.score, 3))
+        self.metrics.set('motion', round(self.quality.motion, 3))
+        if self.shedder is not None:
+            self.metrics.set('degradation_level', self.shedder.level)
+            self.metrics.set('load', round(self.shedder.load, 3))
+
+        now = time.time()
+        if self.stats_interval and now - self.last_stats >= self.stats_interval:
+            self.last_stats = now
+            self.publish_stats()
+
+        # samples is the absolute sample count at the end of the eeg, accel and gyro windows
+        return {
+            'samples': self.reader.samples_received,
+            'eeg': filtered_data,
+            'eeg_means': eeg_means,
+            'accel': accel_data,
+            'gyro': gyro_data,
+            'mental_states': self.mental_state_data.copy_latest(self.history_size, self.mental_state_scratch.next()),
+        }
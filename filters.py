@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+import hashlib
+import json
+import threading
+
+import numpy as np
+from scipy import signal
+from brainflow.data_filter import NoiseTypes
+
+from ring_buffer import RingBuffer
+
+# Filter specs follow the BrainFlow DataFilter.perform_* arguments the viewers
+# were written against (BrainFlow 4.x, band filters take center and width):
+#   ('bandpass', center, width, order)   ('bandstop', center, width, order)
+#   ('highpass', cutoff, order)          ('lowpass', cutoff, order)
+#   ('noise', NoiseTypes value)          like remove_environmental_noise
+EEG_FILTERS = [
+    ('bandpass', 30.0, 58.0, 2),
+    ('bandstop', 50.0, 4.0, 2),
+]
+ACCEL_FILTERS = [
+    ('highpass', 0.1, 1),
+    ('lowpass', 20.0, 1),
+]
+# what get_avg_band_powers(apply_filters=True) runs on the window after a
+# constant detrend, applied to the filtered EEG before the band powers so the
+# models get the inputs they were trained on
+BAND_POWER_FILTERS = [
+    ('bandstop', 50.0, 4.0, 4),
+    ('bandstop', 60.0, 4.0, 4),
+    ('bandpass', 24.0, 47.0, 4),
+]
+
+
+# remove_environmental_noise is a 4th order Butterworth band stop 4 Hz wide
+NOISE_FILTERS = {
+    NoiseTypes.FIFTY.value: ('bandstop', 50.0, 4.0, 4),
+    NoiseTypes.SIXTY.value: ('bandstop', 60.0, 4.0, 4),
+}
+
+
+def design_sos(spec, sampling_rate):
+    kind = spec[0]
+    if kind == 'noise':
+        return design_sos(NOISE_FILTERS[spec[1]], sampling_rate)
+    if kind in ('bandpass', 'bandstop'):
+        _, center, width, order = spec
+        band = [center - width / 2.0, center + width / 2.0]
+        return signal.butter(order, band, btype=kind, fs=sampling_rate, output='sos')
+    if kind in ('highpass', 'lowpass'):
+        _, cutoff, order = spec
+        sos = signal.butter(order, cutoff, btype=kind, fs=sampling_rate, output='sos')
+        if kind == 'highpass' and order % 2:
+            # BrainFlow's odd order Butterworth high pass comes out inverted,
+            # match it so results don't depend on which implementation ran
+            sos[0, :3] *= -1
+        return sos
+    raise ValueError(f"unknown filter type {kind}")
+
+
+def design_chain(specs, sampling_rate):
+    # a chain of filters is just all their second order sections in series
+    return np.vstack([design_sos(spec, sampling_rate) for spec in specs])
+
+
+class FilterChain:
+    # A filter chain compiled for one sampling rate. key is a hash of the
+    # specs and sampling rate, so equal configs share one chain wherever they
+    # come from (code, config file, recorder, offline tools).
+    def __init__(self, specs, sampling_rate):
+        self.specs = _normalize(specs)
+        self.sampling_rate = sampling_rate
+        self.key = chain_key(self.specs, sampling_rate)
+        self.sos = design_chain(self.specs, sampling_rate) if self.specs else None
+        # steady state for a unit input, scaled per channel by the streaming filters
+        self.zi = signal.sosfilt_zi(self.sos) if self.specs else None
+
+    def apply(self, data, out=None):
+        # Filters every row of data (channels x samples) in one call, from
+        # zero state, like calling the DataFilter.perform_* of the specs on
+        # each row. out may be data itself.
+        filtered = signal.sosfilt(self.sos, data, axis=1) if self.sos is not None else data
+        if out is None:
+            return filtered
+        out[...] = filtered
+        return out
+
+    def streaming(self, num_channels, capacity):
+        return StreamingFilterBank(self, self.sampling_rate, num_channels, capacity)
+
+
+def _normalize(specs):
+    return tuple(tuple(spec) for spec in specs)
+
+
+def chain_key(specs, sampling_rate):
+    # numbers as floats, so 30 and 30.0 give the same key
+    description = json.dumps([float(sampling_rate), [[value if isinstance(value, str) else float(value) for value in spec]
+                                                     for spec in specs]], separators=(',', ':'))
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+_chains = {}
+_chains_lock = threading.Lock()
+
+
+def compile_chain(specs, sampling_rate):
+    # designed once per (specs, sampling rate) and shared, don't modify
+    if isinstance(specs, FilterChain):
+        return specs
+    key = chain_key(specs, sampling_rate)
+    with _chains_lock:
+        chain = _chains.get(key)
+        if chain is None:
+            chain = FilterChain(specs, sampling_rate)
+            _chains[key] = chain
+        return chain
+
+
+def filter_matrix(data, specs, sampling_rate, out=None):
+    return compile_chain(specs, sampling_rate).apply(data, out)
+
+
+# Filter chains per channel group, the groups medium_viz plots, and the chain
+# between the filtered EEG and its band powers. A config file has the same
+# layout as json:
+#   {"eeg": [["bandpass", 30.0, 58.0, 2], ["bandstop", 50.0, 4.0, 2]],
+#    "accel": [["highpass", 0.1, 1], ["lowpass", 20.0, 1]],
+#    "gyro": [],
+#    "band_power": [["bandstop", 50.0, 4.0, 4], ["bandstop", 60.0, 4.0, 4], ["bandpass", 24.0, 47.0, 4]]}
+FILTER_CONFIG = {
+    'eeg': EEG_FILTERS,
+    'accel': ACCEL_FILTERS,
+    'gyro': [],
+    'band_power': BAND_POWER_FILTERS,
+}
+
+
+def load_filter_config(path=None):
+    # groups missing from the file keep the default chain
+    config = dict(FILTER_CONFIG)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def compile_filter_config(config, sampling_rate):
+    return {group: compile_chain(specs, sampling_rate) for group, specs in config.items()}
+
+
+def detrend_linear(data):
+    # DataFilter.detrend(LINEAR) on every row, in place. BrainFlow centers the
+    # sample index on n / 2 rather than (n - 1) / 2, kept for identical output.
+    n = data.shape[1]
+    index = np.arange(n, dtype=float)
+    mean_x = n / 2.0
+    mean_y = data.mean(axis=1, keepdims=True)
+    s_xy = data @ index[:, None] / n - mean_x * mean_y
+    s_xx = np.dot(index, index) / n - mean_x * mean_x
+    gradient = s_xy / s_xx
+    data -= gradient * index + (mean_y - gradient * mean_x)
+    return data
+
+
+class StreamingFilterBank:
+    # Causal IIR chain applied to all channels of a group at once. Keeps the
+    # filter state (zi) between calls so every tick only filters the samples
+    # that arrived since the last one, and stores the output in a ring buffer.
+    def __init__(self, specs, sampling_rate, num_channels, capacity):
+        # specs may also be an already compiled FilterChain
+        self.chain = compile_chain(specs, sampling_rate)
+        self.sos = self.chain.sos
+        self.num_channels = num_channels
+        self.zi = None
+        self.buffer = RingBuffer(num_channels, capacity)
+
+    def process(self, block):
+        if block.shape[1] == 0:
+            return block
+        if self.sos is None:
+            filtered = block
+        else:
+            if self.zi is None:
+                # start in steady state for the first sample instead of from
+                # zero, otherwise the step response rings through the window
+                self.zi = self.chain.zi[:, None, :] * block[None, :, 0, None]
+            filtered, self.zi = signal.sosfilt(self.sos, block, axis=1, zi=self.zi)
+        self.buffer.append(filtered)
+        return filtered
+
+    def latest(self, n):
+        return self.buffer.latest(n)
+
+    def reset(self):
+        self.zi = None
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import signal
+import threading
+
+from brainflow.board_shim import BoardShim, BrainFlowInputParams
+
+from pipeline import ProcessingThread, LoadShedder, DEGRADATIONS
+from features import FeaturePipeline
+from metrics import MetricsServer
+from filters import load_filter_config
+from inference import InferenceStage
+from sinks import SinkHub, load_sink_config
+from shared_ring import SharedBoard
+from dsp_pool import DspPool
+from quality import load_quality_config
+
+# The medium_viz pipeline (acquisition, filtering, band powers, MLModel,
+# output sinks) without a display. Nothing Qt is imported unless --gui is given,
+# in which case the medium_viz window is attached to the running pipeline and
+# only renders. SIGTERM (systemd stop) and SIGINT shut down cleanly. Stage
+# timings are served on http://127.0.0.1:<metrics-port>/metrics.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--board-id', type=int, default=8)
+    parser.add_argument('--ip-address', type=str, default='')
+    parser.add_argument('--ip-port', type=int, default=0)
+    parser.add_argument('--other-info', type=str, default='')
+    parser.add_argument('--serial-port', type=str, default='')
+    parser.add_argument('--shm', type=str, default=None, help='read from the shared ring of acquisition_daemon.py')
+    parser.add_argument('--name', type=str, default=None, help='namespace for MQTT topics and Tidal controls')
+    parser.add_argument('--processing-speed-ms', type=int, default=100)
+    parser.add_argument('--buffer-size', type=int, default=450000)
+    parser.add_argument('--gui', action='store_true', help='also show the medium_viz plots')
+    parser.add_argument('--filter-config', type=str, default=None, help='json file with the filter chain per channel group')
+    parser.add_argument('--inference-process', action='store_true', help='run the ML models in a separate process')
+    parser.add_argument('--sinks', type=str, default=None, help='json file with the output sinks')
+    parser.add_argument('--metrics-port', type=int, default=9101, help='local metrics endpoint, 0 to disable')
+    parser.add_argument('--quality-config', type=str, default=None, help='json file with the signal quality thresholds')
+    parser.add_argument('--dsp-workers', type=int, default=0, help='processes for filters and PSD, 0 to run them in the tick')
+    parser.add_argument('--verbose', action='store_true', help='print band powers and predictions every tick')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    params = BrainFlowInputParams()
+    params.ip_address = args.ip_address
+    params.ip_port = args.ip_port
+    params.other_info = args.other_info
+    params.serial_port = args.serial_port
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    if args.shm:
+        board_shim = SharedBoard(args.shm)
+    else:
+        board_shim = BoardShim(args.board_id, params)
+    worker = None
+    metrics_server = None
+    inference = None
+    hub = None
+    dsp_pool = None
+    try:
+        board_shim.prepare_session()
+        board_shim.start_stream(args.buffer_size)
+        if args.inference_process:
+            inference = InferenceStage(max_slots=1, use_process=True)
+        hub = SinkHub(load_sink_config(args.sinks))
+        if args.dsp_workers:
+            dsp_pool = DspPool(args.dsp_workers)
+        # without plots only the PSD resolution and the controls can give way
+        shedder = LoadShedder(args.processing_speed_ms,
+                              DEGRADATIONS if args.gui else ['low_psd_resolution', 'coalesce_outputs'])
+        pipeline = FeaturePipeline(board_shim, name=args.name, processing_speed_ms=args.processing_speed_ms,
+                                   verbose=args.verbose, filter_config=load_filter_config(args.filter_config),
+                                   inference=inference, sinks=hub, shedder=shedder, dsp_pool=dsp_pool,
+                                   quality_config=load_quality_config(args.quality_config))
+        worker = ProcessingThread(pipeline.process, args.processing_speed_ms, name='headless', shedder=shedder,
+                                  release_fn=pipeline.release)
+        worker.start()
+        if args.metrics_port:
+            metrics_server = MetricsServer(lambda: [pipeline.metrics] + hub.metrics(), port=args.metrics_port).start()
+        logging.info('Pipeline running')
+
+        if args.gui:
+            import medium_viz
+            # returns when the window is closed or stop is set
+            medium_viz.Graph(board_shim, pipeline, worker, stop)
+        else:
+            while not stop.wait(10.0):
+                logging.info(f"feature rate {worker.rate():.1f} Hz, last tick {worker.last_cost * 1000:.1f} ms, "
+                             f"{pipeline.reader.samples_dropped} samples dropped, load {shedder.load:.0%}, {shedder.state()}, "
+                             f"quality {pipeline.quality.score:.2f}")
+                for name in ('tick', 'sample_to_output'):
+                    stats = pipeline.metrics.histogram(name).snapshot()
+                    logging.info(f"{name}: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, max {stats['max_ms']:.1f} ms")
+    except BaseException as e:
+        logging.warning('Exception', exc_info=True)
+    finally:
+        logging.info('End')
+        if worker is not None:
+            worker.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if dsp_pool is not None:
+            dsp_pool.stop()
+        if inference is not None:
+            inference.stop()
+        if hub is not None:
+            hub.stop()
+        if board_shim.is_prepared():
+            logging.info('Releasing session')
+            board_shim.release_session()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+import logging
+import multiprocessing
+import signal
+import threading
+
+import numpy as np
+from multiprocessing import shared_memory
+
+from brainflow.ml_model import MLModel, BrainFlowMetrics, BrainFlowClassifiers, BrainFlowModelParams
+
+# every model run on each feature vector, in this order
+MODELS = [
+    ('relaxation', BrainFlowMetrics.RELAXATION.value, BrainFlowClassifiers.REGRESSION.value),
+    ('concentration', BrainFlowMetrics.CONCENTRATION.value, BrainFlowClassifiers.KNN.value),
+]
+NUM_FEATURES = 10
+
+
+class SharedModel:
+    # BrainFlow refuses to prepare the same classifier twice in one process, so
+    # every pipeline uses one prepared instance per model, predict is serialized
+    def __init__(self, metric, classifier):
+        self.model = MLModel(BrainFlowModelParams(metric, classifier))
+        self.model.prepare()
+        self.lock = threading.Lock()
+
+    def predict(self, feature_vector):
+        with self.lock:
+            return self.model.predict(feature_vector)
+
+_models = {}
+_models_lock = threading.Lock()
+
+def shared_model(metric, classifier):
+    with _models_lock:
+        model = _models.get((metric, classifier))
+        if model is None:
+            model = SharedModel(metric, classifier)
+            _models[(metric, classifier)] = model
+        return model
+
+
+def _run_pass(models, inputs, outputs, input_seq, output_seq, lock, row, done):
+    # predicts every slot with a newer input than its last output, all models
+    # per slot. Only the newest vector of a slot is kept, so ticks that queued
+    # up while the models were busy are coalesced into one prediction. The
+    # predictions of a slot are written under the lock, so result() never
+    # sees half of them. done() is called after each slot, to wake whoever
+    # waits for it.
+    with lock:
+        pending = np.flatnonzero(input_seq > output_seq)
+    predictions = np.zeros(len(models), dtype=float)
+    for slot in pending:
+        with lock:
+            row[:] = inputs[slot]
+            seq = input_seq[slot]
+        for count, model in enumerate(models):
+            predictions[count] = model.predict(row)
+        with lock:
+            outputs[slot] = predictions
+            output_seq[slot] = seq
+        done()
+    return len(pending)
+
+
+def _worker_main(names, memory, max_slots, request, done, stop):
+    # like the DSP workers, Ctrl-C and SIGTERM are for the owner, which stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    models = []
+    for name, metric, classifier in MODELS:
+        if name in names:
+            model = MLModel(BrainFlowModelParams(metric, classifier))
+            model.prepare()
+            models.append(model)
+    arrays, blocks = _attach(names, memory, max_slots)
+    lock = memory['lock']
+    row = np.zeros(NUM_FEATURES, dtype=float)
+    try:
+        while not stop.is_set():
+            if request.wait(0.1):
+                request.clear()
+                try:
+                    _run_pass(models, *arrays, lock, row, done.release)
+                except Exception:
+                    logging.warning('Inference pass failed', exc_info=True)
+    finally:
+        for block in blocks:
+            block.close()
+
+
+def _layout(num_models, max_slots):
+    return {
+        'inputs': ((max_slots, NUM_FEATURES), np.float64),
+        'outputs': ((max_slots, num_models), np.float64),
+        'input_seq': ((max_slots,), np.int64),
+        'output_seq': ((max_slots,), np.int64),
+    }
+
+
+def _attach(names, memory, max_slots):
+    arrays = []
+    blocks = []
+    for key, (shape, dtype) in _layout(len(names), max_slots).items():
+        block = shared_memory.SharedMemory(name=memory[key])
+        blocks.append(block)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+    return arrays, blocks
+
+
+class InferenceStage:
+    # Runs all registered models on the feature vectors of every headset in
+    # one pass, on a background thread or (use_process) in a separate process
+    # so a slow model never blocks acquisition. Each headset gets a slot in
+    # preallocated input and output arrays (shared memory in process mode);
+    # submit copies a vector into its slot and returns right away, result
+    # returns the newest predictions of the slot, waiting on a condition that
+    # is notified whenever a slot got new predictions.
+    def __init__(self, models=None, max_slots=16, use_process=False):
+        self.names = [name for name, _, _ in MODELS if models is None or name in models]
+        self.max_slots = max_slots
+        self.use_process = use_process
+        self.slots = {}
+        self.submitted = np.zeros(max_slots, dtype=np.int64)
+        self.passes = 0
+        self.blocks = []
+        self.stop_event = None
+        self.predicted = threading.Condition()
+        self.worker_lost = False
+
+        if use_process:
+            context = multiprocessing.get_context('spawn')
+            self.lock = context.Lock()
+            self.request = context.Event()
+            # released by the worker per predicted slot, never blocks it
+            self.done = context.Semaphore(0)
+            self.stop_event = context.Event()
+            memory = {'lock': self.lock}
+            arrays = []
+            for key, (shape, dtype) in _layout(len(self.names), max_slots).items():
+                block = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                self.blocks.append(block)
+                array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                array.fill(0)
+                arrays.append(array)
+                memory[key] = block.name
+            self.inputs, self.outputs, self.input_seq, self.output_seq = arrays
+            self.worker = context.Process(target=_worker_main, name='inference',
+                                          args=(self.names, memory, max_slots, self.request, self.done, self.stop_event),
+                                          daemon=True)
+            # turns the worker's releases into notifications for the waiting threads
+            self.listener = threading.Thread(target=self._listen, name='inference-done', daemon=True)
+            self.listener.start()
+        else:
+            self.lock = threading.Lock()
+            self.request = threading.Event()
+            self.stop_event = threading.Event()
+            self.inputs = np.zeros((max_slots, NUM_FEATURES), dtype=np.float64)
+            self.outputs = np.zeros((max_slots, len(self.names)), dtype=np.float64)
+            self.input_seq = np.zeros(max_slots, dtype=np.int64)
+            self.output_seq = np.zeros(max_slots, dtype=np.int64)
+            models = [shared_model(metric, classifier) for name, metric, classifier in MODELS if name in self.names]
+            self.worker = threading.Thread(target=self._thread_main, args=(models,), name='inference', daemon=True)
+        self.worker.start()
+
+    def _notify(self):
+        with self.predicted:
+            self.predicted.notify_all()
+
+    def _thread_main(self, models):
+        row = np.zeros(NUM_FEATURES, dtype=float)
+        while not self.stop_event.is_set():
+            if self.request.wait(0.1):
+                self.request.clear()
+                try:
+                    if _run_pass(models, self.inputs, self.outputs, self.input_seq, self.output_seq, self.lock, row,
+                                 self._notify):
+                        self.passes += 1
+                except Exception:
+                    logging.warning('Inference pass failed', exc_info=True)
+
+    def _listen(self):
+        while not self.stop_event.is_set():
+            if self.done.acquire(timeout=0.1):
+                self._notify()
+
+    def slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            if len(self.slots) == self.max_slots:
+                raise ValueError(f"more than {self.max_slots} headsets on one inference stage")
+            slot = len(self.slots)
+            self.slots[key] = slot
+        return slot
+
+    def submit(self, slot, feature_vector):
+        with self.lock:
+            self.inputs[slot] = feature_vector
+            self.submitted[slot] += 1
+            self.input_seq[slot] = self.submitted[slot]
+        self.request.set()
+        return self.submitted[slot]
+
+    def result(self, slot, seq=0, timeout=0.0, out=None):
+        # newest predictions of the slot (one value per model name), waiting
+        # up to timeout seconds for the prediction of submission seq. They are
+        # copied into out (a new array without it), the outputs themselves
+        # keep changing under the caller.
+        if self.output_seq[slot] < seq and timeout > 0 and self.alive():
+            with self.predicted:
+                self.predicted.wait_for(lambda: self.output_seq[slot] >= seq, timeout)
+        if out is None:
+            out = np.zeros(len(self.names), dtype=float)
+        with self.lock:
+            out[:] = self.outputs[slot]
+            fresh = bool(self.output_seq[slot] >= seq)
+        return out, fresh
+
+    def alive(self):
+        # without its worker the predictions stay frozen, said once in the log
+        if self.worker.is_alive():
+            return True
+        if not self.worker_lost and not self.stop_event.is_set():
+            self.worker_lost = True
+            logging.error(f"inference worker exited ({self.worker.name}), predictions are frozen")
+        return False
+
+    def stop(self):
+        self.stop_event.set()
+        self.worker.join(1.0)
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+_default_stage = None
+_default_lock = threading.Lock()
+
+def default_inference():
+    # one thread mode stage for all pipelines of the process that don't get one
+    global _default_stage
+    with _default_lock:
+        if _default_stage is None:
+            _default_stage = InferenceStage()
+        return _default_stage
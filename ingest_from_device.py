@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 import argparse
+import logging
+import signal
+import threading
 import time
 import numpy as np
 import pandas as pd
@@ -8,28 +11,55 @@ import brainflow
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, LogLevels, BoardIds
 from brainflow.data_filter import DataFilter, FilterTypes, AggOperations
 
+from recorder import SegmentedRecorder, run_recorder
+
 
 def main():
     BoardShim.enable_dev_board_logger()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--record', type=str, default=None,
+                        help='also record into rotating segments <record>-<time>.bfrec, see record.py')
+    parser.add_argument('--poll-ms', type=int, default=200, help='drain cadence of the board buffer')
+    parser.add_argument('--segment-minutes', type=float, default=60.0)
+    parser.add_argument('--stats-interval', type=float, default=60.0)
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
 
     # use synthetic board for demo
     params = BrainFlowInputParams()
     board = BoardShim(8, params)
-    board.prepare_session()
-    board.start_stream(45000, 'streaming_board://224.0.0.1:6666')
-    BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'start sleeping in the main thread')
-
-    while True:
-        time.sleep(5)
-        data = board.get_board_data()
-        print(data)
-    # BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'dumping first 5 seconds of measurement')
-    input("Press Enter to stop streaming...")
-    # time.sleep(60)
-    # data = board.get_board_data()
-    
-    board.stop_stream()
-    board.release_session()
+    recorder = None
+    try:
+        board.prepare_session()
+        board.start_stream(45000, 'streaming_board://224.0.0.1:6666')
+        BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'start sleeping in the main thread')
+        if args.record:
+            recorder = SegmentedRecorder(args.record, board.get_board_id(), segment_seconds=args.segment_minutes * 60)
+            run_recorder(board, recorder, stop, args.poll_ms, args.stats_interval)
+        else:
+            # the streamer sends everything, the local buffer only has to be emptied
+            samples = 0
+            last_stats = time.monotonic()
+            while not stop.wait(args.poll_ms / 1000.0):
+                samples += board.get_board_data().shape[1]
+                if args.stats_interval and time.monotonic() - last_stats >= args.stats_interval:
+                    last_stats = time.monotonic()
+                    logging.info(f"{samples} samples streamed")
+    except BaseException as e:
+        logging.warning('Exception', exc_info=True)
+    finally:
+        logging.info('End')
+        if recorder is not None:
+            recorder.close()
+            logging.info(f"{recorder.stats()}")
+        if board.is_prepared():
+            logging.info('Releasing session')
+            board.release_session()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,12 +4,15 @@ import time
 import numpy as np
 import pandas as pd
 import signal
+import threading
 
 import brainflow
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, LogLevels, BoardIds
 from brainflow.data_filter import DataFilter, FilterTypes, AggOperations
 import os, sys
 
+from playback import PlaybackServer, open_recording
+
 class GracefulKiller:
   kill_now = False
   def __init__(self):
@@ -23,31 +26,25 @@ class GracefulKiller:
 def main():
     BoardShim.enable_dev_board_logger()
     original_board_id = BoardIds.UNICORN_BOARD.value
-    board_id = BoardIds.PLAYBACK_FILE_BOARD.value
-
-    # use synthetic board for demo
-    params = BrainFlowInputParams()
-    params.other_info = str(original_board_id)
-    params.file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Testdump1.gtec')
 
-    board = BoardShim(board_id, params)
-
-    board.prepare_session()
-    board.config_board ('loopback_true')
-    board.start_stream(5000, 'streaming_board://224.0.0.1:6666')
+    # replays onto the streaming board multicast group, see playback.py for
+    # speed, seeking and looping
+    recording = open_recording(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Testdump1.gtec'),
+                               original_board_id)
+    server = PlaybackServer(recording, '224.0.0.1', 6666, loop=True)
+    worker = threading.Thread(target=server.run, name='playback')
+    worker.start()
     BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'start sleeping in the main thread')
 
     killer = GracefulKiller()
-    while not killer.kill_now:
+    while not killer.kill_now and worker.is_alive():
         time.sleep(1)
-        print(board.get_board_data_count())
-        data = board.get_board_data()
-        # print(board.get_board_data_count())
-        # print(len(data.flatten()))
-
-    print("Closing Stream") 
-    board.stop_stream()
-    board.release_session()
+        print(server.position)
+
+    print("Closing Stream")
+    server.stop()
+    worker.join()
+    recording.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+import http.server
+import json
+import threading
+import time
+
+import numpy as np
+
+# bucket upper bounds in seconds, roughly logarithmic from 50 us to 10 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    # Fixed bucket histogram (cumulative since start, like a Prometheus
+    # histogram). Percentiles are interpolated inside the bucket they fall in.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = np.array(buckets, dtype=float)
+        self.counts = np.zeros(len(self.bounds) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.last = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q / 100.0 * self.count
+        cumulative = np.cumsum(self.counts)
+        bucket = int(np.searchsorted(cumulative, rank))
+        lower = self.bounds[bucket - 1] if bucket > 0 else 0.0
+        upper = self.bounds[bucket] if bucket < len(self.bounds) else self.max
+        below = cumulative[bucket - 1] if bucket > 0 else 0
+        fraction = (rank - below) / self.counts[bucket] if self.counts[bucket] else 0.0
+        return float(min(lower + (upper - lower) * fraction, self.max))
+
+    def snapshot(self):
+        # milliseconds, for logs, JSON and MQTT
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+            'last_ms': self.last * 1000,
+        }
+
+
+class Metrics:
+    # Named latency histograms of one pipeline. Stages are timed with a
+    # StageClock, end to end latencies are observed directly. Gauges hold
+    # plain current values (e.g. the degradation level).
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def clock(self):
+        return StageClock(self)
+
+    def snapshot(self):
+        return {name: histogram.snapshot() for name, histogram in list(self.histograms.items())}
+
+    def prometheus(self, prefix='eeg_pipeline'):
+        labels = ','.join(f'{key}="{value}"' for key, value in self.labels.items())
+        lines = []
+        for name, histogram in sorted(list(self.histograms.items())):
+            metric = f"{prefix}_{name}_seconds"
+            cumulative = np.cumsum(histogram.counts)
+            for bound, count in zip(histogram.bounds, cumulative):
+                lines.append(f'{metric}_bucket{{{labels}{"," if labels else ""}le="{bound:g}"}} {count}')
+            lines.append(f'{metric}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum{{{labels}}} {histogram.total}")
+            lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        for name, value in sorted(list(self.gauges.items())):
+            lines.append(f"{prefix}_{name}{{{labels}}} {value}")
+        return lines
+
+
+class StageClock:
+    # times consecutive stages of one tick: clock.lap('filter') records the
+    # time since the previous lap under 'filter'
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.metrics.observe(name, now - self.last)
+        self.last = now
+
+    def total(self, name='tick'):
+        self.metrics.observe(name, time.perf_counter() - self.start)
+
+
+class MetricsServer:
+    # Local HTTP endpoint: /metrics in Prometheus text format, /metrics.json as
+    # the snapshots of all registries
+    def __init__(self, registries, host='127.0.0.1', port=9101):
+        self.registries = registries
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    lines = []
+                    for metrics in server.registries():
+                        lines.extend(metrics.prometheus())
+                    body = ('\n'.join(lines) + '\n').encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps([dict(labels=metrics.labels, stages=metrics.snapshot(), gauges=dict(metrics.gauges))
+                                       for metrics in server.registries()]).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+import atexit
+import collections
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+# One long lived client per broker host. Each client runs paho's network loop
+# in its own thread (which also does reconnect with backoff) and is fed from a
+# bounded outbound queue by a small sender thread, so callers never block on
+# the network. When the queue is full the oldest message is dropped.
+
+
+def _make_client():
+    # paho-mqtt 2.x wants the callback api version, 1.x does not know about it
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    return mqtt.Client()
+
+
+class MqttPublisher:
+    def __init__(self, hostname, port=1883, max_queue=1000, min_backoff=1, max_backoff=30, keepalive=60):
+        self.hostname = hostname
+        self.port = port
+        self.sent = 0
+        self.dropped = 0
+        self.outbox = collections.deque()
+        self.max_queue = max_queue
+        self.lock = threading.Condition()
+        self.connected = threading.Event()
+        self.running = True
+
+        self.client = _make_client()
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=min_backoff, max_delay=max_backoff)
+        # connect_async defers name resolution and the handshake to the loop
+        # thread, so an offline host (e.g. crystal.local) never blocks us here
+        self.client.connect_async(hostname, port, keepalive)
+        self.client.loop_start()
+
+        self.sender = threading.Thread(target=self._run, name=f"mqtt-{hostname}", daemon=True)
+        self.sender.start()
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            logging.info(f"MQTT connected to {self.hostname}")
+            self.connected.set()
+            with self.lock:
+                self.lock.notify()
+        else:
+            logging.warning(f"MQTT connect to {self.hostname} refused: {rc}")
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected.clear()
+        if self.running:
+            logging.warning(f"MQTT lost connection to {self.hostname}, reconnecting")
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            if len(self.outbox) >= self.max_queue:
+                self.outbox.popleft()
+                self.dropped += 1
+            self.outbox.append((topic, payload, qos, retain))
+            self.lock.notify()
+
+    def publish_multiple(self, messages, qos=0):
+        # same message dicts as paho.mqtt.publish.multiple
+        with self.lock:
+            for message in messages:
+                if len(self.outbox) >= self.max_queue:
+                    self.outbox.popleft()
+                    self.dropped += 1
+                self.outbox.append((message["topic"], message.get("payload"),
+                                    message.get("qos", qos), message.get("retain", False)))
+            self.lock.notify()
+
+    def backlog(self):
+        return len(self.outbox)
+
+    def _run(self):
+        while self.running:
+            with self.lock:
+                while self.running and (not self.outbox or not self.connected.is_set()):
+                    self.lock.wait(0.5)
+                if not self.running:
+                    return
+                batch = list(self.outbox)
+                self.outbox.clear()
+            for count, (topic, payload, qos, retain) in enumerate(batch):
+                info = self.client.publish(topic, payload, qos, retain)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    # connection went away mid batch, put the rest back in front
+                    with self.lock:
+                        self.outbox.extendleft(reversed(batch[count:]))
+                        while len(self.outbox) > self.max_queue:
+                            self.outbox.popleft()
+                            self.dropped += 1
+                    break
+                self.sent += 1
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            self.lock.notify()
+        self.sender.join(1.0)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(hostname, port=1883):
+    with _publishers_lock:
+        publisher = _publishers.get((hostname, port))
+        if publisher is None:
+            publisher = MqttPublisher(hostname, port)
+            _publishers[(hostname, port)] = publisher
+        return publisher
+
+
+def publish(topic, payload, hostname, port=1883, qos=0, retain=False):
+    get_publisher(hostname, port).publish(topic, payload, qos, retain)
+
+
+def publish_multiple(messages, hostname, port=1883, qos=0):
+    if messages:
+        get_publisher(hostname, port).publish_multiple(messages, qos)
+
+
+def stop_all():
+    with _publishers_lock:
+        for publisher in _publishers.values():
+            publisher.stop()
+        _publishers.clear()
+
+
+atexit.register(stop_all)
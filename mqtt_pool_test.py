@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import mqtt_pool
+
+# MqttPublisher against a stand-in for the paho client, whose connection is
+# switched by the test instead of a broker:  python -m pytest mqtt_pool_test.py
+
+
+class FakeInfo:
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class FakeClient:
+    def __init__(self):
+        self.on_connect = None
+        self.on_disconnect = None
+        self.is_connected = False
+        self.published = []
+        self.lock = threading.Lock()
+
+    def reconnect_delay_set(self, min_delay, max_delay):
+        pass
+
+    def connect_async(self, hostname, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.is_connected = False
+
+    def broker_up(self):
+        self.is_connected = True
+        self.on_connect(self, None, {}, 0)
+
+    def broker_down(self):
+        self.is_connected = False
+        self.on_disconnect(self, None, 1)
+
+    def publish(self, topic, payload, qos, retain):
+        if not self.is_connected:
+            return FakeInfo(mqtt.MQTT_ERR_NO_CONN)
+        with self.lock:
+            self.published.append((topic, payload))
+        return FakeInfo(mqtt.MQTT_ERR_SUCCESS)
+
+
+def _publisher(monkeypatch, max_queue=1000):
+    client = FakeClient()
+    monkeypatch.setattr(mqtt_pool, '_make_client', lambda: client)
+    return mqtt_pool.MqttPublisher('broker.test', max_queue=max_queue), client
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_queued_while_disconnected_sent_after_connect(monkeypatch):
+    publisher, client = _publisher(monkeypatch)
+    try:
+        publisher.publish('/mirror/1/position', '0.10')
+        publisher.publish_multiple([{'topic': '/mirror/2/position', 'payload': '0.20'},
+                                    {'topic': '/mirror/3/position', 'payload': '0.30'}])
+        time.sleep(0.1)
+        assert client.published == []
+        assert publisher.backlog() == 3
+
+        client.broker_up()
+        assert _wait_for(lambda: publisher.sent == 3)
+        assert client.published == [('/mirror/1/position', '0.10'), ('/mirror/2/position', '0.20'),
+                                    ('/mirror/3/position', '0.30')]
+    finally:
+        publisher.stop()
+
+
+def test_sends_again_after_reconnect(monkeypatch):
+    publisher, client = _publisher(monkeypatch)
+    try:
+        client.broker_up()
+        publisher.publish('/ctrl/alpha', '1.0')
+        assert _wait_for(lambda: publisher.sent == 1)
+
+        client.broker_down()
+        publisher.publish('/ctrl/alpha', '2.0')
+        publisher.publish('/ctrl/beta', '3.0')
+        time.sleep(0.1)
+        assert publisher.sent == 1
+        assert publisher.backlog() == 2
+
+        client.broker_up()
+        assert _wait_for(lambda: publisher.sent == 3)
+        assert client.published[1:] == [('/ctrl/alpha', '2.0'), ('/ctrl/beta', '3.0')]
+        assert publisher.dropped == 0
+    finally:
+        publisher.stop()
+
+
+def test_full_queue_drops_oldest(monkeypatch):
+    publisher, client = _publisher(monkeypatch, max_queue=3)
+    try:
+        for count in range(5):
+            publisher.publish(f"/servos/{count}", str(count))
+        assert publisher.backlog() == 3
+        assert publisher.dropped == 2
+
+        client.broker_up()
+        assert _wait_for(lambda: publisher.sent == 3)
+        assert client.published == [('/servos/2', '2'), ('/servos/3', '3'), ('/servos/4', '4')]
+    finally:
+        publisher.stop()
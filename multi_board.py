@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import time
+
+import numpy as np
+
+from brainflow.board_shim import BoardShim, BrainFlowInputParams
+
+from pipeline import ProcessingThread, LoadShedder
+from features import FeaturePipeline
+from metrics import MetricsServer
+from filters import FILTER_CONFIG
+from inference import InferenceStage
+from sinks import SinkHub, load_sink_config
+from dsp_pool import DspPool
+from quality import load_quality_config
+
+# Several boards in one process. Each board gets its own acquisition and
+# FeaturePipeline (outputs under /<name>/..., Tidal controls as <name>_...), and
+# every tick the pipelines of all boards are run on one shared thread pool.
+# NumPy, SciPy and BrainFlow release the GIL in their heavy parts, so boards
+# are processed in parallel without pickling board sessions into processes.
+#
+# config file:
+# {
+#     "processing_speed_ms": 100,
+#     "workers": 4,
+#     "filters": {"eeg": [["bandpass", 30.0, 58.0, 2], ["bandstop", 50.0, 4.0, 2]]},
+#     "boards": [
+#         {"name": "unicorn1", "board_id": -2,
+#          "params": {"ip_address": "224.0.0.1", "ip_port": 6666, "other_info": "8"}},
+#         {"name": "unicorn2", "board_id": -2,
+#          "params": {"ip_address": "224.0.0.2", "ip_port": 6666, "other_info": "8"},
+#          "filters": {"eeg": [["bandpass", 30.0, 58.0, 2], ["bandstop", 60.0, 4.0, 2]]}}
+#     ]
+# }
+# "filters" (filters.py FILTER_CONFIG layout) is optional, per board entries
+# override the top level ones per channel group.
+
+
+def open_board(config, buffer_size=450000):
+    params = BrainFlowInputParams()
+    for key, value in config.get('params', {}).items():
+        setattr(params, key, value)
+    board_shim = BoardShim(config['board_id'], params)
+    board_shim.prepare_session()
+    board_shim.start_stream(buffer_size)
+    return board_shim
+
+
+class MultiBoardRunner:
+    def __init__(self, boards, processing_speed_ms=100, workers=None, verbose=False, filter_configs=None,
+                 inference_process=False, sinks=None, dsp_workers=0, quality_config=None):
+        # boards: list of (name, board_shim), filter_configs: name -> filter config
+        filter_configs = filter_configs or {}
+        # the models of all boards run in one pass per tick, optionally in their own process
+        self.inference = InferenceStage(max_slots=max(len(boards), 1), use_process=inference_process)
+        # and all of them publish through one sink hub
+        self.sinks = sinks or SinkHub()
+        # one tick runs every board, so they all shed load together
+        self.shedder = LoadShedder(processing_speed_ms, ['low_psd_resolution', 'coalesce_outputs'])
+        # filters and PSDs of all boards on worker processes instead of the GIL bound threads
+        self.dsp_pool = DspPool(dsp_workers) if dsp_workers else None
+        self.pipelines = [FeaturePipeline(board_shim, name=name, processing_speed_ms=processing_speed_ms, verbose=verbose,
+                                          filter_config=filter_configs.get(name), inference=self.inference,
+                                          sinks=self.sinks, shedder=self.shedder, dsp_pool=self.dsp_pool,
+                                          quality_config=quality_config)
+                          for name, board_shim in boards]
+        # a board has at most one tick in flight, with a thread per board a slow
+        # one can't keep the others from running
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers or max(len(self.pipelines), 1),
+                                                          thread_name_prefix='dsp')
+        self.latencies = {pipeline.name: collections.deque(maxlen=100) for pipeline in self.pipelines}
+        self.pending = {}
+        self.skipped = collections.Counter()
+        self.board_timeout = processing_speed_ms / 2000.0
+        self.by_name = {pipeline.name: pipeline for pipeline in self.pipelines}
+        self.worker = ProcessingThread(self.tick, processing_speed_ms, name='multi-board', shedder=self.shedder,
+                                       release_fn=self.release)
+
+    def _run_pipeline(self, pipeline, submitted):
+        result = pipeline.process()
+        # time from the start of the tick to the features of this board being out
+        self.latencies[pipeline.name].append(time.perf_counter() - submitted)
+        return result
+
+    def _collect(self, results):
+        # takes the finished boards out of pending
+        for name, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[name]
+                if future.exception() is not None:
+                    logging.warning(f"board {name} failed", exc_info=future.exception())
+                else:
+                    results[name] = future.result()
+
+    def tick(self):
+        # Boards get board_timeout to finish. A board that takes longer doesn't
+        # hold up the tick: it keeps running, is skipped by the following ticks
+        # until it is done, and its result goes out with the first tick after.
+        submitted = time.perf_counter()
+        results = {}
+        self._collect(results)
+        for pipeline in self.pipelines:
+            if pipeline.name in self.pending:
+                # this board is still busy with an earlier tick, don't pile up
+                self.skipped[pipeline.name] += 1
+                continue
+            self.pending[pipeline.name] = self.pool.submit(self._run_pipeline, pipeline, submitted)
+        concurrent.futures.wait(self.pending.values(), timeout=self.board_timeout)
+        self._collect(results)
+        return results
+
+    def release(self, results):
+        for name, result in results.items():
+            self.by_name[name].release(result)
+
+    def latency_stats(self):
+        stats = {}
+        for name, values in self.latencies.items():
+            if values:
+                values = np.array(values) * 1000
+                stats[name] = {'mean_ms': float(values.mean()), 'p95_ms': float(np.percentile(values, 95)),
+                               'max_ms': float(values.max()), 'skipped': self.skipped[name]}
+        return stats
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.worker.stop()
+        self.pool.shutdown(wait=True)
+        if self.dsp_pool is not None:
+            self.dsp_pool.stop()
+        self.inference.stop()
+        self.sinks.stop()
+
+
+def main():
+    BoardShim.enable_dev_board_logger()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, help='json file listing the boards')
+    parser.add_argument('--synthetic', type=int, default=0, help='run this many synthetic boards instead')
+    parser.add_argument('--stats-interval', type=float, default=5.0)
+    parser.add_argument('--inference-process', action='store_true', help='run the ML models in a separate process')
+    parser.add_argument('--sinks', type=str, default=None, help='json file with the output sinks')
+    parser.add_argument('--metrics-port', type=int, default=9101, help='local metrics endpoint, 0 to disable')
+    parser.add_argument('--quality-config', type=str, default=None, help='json file with the signal quality thresholds')
+    parser.add_argument('--dsp-workers', type=int, default=0, help='processes for filters and PSD, 0 to run them in the tick')
+    args = parser.parse_args()
+
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    else:
+        # BrainFlow needs a distinct config per session, other_info is unused by the synthetic board
+        config = {'boards': [{'name': f"synthetic{i}", 'board_id': -1, 'params': {'other_info': f"synthetic{i}"}}
+                             for i in range(args.synthetic or 1)]}
+
+    boards = []
+    runner = None
+    metrics_server = None
+    try:
+        filter_configs = {}
+        for board_config in config['boards']:
+            boards.append((board_config['name'], open_board(board_config)))
+            filter_configs[board_config['name']] = dict(FILTER_CONFIG, **config.get('filters', {}), **board_config.get('filters', {}))
+        runner = MultiBoardRunner(boards, config.get('processing_speed_ms', 100), config.get('workers'),
+                                  filter_configs=filter_configs, inference_process=args.inference_process,
+                                  sinks=SinkHub(load_sink_config(args.sinks)),
+                                  dsp_workers=config.get('dsp_workers', args.dsp_workers),
+                                  quality_config=load_quality_config(args.quality_config))
+        runner.start()
+        if args.metrics_port:
+            metrics_server = MetricsServer(lambda: [pipeline.metrics for pipeline in runner.pipelines] + runner.sinks.metrics(),
+                                           port=args.metrics_port).start()
+        while True:
+            time.sleep(args.stats_interval)
+            logging.info(f"feature rate {runner.worker.rate():.1f} Hz, load {runner.shedder.load:.0%}, {runner.shedder.state()}")
+            for name, stats in runner.latency_stats().items():
+                logging.info(f"{name}: mean {stats['mean_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, "
+                             f"max {stats['max_ms']:.1f} ms, {stats['skipped']} ticks skipped")
+    except BaseException as e:
+        logging.warning('Exception', exc_info=True)
+    finally:
+        logging.info('End')
+        if runner is not None:
+            runner.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        for name, board_shim in boards:
+            if board_shim.is_prepared():
+                logging.info(f"Releasing session {name}")
+                board_shim.release_session()
+
+
+if __name__ == '__main__':
+    main()
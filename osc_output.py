@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+import socket
+import struct
+import threading
+import time
+
+# seconds between the NTP epoch (1900) used by OSC time tags and the unix epoch
+NTP_DELTA = 2208988800
+
+
+def _osc_string(value):
+    data = value.encode() + b'\0'
+    return data + b'\0' * (-len(data) % 4)
+
+
+class OscControlOutput:
+    # Collects the control values of a tick (name, value pairs sent to one OSC
+    # address, like Tidal's /ctrl) and sends them as one timestamped bundle.
+    # The encoded message prefix per (name, type) is built once and reused,
+    # values that did not change since they were last sent are left out (but
+    # resent after max_interval seconds, 0 = never), and bundles go out at
+    # most every min_interval seconds, values set in between are coalesced.
+    # Values of a bundle that could not be sent go out with the next one.
+    def __init__(self, host, port, address="/ctrl", min_interval=0.0, suppress_unchanged=True, max_interval=0.0):
+        self.target = (host, port)
+        self.address = _osc_string(address)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.suppress_unchanged = suppress_unchanged
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.prefixes = {}
+        self.pending = {}
+        self.last_sent = {}
+        self.last_sent_time = {}
+        self.last_flush = 0.0
+        self.lock = threading.Lock()
+        self.bundles_sent = 0
+        self.send_errors = 0
+
+    def _prefix(self, name, tag):
+        key = (name, tag)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            prefix = self.address + _osc_string(',s' + tag) + _osc_string(name)
+            self.prefixes[key] = prefix
+        return prefix
+
+    def _encode(self, name, value):
+        if isinstance(value, (int, bool)) or (hasattr(value, 'dtype') and value.dtype.kind in 'iu'):
+            return self._prefix(name, 'i') + struct.pack('>i', int(value))
+        return self._prefix(name, 'f') + struct.pack('>f', float(value))
+
+    def set(self, name, value):
+        with self.lock:
+            self.pending[name] = value
+
+    def flush(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if not self.pending or now - self.last_flush < self.min_interval:
+                return False
+            pending = self.pending
+            self.pending = {}
+        elements = []
+        sent = []
+        for name, value in pending.items():
+            if (self.suppress_unchanged and self.last_sent.get(name) == value and
+                    not (self.max_interval and now - self.last_sent_time[name] >= self.max_interval)):
+                continue
+            message = self._encode(name, value)
+            elements.append(struct.pack('>i', len(message)))
+            elements.append(message)
+            sent.append((name, value))
+        if not elements:
+            return False
+        self.last_flush = now
+        ntp = now + NTP_DELTA
+        seconds = int(ntp)
+        timetag = struct.pack('>II', seconds, int((ntp - seconds) * 4294967296) & 0xffffffff)
+        try:
+            self.sock.sendto(b'#bundle\0' + timetag + b''.join(elements), self.target)
+            self.bundles_sent += 1
+        except OSError:
+            # a full socket buffer or unreachable host must not stall the tick,
+            # the values are retried with the next flush unless newer ones come
+            self.send_errors += 1
+            with self.lock:
+                for name, value in sent:
+                    self.pending.setdefault(name, value)
+            return True
+        for name, value in sent:
+            self.last_sent[name] = value
+            self.last_sent_time[name] = now
+        return True
+
+    def close(self):
+        self.sock.close()
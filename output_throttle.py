@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+import time
+
+from paho.mqtt.client import topic_matches_sub
+
+
+class TopicRule:
+    # deadband_abs / deadband_rel: a value has to move by more than both to
+    # count as changed. min_interval: never publish a topic faster than this.
+    # max_interval: republish an unchanged value after this long (0 = never).
+    def __init__(self, deadband_abs=0.0, deadband_rel=0.0, min_interval=0.0, max_interval=0.0, qos=0):
+        self.deadband_abs = deadband_abs
+        self.deadband_rel = deadband_rel
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.qos = qos
+
+
+class OutputThrottle:
+    # Decides per topic whether a new value is worth publishing, remembering
+    # what was last sent. Rules are matched with MQTT wildcards in the order
+    # given, topics without a matching rule use the default rule.
+    def __init__(self, rules=None, default_rule=None):
+        self.rules = list(rules or [])
+        self.default_rule = default_rule or TopicRule()
+        self.topic_rules = {}
+        self.last_sent = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    def add_rule(self, pattern, rule):
+        self.rules.append((pattern, rule))
+        self.topic_rules.clear()
+
+    def rule_for(self, topic):
+        rule = self.topic_rules.get(topic)
+        if rule is None:
+            rule = self.default_rule
+            for pattern, candidate in self.rules:
+                if topic_matches_sub(pattern, topic):
+                    rule = candidate
+                    break
+            self.topic_rules[topic] = rule
+        return rule
+
+    def _changed(self, rule, last_value, value):
+        if isinstance(value, str) or isinstance(last_value, str):
+            return value != last_value
+        delta = abs(value - last_value)
+        return delta > rule.deadband_abs and delta > rule.deadband_rel * abs(last_value)
+
+    def check(self, topic, value, now=None):
+        # returns the qos to publish with, or None if the value is suppressed
+        if now is None:
+            now = time.monotonic()
+        rule = self.rule_for(topic)
+        last = self.last_sent.get(topic)
+        if last is not None:
+            last_value, last_time = last
+            elapsed = now - last_time
+            if elapsed < rule.min_interval:
+                self.suppressed += 1
+                return None
+            heartbeat = rule.max_interval > 0 and elapsed >= rule.max_interval
+            if not heartbeat and not self._changed(rule, last_value, value):
+                self.suppressed += 1
+                return None
+        self.last_sent[topic] = (value, now)
+        self.sent += 1
+        return rule.qos
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+import collections
+import logging
+import threading
+import time
+
+
+class LatestValue:
+    # Single slot holding the most recent result. Readers never wait and
+    # simply skip if nothing new was published since their last look.
+    # Results may live in buffers the writer reuses (ScratchBuffers): a reader
+    # that works with a result hold()s it and release()s it when done, and a
+    # result that is replaced and not held, or released after it was
+    # replaced, is handed to release_fn to be reused.
+    def __init__(self, release_fn=None):
+        self._item = (0, None)
+        self._held = None
+        self._release_fn = release_fn
+        self._lock = threading.Lock()
+
+    def publish(self, value):
+        with self._lock:
+            seq, old = self._item
+            self._item = (seq + 1, value)
+            if self._held is not None and self._held[0] == seq:
+                old = None
+        if old is not None and self._release_fn is not None:
+            self._release_fn(old)
+
+    def get(self):
+        # a look without holding, the result may be reused any time
+        return self._item
+
+    def hold(self):
+        self.release()
+        with self._lock:
+            self._held = self._item
+            return self._held
+
+    def release(self):
+        with self._lock:
+            held, self._held = self._held, None
+            if held is None or held[0] == self._item[0]:
+                # still the latest, publish hands it back when it is replaced
+                return
+        if held[1] is not None and self._release_fn is not None:
+            self._release_fn(held[1])
+
+
+# What gets degraded when the ticks don't fit their interval any more, in
+# this order. Feature publication itself is never skipped.
+DEGRADATIONS = [
+    'skip_render',          # draw every other frame
+    'reduce_channels',      # update half of the plotted curves per frame, alternating
+    'low_psd_resolution',   # half the FFT length, no segment overlap
+    'coalesce_outputs',     # Tidal controls every other tick, mirrors every tick
+]
+
+
+class LoadShedder:
+    # Keeps a moving average of the cost of every stage competing for the CPU
+    # (processing ticks, rendering) and compares their sum to the tick
+    # interval. After shed_ticks ticks in a row above high of the budget (or
+    # overrunning) it goes one level further down the DEGRADATIONS, after
+    # recover_ticks ticks below low it comes back one level. Only the
+    # degradations that apply are used, e.g. no render ones without a GUI.
+    def __init__(self, interval_ms, degradations=DEGRADATIONS, high=0.8, low=0.5, shed_ticks=3, recover_ticks=50,
+                 smoothing=0.2):
+        self.budget = interval_ms / 1000.0
+        self.degradations = [name for name in DEGRADATIONS if name in degradations]
+        self.high = high
+        self.low = low
+        self.shed_ticks = shed_ticks
+        self.recover_ticks = recover_ticks
+        self.smoothing = smoothing
+        self.costs = {}
+        self.level = 0
+        self.load = 0.0
+        self.changes = 0
+        self.over = 0
+        self.under = 0
+
+    def observe(self, stage, seconds):
+        previous = self.costs.get(stage)
+        self.costs[stage] = seconds if previous is None else previous + self.smoothing * (seconds - previous)
+
+    def tick(self, overrun=False):
+        # once per processing tick, after its cost was observed
+        self.load = sum(list(self.costs.values())) / self.budget
+        if overrun or self.load > self.high:
+            self.over += 1
+            self.under = 0
+        elif self.load < self.low:
+            self.under += 1
+            self.over = 0
+        else:
+            self.over = self.under = 0
+        if self.over >= self.shed_ticks and self.level < len(self.degradations):
+            self._set_level(self.level + 1)
+        elif self.under >= self.recover_ticks and self.level > 0:
+            self._set_level(self.level - 1)
+        return self.level
+
+    def _set_level(self, level):
+        self.level = level
+        self.over = self.under = 0
+        self.changes += 1
+        logging.info(f"load {self.load:.0%} of the tick budget, degradation {self.state()}")
+
+    def active(self, name):
+        return name in self.degradations[:self.level]
+
+    def state(self):
+        return self.degradations[self.level - 1] if self.level else 'normal'
+
+
+class ProcessingThread(threading.Thread):
+    # Calls process_fn at a fixed rate on its own thread and publishes each
+    # result into a LatestValue slot. Ticks are scheduled against absolute
+    # deadlines, if a tick overruns the next one starts right away instead of
+    # queueing up behind it. A LoadShedder gets the cost and overruns of
+    # every tick. release_fn gets the results no reader holds any more.
+    def __init__(self, process_fn, interval_ms=100, name="processing", stats_interval=5.0, shedder=None,
+                 release_fn=None):
+        super().__init__(name=name, daemon=True)
+        self.process_fn = process_fn
+        self.interval = interval_ms / 1000.0
+        self.stats_interval = stats_interval
+        self.latest = LatestValue(release_fn)
+        self.tick_times = collections.deque(maxlen=256)
+        self.last_cost = 0.0
+        self.overruns = 0
+        self.shedder = shedder
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_tick = time.perf_counter()
+        last_stats = next_tick
+        while not self._stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                result = self.process_fn()
+            except Exception:
+                logging.warning('Processing tick failed', exc_info=True)
+                result = None
+            end = time.perf_counter()
+            self.last_cost = end - start
+            if result is not None:
+                self.latest.publish(result)
+                self.tick_times.append(end)
+
+            if end - last_stats >= self.stats_interval:
+                last_stats = end
+                logging.debug(f"{self.name}: {self.rate():.1f} Hz, last tick {self.last_cost * 1000:.1f} ms, {self.overruns} overruns")
+
+            next_tick += self.interval
+            delay = next_tick - time.perf_counter()
+            if self.shedder is not None:
+                self.shedder.observe('tick', self.last_cost)
+                self.shedder.tick(delay < 0)
+            if delay < 0:
+                self.overruns += 1
+                next_tick = time.perf_counter()
+            else:
+                self._stop_event.wait(delay)
+
+    def rate(self):
+        # effective output rate over the recent ticks
+        if len(self.tick_times) < 2:
+            return 0.0
+        span = self.tick_times[-1] - self.tick_times[0]
+        return (len(self.tick_times) - 1) / span if span > 0 else 0.0
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(1.0)
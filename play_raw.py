@@ -8,17 +8,26 @@ import brainflow
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, LogLevels, BoardIds
 from brainflow.data_filter import DataFilter, FilterTypes, AggOperations
 
+from shared_ring import SharedBoard
+
 
 def main():
     BoardShim.enable_dev_board_logger()
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shm', type=str, default=None, help='read from the shared ring of acquisition_daemon.py')
+    args = parser.parse_args()
+
     # use synthetic board for demo
     params = BrainFlowInputParams()
     params.other_info = '8'
     params.ip_address = '224.0.0.1'
     params.ip_port = 6666
     print(params)
-    board = BoardShim(-2, params)
+    if args.shm:
+        board = SharedBoard(args.shm)
+    else:
+        board = BoardShim(-2, params)
     board.prepare_session()
     board.start_stream(45000)
     BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'start sleeping in the main thread')
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import signal
+import socket
+import threading
+import time
+
+import numpy as np
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import ThreadingOSCUDPServer
+
+from brainflow.board_shim import BoardShim, BoardIds
+
+from recording import RecordingReader, read_brainflow_file
+
+# Replays a recording onto the streaming board multicast protocol, so that
+# viewers and consumers started with board id -2 (ip 224.0.0.1, port 6666,
+# other_info = original board id) see it like a live headset.
+#
+# The BrainFlow streaming board reads datagrams of PACKAGES_PER_DATAGRAM
+# samples, sample after sample, each sample all board rows as float64.
+#
+# control over OSC (default port 6020):
+#   /playback/pause, /playback/resume
+#   /playback/speed <factor>          0.5 .. 50
+#   /playback/seek <seconds>          from the start of the recording
+#   /playback/seek_time <timestamp>   unix timestamp of the recording
+#   /playback/loop <0|1>
+
+PACKAGES_PER_DATAGRAM = 3
+MIN_SPEED = 0.5
+MAX_SPEED = 50.0
+# below this the pacing loop spins instead of sleeping
+SPIN_SECONDS = 0.002
+
+
+class ArrayRecording:
+    # file streamer dumps loaded into memory, same interface as RecordingReader
+    def __init__(self, path, board_id):
+        self.data = np.concatenate(list(read_brainflow_file(path, board_id)), axis=1)
+        self.board_id = board_id
+        self.num_rows = self.data.shape[0]
+        self.num_samples = self.data.shape[1]
+        self.sampling_rate = BoardShim.get_sampling_rate(board_id)
+        self.timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+        self.package_num_channel = BoardShim.get_package_num_channel(board_id)
+
+    def seek(self, timestamp):
+        return int(np.searchsorted(self.data[self.timestamp_channel], timestamp, side='left'))
+
+    def read(self, start_sample, n):
+        block = self.data[:, start_sample:start_sample + n]
+        return block[self.timestamp_channel], block[self.package_num_channel], block
+
+    def close(self):
+        pass
+
+
+def open_recording(path, board_id):
+    if path.endswith('.bfrec'):
+        return RecordingReader(path)
+    return ArrayRecording(path, board_id)
+
+
+class PlaybackServer:
+    def __init__(self, recording, host='224.0.0.1', port=6666, speed=1.0, loop=False, restamp=True,
+                 block_seconds=0.1, ttl=1):
+        self.recording = recording
+        self.target = (host, port)
+        self.timestamp_channel = BoardShim.get_timestamp_channel(recording.board_id)
+        self.package_num_channel = BoardShim.get_package_num_channel(recording.board_id)
+        self.sampling_rate = recording.sampling_rate
+        self.loop = loop
+        self.restamp = restamp
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.paused = False
+        self.speed = 1.0
+        self.position = 0
+        self.anchor_time = time.perf_counter()
+        self.anchor_position = 0
+        # samples are converted to float64 datagram layout a block at a time
+        self.block_samples = max(PACKAGES_PER_DATAGRAM,
+                                 int(self.sampling_rate * block_seconds) // PACKAGES_PER_DATAGRAM * PACKAGES_PER_DATAGRAM)
+        self.block = np.zeros(shape=(self.block_samples, recording.num_rows), dtype=np.float64)
+        self.block_start = 0
+        self.block_count = 0
+        self.datagrams_sent = 0
+        self.send_errors = 0
+        self.lateness = 0.0
+        self.set_speed(speed)
+
+    def _reanchor(self):
+        self.anchor_time = time.perf_counter()
+        self.anchor_position = self.position
+
+    def set_speed(self, speed):
+        with self.lock:
+            self.speed = min(max(float(speed), MIN_SPEED), MAX_SPEED)
+            self._reanchor()
+        logging.info(f"playback speed {self.speed}x")
+
+    def seek(self, sample):
+        with self.lock:
+            self.position = min(max(int(sample), 0), self.recording.num_samples)
+            self.block_count = 0
+            self._reanchor()
+        logging.info(f"playback at {self.position / self.sampling_rate:.1f} s")
+
+    def seek_seconds(self, seconds):
+        self.seek(seconds * self.sampling_rate)
+
+    def seek_time(self, timestamp):
+        self.seek(self.recording.seek(timestamp))
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self._reanchor()
+
+    def set_loop(self, loop):
+        with self.lock:
+            self.loop = bool(loop)
+
+    def _fill_block(self):
+        timestamps, counters, rows = self.recording.read(self.position, self.block_samples)
+        n = rows.shape[1]
+        self.block[:n] = rows.T
+        # the float32 counter row of bfrec files is only exact up to 2^24
+        self.block[:n, self.package_num_channel] = counters
+        if not self.restamp:
+            # the float32 timestamp row of bfrec files is too coarse, use the float64 one
+            self.block[:n, self.timestamp_channel] = timestamps
+        self.block_start = self.position
+        self.block_count = n
+
+    def _send_datagram(self):
+        # called with the lock held, position is at a datagram boundary of the block
+        if self.block_count == 0 or not self.block_start <= self.position < self.block_start + self.block_count:
+            self._fill_block()
+        offset = self.position - self.block_start
+        end = min(offset + PACKAGES_PER_DATAGRAM, self.block_count)
+        packages = self.block[offset:end]
+        if end - offset < PACKAGES_PER_DATAGRAM:
+            # the streaming board drops short datagrams, repeat the last sample
+            packages = np.concatenate((packages, np.repeat(packages[-1:], PACKAGES_PER_DATAGRAM - (end - offset), axis=0)))
+        if self.restamp:
+            packages[:, self.timestamp_channel] = time.time()
+        try:
+            self.sock.sendto(packages.tobytes(), self.target)
+            self.datagrams_sent += 1
+        except OSError:
+            self.send_errors += 1
+        self.position += end - offset
+
+    def run(self):
+        logging.info(f"playing {self.recording.num_samples / self.sampling_rate:.0f} s to {self.target[0]}:{self.target[1]}")
+        while not self.stop_event.is_set():
+            with self.lock:
+                if self.position >= self.recording.num_samples:
+                    if not self.loop:
+                        logging.info('end of recording')
+                        return
+                    self.position = 0
+                    self.block_count = 0
+                    self._reanchor()
+                if self.paused:
+                    wait = 0.05
+                else:
+                    # where playback should be now, from a fixed anchor so errors don't accumulate
+                    due_time = self.anchor_time + (self.position - self.anchor_position) / (self.sampling_rate * self.speed)
+                    wait = due_time - time.perf_counter()
+                    if wait <= 0:
+                        self.lateness = -wait
+                        self._send_datagram()
+                        continue
+            if wait > SPIN_SECONDS:
+                self.stop_event.wait(min(wait - SPIN_SECONDS, 0.05))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def start_control_server(server, host='0.0.0.0', port=6020):
+    dispatcher = Dispatcher()
+    dispatcher.map('/playback/pause', lambda address, *args: server.pause())
+    dispatcher.map('/playback/resume', lambda address, *args: server.resume())
+    dispatcher.map('/playback/speed', lambda address, speed: server.set_speed(speed))
+    dispatcher.map('/playback/seek', lambda address, seconds: server.seek_seconds(seconds))
+    dispatcher.map('/playback/seek_time', lambda address, timestamp: server.seek_time(timestamp))
+    dispatcher.map('/playback/loop', lambda address, loop: server.set_loop(loop))
+    control = ThreadingOSCUDPServer((host, port), dispatcher)
+    threading.Thread(target=control.serve_forever, name='playback-control', daemon=True).start()
+    return control
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str, help='bfrec recording or BrainFlow file streamer dump')
+    parser.add_argument('--board-id', type=int, default=BoardIds.UNICORN_BOARD.value,
+                        help='board of a file streamer dump, bfrec files know their board')
+    parser.add_argument('--ip-address', type=str, default='224.0.0.1')
+    parser.add_argument('--ip-port', type=int, default=6666)
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--start', type=float, default=0.0, help='seconds into the recording')
+    parser.add_argument('--loop', action='store_true')
+    parser.add_argument('--keep-timestamps', action='store_true',
+                        help='send the recorded timestamps instead of the time of sending')
+    parser.add_argument('--control-port', type=int, default=6020, help='OSC control port, 0 to disable')
+    parser.add_argument('--stats-interval', type=float, default=10.0)
+    args = parser.parse_args()
+
+    recording = open_recording(args.file, args.board_id)
+    server = PlaybackServer(recording, args.ip_address, args.ip_port, args.speed, args.loop,
+                            restamp=not args.keep_timestamps)
+    server.seek_seconds(args.start)
+    signal.signal(signal.SIGTERM, lambda *args: server.stop())
+    signal.signal(signal.SIGINT, lambda *args: server.stop())
+
+    control = None
+    try:
+        if args.control_port:
+            control = start_control_server(server, port=args.control_port)
+        worker = threading.Thread(target=server.run, name='playback')
+        worker.start()
+        while worker.is_alive():
+            worker.join(args.stats_interval)
+            logging.info(f"at {server.position / server.sampling_rate:.1f} s, {server.speed}x, "
+                         f"{server.datagrams_sent} datagrams, {server.send_errors} send errors, "
+                         f"lateness {server.lateness * 1000:.2f} ms")
+    except BaseException as e:
+        logging.warning('Exception', exc_info=True)
+    finally:
+        logging.info('End')
+        server.stop()
+        if control is not None:
+            control.shutdown()
+        recording.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+import json
+
+import numpy as np
+
+# Signal quality of the last quality window (window_ticks processing ticks),
+# updated from the new samples of each tick only. Each tick adds one summary
+# per channel (count, sum, sum of squares, min, max, stuck samples) to a small
+# ring, and the window is the sum (min, max) over the ring, so a tick costs a
+# few vectorized reductions over its new samples whatever the window length.
+#
+# An EEG channel is bad when in the window
+#   amplitude  peak to peak of the filtered signal is above max_ptp (uV)
+#   variance   std of the filtered signal is above max_std (uV)
+#   flatline   std of the raw signal is below min_std (uV), electrode off
+#   railing    more than stuck_fraction of the raw samples repeat the previous
+#              value (ADC pinned), or |raw| reaches rail when one is given
+# Motion is the summed variance of the accel (g^2) and gyro ((deg/s)^2) axes
+# relative to max_accel_var / max_gyro_var, above 1 the head moved.
+#
+# score is the fraction of good EEG channels, 0 while the head moves. Windows
+# with a score below min_good are not usable: FeaturePipeline then skips the
+# band powers and the models and holds the last outputs. Usable windows use
+# the good channels only and move the feature vector by score towards the new
+# one, so half a cap of bad electrodes only nudges the mirrors.
+QUALITY_CONFIG = {
+    'window_ticks': 10,
+    'max_ptp': 800.0,
+    'max_std': 150.0,
+    'min_std': 0.1,
+    'stuck_fraction': 0.5,
+    'rail': None,
+    'max_accel_var': 0.01,
+    'max_gyro_var': 100.0,
+    'min_good': 0.5,
+}
+
+
+def load_quality_config(path=None):
+    # settings missing from the file keep the defaults
+    config = dict(QUALITY_CONFIG)
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+class TickStats:
+    # per tick sums of a (rows x samples) stream over the last num_ticks ticks
+    def __init__(self, num_rows, num_ticks):
+        self.counts = np.zeros(num_ticks, dtype=np.int64)
+        self.sums = np.zeros((num_ticks, num_rows))
+        self.squares = np.zeros((num_ticks, num_rows))
+        self.mins = np.full((num_ticks, num_rows), np.inf)
+        self.maxs = np.full((num_ticks, num_rows), -np.inf)
+        self.slot = 0
+
+    def add(self, block):
+        self.slot = (self.slot + 1) % len(self.counts)
+        self.counts[self.slot] = block.shape[1]
+        np.sum(block, axis=1, out=self.sums[self.slot])
+        np.einsum('ij,ij->i', block, block, out=self.squares[self.slot])
+        np.min(block, axis=1, out=self.mins[self.slot])
+        np.max(block, axis=1, out=self.maxs[self.slot])
+
+    def count(self):
+        return max(int(self.counts.sum()), 1)
+
+    def variance(self):
+        count = self.count()
+        mean = self.sums.sum(axis=0) / count
+        return np.maximum(self.squares.sum(axis=0) / count - mean ** 2, 0.0)
+
+    def ptp(self):
+        return self.maxs.max(axis=0) - self.mins.min(axis=0)
+
+
+class QualityMonitor:
+    def __init__(self, num_eeg, num_accel=0, num_gyro=0, window_ticks=10, max_ptp=800.0, max_std=150.0, min_std=0.1,
+                 stuck_fraction=0.5, rail=None, max_accel_var=0.01, max_gyro_var=100.0, min_good=0.5):
+        self.num_eeg = num_eeg
+        self.max_ptp = max_ptp
+        self.max_std = max_std
+        self.min_std = min_std
+        self.stuck_fraction = stuck_fraction
+        self.rail = rail
+        self.max_accel_var = max_accel_var
+        self.max_gyro_var = max_gyro_var
+        self.min_good = min_good
+        self.filtered = TickStats(num_eeg, window_ticks)
+        self.raw = TickStats(num_eeg, window_ticks)
+        self.stuck = np.zeros((window_ticks, num_eeg))
+        self.accel = TickStats(num_accel, window_ticks) if num_accel else None
+        self.gyro = TickStats(num_gyro, window_ticks) if num_gyro else None
+        self.last_raw = None
+
+        self.good = np.ones(num_eeg, dtype=bool)
+        self.score = 1.0
+        self.motion = 0.0
+        self.usable = True
+        # ticks whose window was not usable
+        self.bad_windows = 0
+
+    def update(self, raw_eeg, eeg, accel=None, gyro=None):
+        # raw and filtered EEG, filtered accel and gyro of the new samples only
+        if raw_eeg.shape[1] == 0:
+            return self
+        self.filtered.add(eeg)
+        self.raw.add(raw_eeg)
+        # repeats of the previous sample, across the tick boundary too
+        stuck = self.stuck[self.raw.slot]
+        np.sum(raw_eeg[:, 1:] == raw_eeg[:, :-1], axis=1, out=stuck)
+        if self.last_raw is not None:
+            stuck += raw_eeg[:, 0] == self.last_raw
+        self.last_raw = raw_eeg[:, -1].copy()
+        motion = 0.0
+        if self.accel is not None and accel is not None and accel.shape[1]:
+            self.accel.add(accel)
+            motion = max(motion, self.accel.variance().sum() / self.max_accel_var)
+        if self.gyro is not None and gyro is not None and gyro.shape[1]:
+            self.gyro.add(gyro)
+            motion = max(motion, self.gyro.variance().sum() / self.max_gyro_var)
+        self.motion = float(motion)
+
+        std = np.sqrt(self.filtered.variance())
+        good = (self.filtered.ptp() <= self.max_ptp) & (std <= self.max_std)
+        good &= np.sqrt(self.raw.variance()) >= self.min_std
+        good &= self.stuck.sum(axis=0) <= self.stuck_fraction * self.raw.count()
+        if self.rail is not None:
+            good &= np.maximum(np.abs(self.raw.maxs.max(axis=0)), np.abs(self.raw.mins.min(axis=0))) < self.rail
+        self.good = good
+        self.score = 0.0 if self.motion > 1.0 else float(good.sum()) / max(self.num_eeg, 1)
+        self.usable = self.score >= self.min_good and good.any()
+        if not self.usable:
+            self.bad_windows += 1
+        return self
+
+    def state(self):
+        return {
+            'score': round(self.score, 3),
+            'motion': round(self.motion, 3),
+            'bad_channels': [int(channel) for channel in np.flatnonzero(~self.good)],
+            'bad_windows': self.bad_windows,
+        }
@@ -1,5 +1,8 @@
 #!/usr/bin/python3
 import argparse
+import logging
+import signal
+import threading
 import time
 import numpy as np
 import pandas as pd
@@ -8,9 +11,34 @@ import brainflow
 from brainflow.board_shim import BoardShim, BrainFlowInputParams, LogLevels, BoardIds
 from brainflow.data_filter import DataFilter, FilterTypes, AggOperations
 
+from recorder import SegmentedRecorder, run_recorder
+from filters import load_filter_config
+from shared_ring import SharedBoard
+
+# Records the multicast stream (or the shared ring of acquisition_daemon.py)
+# into rotating bfrec segments <output>-<time>.bfrec, see recorder.py.
+# SIGTERM (systemd stop) and SIGINT write out the rest of the buffer first.
+
 
 def main():
     BoardShim.enable_dev_board_logger()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str, default='Testdump', help='segment prefix, may include a directory')
+    parser.add_argument('--compress', action='store_true', help='zlib compress the chunks')
+    parser.add_argument('--filter-config', type=str, default=None,
+                        help='filter config stored with the raw data, used by batch_features.py')
+    parser.add_argument('--chunk-size', type=int, default=2500, help='samples per chunk (seek granularity)')
+    parser.add_argument('--shm', type=str, default=None, help='read from the shared ring of acquisition_daemon.py')
+    parser.add_argument('--poll-ms', type=int, default=200, help='drain cadence of the board buffer')
+    parser.add_argument('--blocks', type=int, default=60, help='preallocated blocks between drain and writer')
+    parser.add_argument('--block-seconds', type=float, default=1.0)
+    parser.add_argument('--segment-mb', type=float, default=256.0, help='rotate after this many MB, 0 for no limit')
+    parser.add_argument('--segment-minutes', type=float, default=60.0, help='rotate after this much data, 0 for no limit')
+    parser.add_argument('--fsync-interval', type=float, default=10.0, help='seconds between fsyncs')
+    parser.add_argument('--stats-interval', type=float, default=60.0)
+    args = parser.parse_args()
 
     # use synthetic board for demo
     params = BrainFlowInputParams()
@@ -18,27 +46,39 @@ def main():
     params.ip_address = '224.0.0.1'
     params.ip_port = 6666
     print(params)
-    board = BoardShim(-2, params)
-    board.prepare_session()
-    board.start_stream(45000, 'file:///home/a0n/Unicorn-Suite-Hybrid-Black/brainflow_start/Testdump.gtec:w')
-    BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'start sleeping in the main thread')
-    # time.sleep(5)
-    # data = board.get_board_data()
-    # print(data)
-    # BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'dumping first 5 seconds of measurement')
-    while True:
-        time.sleep(5)
-        data = board.get_board_data()
-        print(data)
-    input("Press Enter to stop streaming...")
-
-    # # demo for data serialization using brainflow API, we recommend to use it instead pandas.to_csv()
-    # DataFilter.write_file(data, 'test.csv', 'w')  # use 'a' for append mode
-    # restored_data = DataFilter.read_file('test.csv')
-    # restored_df = pd.DataFrame(np.transpose(restored_data))
-    # print('Data From the File')
-    # print(restored_df.tail(30))
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    if args.shm:
+        board = SharedBoard(args.shm)
+    else:
+        board = BoardShim(-2, params)
+    recorder = None
+    try:
+        board.prepare_session()
+        # the streaming board replays the rows of the original board
+        recorder = SegmentedRecorder(args.output.removesuffix('.bfrec'), board.get_board_id(),
+                                     block_seconds=args.block_seconds, num_blocks=args.blocks,
+                                     segment_bytes=int(args.segment_mb * 1024 * 1024),
+                                     segment_seconds=args.segment_minutes * 60, fsync_interval=args.fsync_interval,
+                                     chunk_size=args.chunk_size, compress=args.compress,
+                                     metadata={'filters': load_filter_config(args.filter_config)})
+        board.start_stream(45000)
+        BoardShim.log_message(LogLevels.LEVEL_INFO.value, 'start recording in the main thread')
+        run_recorder(board, recorder, stop, args.poll_ms, args.stats_interval)
+    except BaseException as e:
+        logging.warning('Exception', exc_info=True)
+    finally:
+        logging.info('End')
+        if recorder is not None:
+            recorder.close()
+            logging.info(f"{recorder.stats()}")
+        if board.is_prepared():
+            logging.info('Releasing session')
+            board.release_session()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
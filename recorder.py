@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from brainflow.board_shim import BoardShim
+
+from recording import RecordingWriter
+from metrics import Metrics
+
+# Recording service for long running installations. The caller drains the
+# board on a fixed cadence into preallocated blocks, a writer thread turns
+# full blocks into bfrec segments (recording.py) and hands the blocks back.
+#
+#   board buffer -> drain() -> blocks -> writer thread -> <prefix>-<time>.bfrec
+#
+# Memory is bounded by the block pool: when the writer falls behind and no
+# block is free, the samples stay in the board's own buffer until one is.
+# Segments are rotated by size and by recorded duration, and fsynced in
+# batches (every fsync_interval seconds and on rotation) instead of per
+# write. stats() reports the backlog between drain and disk.
+
+_STOP = object()
+
+
+def segment_path(prefix, now=None):
+    # <prefix>-YYYYmmdd-HHMMSS.bfrec, with a counter when a segment of the same
+    # second exists already
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+    path = f"{prefix}-{stamp}.bfrec"
+    count = 1
+    while os.path.exists(path):
+        path = f"{prefix}-{stamp}-{count}.bfrec"
+        count += 1
+    return path
+
+
+class SegmentedRecorder:
+    def __init__(self, prefix, board_id, block_seconds=1.0, num_blocks=60, segment_bytes=256 * 1024 * 1024,
+                 segment_seconds=3600.0, fsync_interval=10.0, chunk_size=2500, compress=False, metadata=None):
+        self.prefix = prefix
+        self.board_id = board_id
+        self.num_rows = BoardShim.get_num_rows(board_id)
+        self.sampling_rate = BoardShim.get_sampling_rate(board_id)
+        self.block_size = max(int(block_seconds * self.sampling_rate), 1)
+        self.segment_bytes = segment_bytes
+        self.segment_samples = int(segment_seconds * self.sampling_rate) if segment_seconds else 0
+        self.fsync_interval = fsync_interval
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.metadata = metadata
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # all the memory the recorder ever holds on to
+        self.free = queue.Queue()
+        for count in range(max(num_blocks, 2)):
+            self.free.put(np.zeros(shape=(self.num_rows, self.block_size), dtype=np.float64))
+        self.num_blocks = self.free.qsize()
+        self.filled = queue.Queue()
+        self.block = None
+        self.block_count = 0
+
+        self.segment = None
+        self.segments = []
+        self.samples_drained = 0
+        self.samples_written = 0
+        self.samples_lost = 0
+        # samples the board lost before drain got to them (SharedBoard.samples_lost)
+        self.board_samples_lost = 0
+        self.bytes_closed = 0
+        self.stalls = 0
+        self.write_errors = 0
+        self.last_sync = time.monotonic()
+        self.metrics = Metrics({'recorder': os.path.basename(prefix)})
+
+        self.thread = threading.Thread(target=self._run, name='recorder', daemon=True)
+        self.thread.start()
+
+    def drain(self, board, wait=False):
+        # moves the samples the board has buffered so far into blocks, returns
+        # how many. Without a free block it stops and leaves the rest in the
+        # board buffer, with wait it waits for the writer instead.
+        moved = 0
+        count = board.get_board_data_count()
+        while count > 0:
+            if self.block is None:
+                try:
+                    self.block = self.free.get() if wait else self.free.get_nowait()
+                except queue.Empty:
+                    self.stalls += 1
+                    break
+            take = min(count, self.block_size - self.block_count)
+            data = board.get_board_data(take)
+            n = data.shape[1]
+            if n == 0:
+                break
+            self.block[:, self.block_count:self.block_count + n] = data
+            self.block_count += n
+            if self.block_count == self.block_size:
+                self._hand_over()
+            count -= n
+            moved += n
+        self.samples_drained += moved
+        self.board_samples_lost = getattr(board, 'samples_lost', 0)
+        return moved
+
+    def _hand_over(self):
+        if self.block is not None and self.block_count:
+            self.filled.put((self.block, self.block_count))
+            self.block = None
+            self.block_count = 0
+
+    def _run(self):
+        while True:
+            try:
+                item = self.filled.get(timeout=0.5)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                block, n = item
+                start = time.perf_counter()
+                try:
+                    self._write(block[:, :n])
+                except Exception:
+                    # e.g. disk full: the block is lost, the next one goes to a new segment
+                    logging.warning('Recorder write failed', exc_info=True)
+                    self.write_errors += 1
+                    self.samples_lost += n
+                    self._close_segment()
+                self.free.put(block)
+                self.metrics.observe('write', time.perf_counter() - start)
+            if self.segment is not None and time.monotonic() - self.last_sync >= self.fsync_interval:
+                start = time.perf_counter()
+                try:
+                    self.segment.flush(fsync=True)
+                except Exception:
+                    logging.warning('Recorder fsync failed', exc_info=True)
+                    self.write_errors += 1
+                self.last_sync = time.monotonic()
+                self.metrics.observe('fsync', time.perf_counter() - start)
+        self._close_segment()
+
+    def _write(self, data):
+        segment = self.segment
+        if segment is not None and ((self.segment_bytes and segment.bytes_written >= self.segment_bytes) or
+                                    (self.segment_samples and segment.samples_written + segment.pending_count
+                                     >= self.segment_samples)):
+            self._close_segment()
+        if self.segment is None:
+            path = segment_path(self.prefix)
+            self.segment = RecordingWriter(path, self.board_id, chunk_size=self.chunk_size, compress=self.compress,
+                                           metadata=self.metadata)
+            self.segments.append(path)
+            self.last_sync = time.monotonic()
+            logging.info(f"Recording to {path}")
+        self.segment.write(data)
+        self.samples_written += data.shape[1]
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+        segment = self.segment
+        self.segment = None
+        try:
+            segment.close()
+        except Exception:
+            logging.warning('Recorder close failed', exc_info=True)
+            self.write_errors += 1
+        self.bytes_closed += segment.bytes_written
+
+    def backlog(self):
+        # samples drained from the board but not yet handed to a segment
+        return self.samples_drained - self.samples_written - self.samples_lost
+
+    def stats(self):
+        backlog = self.backlog()
+        segment = self.segment
+        stats = {
+            'samples_drained': self.samples_drained,
+            'samples_written': self.samples_written,
+            'samples_lost': self.samples_lost,
+            'board_samples_lost': self.board_samples_lost,
+            'bytes_written': self.bytes_closed + (segment.bytes_written if segment is not None else 0),
+            'backlog_samples': backlog,
+            'backlog_seconds': backlog / self.sampling_rate,
+            'free_blocks': self.free.qsize(),
+            'segments': len(self.segments),
+            'stalls': self.stalls,
+            'write_errors': self.write_errors,
+        }
+        for name in ('backlog_samples', 'free_blocks', 'segments', 'stalls', 'write_errors', 'board_samples_lost'):
+            self.metrics.set(name, stats[name])
+        return stats
+
+    def close(self):
+        # hands over the partly filled block and waits until all of it is on disk
+        self._hand_over()
+        self.filled.put(_STOP)
+        self.thread.join()
+
+
+def run_recorder(board, recorder, stop, poll_ms=200, stats_interval=60.0):
+    # the drain loop of record.py and ingest_from_device.py, until stop is set.
+    # Then everything still in the board buffer is drained as well, waiting
+    # for free blocks if needed, so the tail of the session ends up on disk.
+    last_stats = time.monotonic()
+    while not stop.wait(poll_ms / 1000.0):
+        recorder.drain(board)
+        now = time.monotonic()
+        if stats_interval and now - last_stats >= stats_interval:
+            last_stats = now
+            stats = recorder.stats()
+            logging.info(f"{stats['samples_written']} samples, {stats['bytes_written']} bytes in {stats['segments']} segments, "
+                         f"backlog {stats['backlog_seconds']:.1f} s, {stats['free_blocks']} free blocks, "
+                         f"{stats['stalls']} stalls, {stats['board_samples_lost']} samples lost by the board")
+    recorder.drain(board, wait=True)
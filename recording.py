@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+from brainflow.board_shim import BoardShim, BoardIds
+
+# Compact binary recordings (.bfrec).
+#
+# file:   MAGIC, uint32 header length, JSON header, then chunks
+# chunk:  CHUNK_MAGIC, uint32 samples, uint64 payload bytes, uint8 compressed,
+#         payload = float64 timestamps (samples) + float64 package counters
+#         (samples) + float32 rows (num_rows x samples)
+# index:  <file>.idx, one INDEX_DTYPE record per chunk, appended as chunks are
+#         written. It can be rebuilt by scanning the chunk headers if missing.
+#
+# All board rows are stored as float32, channel by channel, so an uncompressed
+# chunk can be handed out as a (num_rows x samples) view straight from the
+# mmap. Timestamps need more precision than float32 and are kept separately as
+# float64, and so is the package counter: float32 only counts exactly up to
+# 2^24, which a 250 Hz board passes after 18.6 hours. In the rows both are
+# float32 copies, read() hands out the float64 ones next to them. Version 1
+# files have no counter block, their counters come from the float32 row.
+# Compressed chunks are byte shuffled before zlib, which packs EEG
+# float32 data much better than compressing the raw bytes.
+
+MAGIC = b'BFREC\x00\x02\x00'
+MAGIC_V1 = b'BFREC\x00\x01\x00'
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIQB')
+INDEX_DTYPE = np.dtype([
+    ('first_sample', '<u8'),
+    ('samples', '<u4'),
+    ('first_counter', '<f8'),
+    ('first_timestamp', '<f8'),
+    ('last_timestamp', '<f8'),
+    ('offset', '<u8'),
+    ('payload_bytes', '<u8'),
+    ('compressed', 'u1'),
+])
+
+
+def _shuffle(data):
+    return np.ascontiguousarray(data.view(np.uint8).reshape(-1, data.itemsize).T).tobytes()
+
+
+def _unshuffle(raw, dtype, count):
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, count).T.copy().view(dtype).ravel()
+
+
+class RecordingWriter:
+    def __init__(self, path, board_id, chunk_size=2500, compress=False, compress_level=3, metadata=None):
+        self.path = path
+        self.board_id = board_id
+        self.num_rows = BoardShim.get_num_rows(board_id)
+        self.timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+        self.package_num_channel = BoardShim.get_package_num_channel(board_id)
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.compress_level = compress_level
+        self.pending = np.zeros(shape=(self.num_rows, chunk_size), dtype=np.float32)
+        self.pending_timestamps = np.zeros(chunk_size, dtype=np.float64)
+        self.pending_counters = np.zeros(chunk_size, dtype=np.float64)
+        self.pending_count = 0
+        self.samples_written = 0
+        self.bytes_written = 0
+
+        header = json.dumps({
+            'board_id': board_id,
+            'num_rows': self.num_rows,
+            'sampling_rate': BoardShim.get_sampling_rate(board_id),
+            'timestamp_channel': self.timestamp_channel,
+            'package_num_channel': self.package_num_channel,
+            # free form, e.g. the filter config the session was viewed with
+            'metadata': metadata or {},
+        }).encode()
+        self.file = open(path, 'wb')
+        self.index_file = open(path + '.idx', 'wb')
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.offset = self.file.tell()
+
+    def write(self, block):
+        # block: all board rows (num_rows x n) as returned by get_board_data
+        pos = 0
+        n = block.shape[1]
+        while pos < n:
+            take = min(n - pos, self.chunk_size - self.pending_count)
+            self.pending[:, self.pending_count:self.pending_count + take] = block[:, pos:pos + take]
+            self.pending_timestamps[self.pending_count:self.pending_count + take] = block[self.timestamp_channel, pos:pos + take]
+            self.pending_counters[self.pending_count:self.pending_count + take] = block[self.package_num_channel, pos:pos + take]
+            self.pending_count += take
+            pos += take
+            if self.pending_count == self.chunk_size:
+                self._write_chunk()
+
+    def _write_chunk(self):
+        n = self.pending_count
+        if n == 0:
+            return
+        timestamps = self.pending_timestamps[:n]
+        counters = self.pending_counters[:n]
+        rows = np.ascontiguousarray(self.pending[:, :n])
+        if self.compress:
+            payload = zlib.compress(_shuffle(timestamps) + _shuffle(counters) + _shuffle(rows), self.compress_level)
+        else:
+            payload = timestamps.tobytes() + counters.tobytes() + rows.tobytes()
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, n, len(payload), int(self.compress)))
+        self.file.write(payload)
+
+        record = np.zeros(1, dtype=INDEX_DTYPE)
+        record['first_sample'] = self.samples_written
+        record['samples'] = n
+        record['first_counter'] = counters[0]
+        record['first_timestamp'] = timestamps[0]
+        record['last_timestamp'] = timestamps[-1]
+        record['offset'] = self.offset
+        record['payload_bytes'] = len(payload)
+        record['compressed'] = int(self.compress)
+        self.index_file.write(record.tobytes())
+
+        self.offset += CHUNK_HEADER.size + len(payload)
+        self.samples_written += n
+        self.bytes_written += CHUNK_HEADER.size + len(payload)
+        self.pending_count = 0
+
+    def flush(self, fsync=False):
+        self._write_chunk()
+        self.file.flush()
+        self.index_file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def close(self):
+        self.flush(fsync=True)
+        self.file.close()
+        self.index_file.close()
+
+
+class RecordingReader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] not in (MAGIC, MAGIC_V1):
+            raise ValueError(f"{path} is not a bfrec recording")
+        self.has_counters = self.map[:len(MAGIC)] == MAGIC
+        header_length = struct.unpack_from('<I', self.map, len(MAGIC))[0]
+        start = len(MAGIC) + 4
+        self.header = json.loads(self.map[start:start + header_length].decode())
+        self.board_id = self.header['board_id']
+        self.num_rows = self.header['num_rows']
+        self.package_num_channel = self.header['package_num_channel']
+        self.sampling_rate = self.header['sampling_rate']
+        self.data_start = start + header_length
+        self.index = self._load_index()
+        self.chunk_starts = self.index['first_sample'].astype(np.int64)
+        self.num_samples = int(self.index['first_sample'][-1] + self.index['samples'][-1]) if len(self.index) else 0
+
+    def _load_index(self):
+        index_path = self.path + '.idx'
+        if os.path.exists(index_path):
+            index = np.fromfile(index_path, dtype=INDEX_DTYPE)
+            # drop index records whose chunk did not make it to disk
+            valid = index['offset'] + CHUNK_HEADER.size + index['payload_bytes'] <= len(self.map)
+            return index[valid]
+        return self._scan_index()
+
+    def _scan_index(self):
+        records = []
+        offset = self.data_start
+        first_sample = 0
+        while offset + CHUNK_HEADER.size <= len(self.map):
+            magic, samples, payload_bytes, compressed = CHUNK_HEADER.unpack_from(self.map, offset)
+            if magic != CHUNK_MAGIC or offset + CHUNK_HEADER.size + payload_bytes > len(self.map):
+                break
+            record = np.zeros(1, dtype=INDEX_DTYPE)
+            record['first_sample'] = first_sample
+            record['samples'] = samples
+            record['offset'] = offset
+            record['payload_bytes'] = payload_bytes
+            record['compressed'] = compressed
+            records.append(record)
+            offset += CHUNK_HEADER.size + payload_bytes
+            first_sample += samples
+        index = np.concatenate(records) if records else np.zeros(0, dtype=INDEX_DTYPE)
+        for record in index:
+            timestamps, counters, _ = self._decode(record)
+            record['first_timestamp'] = timestamps[0]
+            record['last_timestamp'] = timestamps[-1]
+            record['first_counter'] = counters[0]
+        return index
+
+    def _decode(self, record):
+        # (timestamps, counters, rows)
+        n = int(record['samples'])
+        start = int(record['offset']) + CHUNK_HEADER.size
+        rows_start = 16 * n if self.has_counters else 8 * n
+        if record['compressed']:
+            raw = zlib.decompress(self.map[start:start + int(record['payload_bytes'])])
+            timestamps = _unshuffle(raw[:8 * n], np.float64, n)
+            rows = _unshuffle(raw[rows_start:], np.float32, self.num_rows * n).reshape(self.num_rows, n)
+            if self.has_counters:
+                counters = _unshuffle(raw[8 * n:16 * n], np.float64, n)
+            else:
+                counters = rows[self.package_num_channel].astype(np.float64)
+            return timestamps, counters, rows
+        # zero copy views into the mmap
+        timestamps = np.frombuffer(self.map, dtype=np.float64, count=n, offset=start)
+        rows = np.frombuffer(self.map, dtype=np.float32, count=self.num_rows * n, offset=start + rows_start)
+        rows = rows.reshape(self.num_rows, n)
+        if self.has_counters:
+            counters = np.frombuffer(self.map, dtype=np.float64, count=n, offset=start + 8 * n)
+        else:
+            counters = rows[self.package_num_channel].astype(np.float64)
+        return timestamps, counters, rows
+
+    def chunk(self, number):
+        # (timestamps, counters, rows) of one chunk
+        return self._decode(self.index[number])
+
+    def chunks(self, start_sample=0):
+        number = self.chunk_of(start_sample)
+        for number in range(number, len(self.index)):
+            timestamps, counters, rows = self._decode(self.index[number])
+            skip = max(start_sample - int(self.chunk_starts[number]), 0)
+            yield timestamps[skip:], counters[skip:], rows[:, skip:]
+
+    def chunk_of(self, sample):
+        return max(int(np.searchsorted(self.chunk_starts, sample, side='right')) - 1, 0)
+
+    def seek(self, timestamp):
+        # index of the first sample at or after timestamp
+        number = int(np.searchsorted(self.index['last_timestamp'], timestamp, side='left'))
+        if number >= len(self.index):
+            return self.num_samples
+        timestamps, _, _ = self._decode(self.index[number])
+        return int(self.chunk_starts[number]) + int(np.searchsorted(timestamps, timestamp, side='left'))
+
+    def read(self, start_sample, n):
+        # (timestamps, counters, rows) for n samples from start_sample. Inside
+        # a single uncompressed chunk these are views into the file, otherwise
+        # copies.
+        n = max(min(n, self.num_samples - start_sample), 0)
+        number = self.chunk_of(start_sample)
+        offset = start_sample - int(self.chunk_starts[number]) if len(self.index) else 0
+        if len(self.index) and offset + n <= int(self.index['samples'][number]):
+            timestamps, counters, rows = self._decode(self.index[number])
+            return timestamps[offset:offset + n], counters[offset:offset + n], rows[:, offset:offset + n]
+        timestamps = np.zeros(n, dtype=np.float64)
+        counters = np.zeros(n, dtype=np.float64)
+        rows = np.zeros(shape=(self.num_rows, n), dtype=np.float32)
+        filled = 0
+        for chunk_timestamps, chunk_counters, chunk_rows in self.chunks(start_sample):
+            take = min(n - filled, chunk_rows.shape[1])
+            timestamps[filled:filled + take] = chunk_timestamps[:take]
+            counters[filled:filled + take] = chunk_counters[:take]
+            rows[:, filled:filled + take] = chunk_rows[:, :take]
+            filled += take
+            if filled == n:
+                break
+        return timestamps, counters, rows
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # views handed out by read are still alive, the mapping goes away with them
+            pass
+        self.file.close()
+
+
+def read_brainflow_file(path, board_id, rows=None, chunk_size=250000):
+    # the file streamer writes one sample per line, all board rows tab separated
+    num_rows = BoardShim.get_num_rows(board_id)
+    for chunk in pd.read_csv(path, sep='\t', header=None, usecols=range(num_rows),
+                             dtype=np.float64, chunksize=chunk_size):
+        data = chunk.to_numpy().T
+        yield data if rows is None else data[rows]
+
+
+def read_recording(path, board_id, rows=None, chunk_size=250000):
+    # board rows in blocks from either a bfrec recording or a file streamer dump
+    if not path.endswith('.bfrec'):
+        yield from read_brainflow_file(path, board_id, rows, chunk_size)
+        return
+    reader = RecordingReader(path)
+    try:
+        for start in range(0, reader.num_samples, chunk_size):
+            timestamps, counters, data = reader.read(start, chunk_size)
+            data = data.astype(np.float64)
+            data[reader.header['timestamp_channel']] = timestamps
+            data[reader.package_num_channel] = counters
+            yield data if rows is None else data[rows]
+    finally:
+        reader.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='convert a BrainFlow file streamer dump to a bfrec recording')
+    parser.add_argument('file', type=str)
+    parser.add_argument('--output', type=str, default=None, help='default <file>.bfrec')
+    parser.add_argument('--board-id', type=int, default=BoardIds.UNICORN_BOARD.value)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    output = args.output or args.file + '.bfrec'
+    writer = RecordingWriter(output, args.board_id, compress=args.compress)
+    for data in read_brainflow_file(args.file, args.board_id):
+        writer.write(data)
+    writer.close()
+    logging.info(f"{writer.samples_written} samples, {os.path.getsize(args.file)} -> {writer.bytes_written} bytes")
+
+
+if __name__ == '__main__':
+    main()
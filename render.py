@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+import numpy as np
+
+# Time series plots never need more than two points per horizontal pixel: the
+# min and the max of the samples falling on a pixel column draw the same
+# picture as all of them. The viewers hand their windows to a PlotRenderer,
+# which decimates every curve to a min/max envelope at the width the plot
+# currently has on screen and leaves curves alone whose plot is hidden or
+# whose data did not change since the last frame.
+#
+# Qt is only touched through the plot and curve objects handed in, the
+# decimation itself is plain NumPy.
+
+
+def bucket_size(num_points, width):
+    # samples per bucket so that num_points fit in width buckets, 1 (no
+    # decimation) while the envelope would not have fewer points than the data
+    width = max(int(width), 1)
+    if num_points <= 2 * width:
+        return 1
+    return -(-num_points // width)
+
+
+def _interleave(lows, highs, rising):
+    # min then max in buckets where the signal comes from below, max then min
+    # otherwise, so the line follows the signal instead of zigzagging across
+    # every bucket (twice the pixels to paint)
+    out = np.empty((lows.shape[0], 2 * lows.shape[1]), dtype=lows.dtype)
+    out[:, 0::2] = np.where(rising, lows, highs)
+    out[:, 1::2] = np.where(rising, highs, lows)
+    return out
+
+
+class EnvelopeDecimator:
+    # Min/max envelope of a (rows x num_points) window. Buckets are aligned to
+    # the absolute sample index (total), so when the window only ever grows at
+    # the end (the streaming filter buffers of FeaturePipeline) a frame only
+    # computes the buckets touched by the samples appended since the last one,
+    # plus the bucket the window start cuts through. Everything else is shifted
+    # over from the previous frame.
+    def __init__(self, num_rows, num_points, width):
+        self.num_points = num_points
+        self.bucket = bucket_size(num_points, width)
+        self.num_buckets = num_points // self.bucket + 2
+        self.lows = np.zeros((num_rows, self.num_buckets))
+        self.highs = np.zeros((num_rows, self.num_buckets))
+        self.rising = np.ones((num_rows, self.num_buckets), dtype=bool)
+        self.total = None
+        self.last_bucket = None
+
+    def _fill(self, data, start, total, first, last):
+        # buckets first..last from the window data[:, 0] = sample start
+        low = max(first * self.bucket, start)
+        high = min((last + 1) * self.bucket, total)
+        if high <= low:
+            return
+        bounds = np.arange(first + 1, last + 1) * self.bucket - low
+        indices = np.concatenate(([0], bounds[bounds < high - low]))
+        segment = data[:, low - start:high - start]
+        slot = first - (self.last_bucket - self.num_buckets + 1)
+        count = len(indices)
+        self.lows[:, slot:slot + count] = np.minimum.reduceat(segment, indices, axis=1)
+        self.highs[:, slot:slot + count] = np.maximum.reduceat(segment, indices, axis=1)
+        entry = segment[:, indices]
+        self.rising[:, slot:slot + count] = (entry - self.lows[:, slot:slot + count]) <= (self.highs[:, slot:slot + count] - entry)
+
+    def update(self, data, total=None):
+        # data holds samples total - num_points .. total - 1. Returns (x, y)
+        # with x in samples from the window start, or None when nothing was
+        # appended since the last call. Without total every bucket is redone.
+        if self.bucket == 1:
+            if total is not None and total == self.total:
+                return None
+            self.total = total
+            return np.arange(data.shape[1], dtype=float), data.copy()
+        if total is None:
+            incremental = False
+            total = self.num_points
+        else:
+            if total == self.total:
+                return None
+            incremental = (self.total is not None and 0 < total - self.total <= self.num_points - self.bucket)
+        start = total - self.num_points
+        first = start // self.bucket
+        last = (total - 1) // self.bucket
+        if incremental:
+            shift = last - self.last_bucket
+            if shift:
+                self.lows[:, :-shift] = self.lows[:, shift:]
+                self.highs[:, :-shift] = self.highs[:, shift:]
+                self.rising[:, :-shift] = self.rising[:, shift:]
+            previous = self.last_bucket
+            self.last_bucket = last
+            # the formerly last bucket was still filling up
+            self._fill(data, start, total, previous, last)
+            self._fill(data, start, total, first, first)
+        else:
+            self.last_bucket = last
+            self._fill(data, start, total, first, last)
+        self.total = total
+
+        used = last - first + 1
+        positions = np.maximum(np.arange(first, last + 1) * self.bucket, start) - start
+        return (np.repeat(positions.astype(float), 2),
+                _interleave(self.lows[:, -used:], self.highs[:, -used:], self.rising[:, -used:]))
+
+
+class CurveGroup:
+    def __init__(self, plots, curves, append_only):
+        self.plots = plots
+        self.curves = curves
+        self.append_only = append_only
+        self.phase = 0
+        self.decimator = None
+        self.width = None
+        self.last = None
+
+
+class PlotRenderer:
+    # Curves are registered in groups whose rows come from one window array
+    # (eeg, accel, ...). append_only groups pass the absolute sample count
+    # with their window and get the incremental envelope, the others are
+    # decimated in full and skipped when their data did not change. With a
+    # LoadShedder (pipeline.py) frames are skipped and curves updated in turns
+    # when it says so, and the cost of each frame goes into its load.
+    def __init__(self, window=None, shedder=None):
+        self.window = window
+        self.shedder = shedder
+        self.groups = {}
+        self.frames = 0
+        self.curves_drawn = 0
+        self.curves_skipped = 0
+
+    def add_group(self, name, plots, curves, append_only=False):
+        self.groups[name] = CurveGroup(plots, curves, append_only)
+
+    def skip_frame(self):
+        # call at the start of every frame, True when this one isn't drawn
+        self.frames += 1
+        if self.shedder is not None and self.shedder.active('skip_render') and self.frames % 2:
+            self.shedder.observe('render', 0.0)
+            return True
+        return False
+
+    def frame_done(self, seconds):
+        if self.shedder is not None:
+            self.shedder.observe('render', seconds)
+
+    def _visible(self):
+        return self.window is None or (self.window.isVisible() and not self.window.isMinimized())
+
+    def _width(self, group):
+        for plot in group.plots:
+            if plot.isVisible():
+                return max(int(plot.getViewBox().width()), 1)
+        return None
+
+    def render(self, name, data, total=None, offset=None):
+        # offset (rows x 1) is subtracted from the envelope, so windows that
+        # are only shifted per row (mean removal) keep their cached buckets
+        group = self.groups[name]
+        width = self._width(group) if self._visible() else None
+        if width is None:
+            self.curves_skipped += len(group.curves)
+            return 0
+        if width != group.width or group.decimator.num_points != data.shape[1]:
+            group.width = width
+            group.decimator = EnvelopeDecimator(data.shape[0], data.shape[1], width)
+            group.last = None
+            # the first and last bucket positions move with the window, a
+            # fixed x range saves the auto range relayout on every frame
+            for plot in group.plots:
+                plot.setXRange(0, data.shape[1] - 1)
+        if group.append_only and total is not None:
+            envelope = group.decimator.update(data, total)
+        else:
+            if group.last is not None and np.array_equal(group.last, data):
+                envelope = None
+            else:
+                group.last = data.copy()
+                envelope = group.decimator.update(data)
+        if envelope is None:
+            self.curves_skipped += len(group.curves)
+            return 0
+        x, y = envelope
+        if offset is not None:
+            y -= offset
+        drawn = 0
+        stride = 2 if self.shedder is not None and self.shedder.active('reduce_channels') else 1
+        group.phase = (group.phase + 1) % stride
+        for count, curve in enumerate(group.curves):
+            if count % stride == group.phase and group.plots[count].isVisible():
+                curve.setData(x, y[count])
+                drawn += 1
+        self.curves_drawn += drawn
+        self.curves_skipped += len(group.curves) - drawn
+        return drawn
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+import collections
+
+import numpy as np
+
+
+class RingBuffer:
+    # Fixed capacity (channels x samples) ring buffer. Every sample is written
+    # twice, at pos and pos + capacity, so the latest n samples are always one
+    # contiguous slice and latest() can hand out a view instead of a copy.
+    def __init__(self, num_channels, capacity, dtype=float):
+        self.num_channels = num_channels
+        self.capacity = capacity
+        self.data = np.zeros(shape=(num_channels, 2 * capacity), dtype=dtype)
+        self.pos = 0
+        self.count = 0
+
+    def append(self, block):
+        n = block.shape[1]
+        if n == 0:
+            return
+        if n > self.capacity:
+            block = block[:, -self.capacity:]
+            n = self.capacity
+        first = min(n, self.capacity - self.pos)
+        self.data[:, self.pos:self.pos + first] = block[:, :first]
+        self.data[:, self.pos + self.capacity:self.pos + self.capacity + first] = block[:, :first]
+        if first < n:
+            rest = n - first
+            self.data[:, :rest] = block[:, first:]
+            self.data[:, self.capacity:self.capacity + rest] = block[:, first:]
+        self.pos = (self.pos + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    def latest(self, n):
+        # contiguous view of the last n samples, zero padded at the front until filled
+        end = self.pos + self.capacity
+        return self.data[:, end - n:end]
+
+    def append_column(self, values):
+        # one sample for every channel, without building a (channels x 1) block
+        self.data[:, self.pos] = values
+        self.data[:, self.pos + self.capacity] = values
+        self.pos = (self.pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def copy_latest(self, n, out):
+        np.copyto(out, self.latest(n))
+        return out
+
+
+class ScratchBuffers:
+    # A few preallocated arrays, so nothing is reallocated per tick. A tick
+    # fills one and passes it to another thread (e.g. the renderer), which
+    # hands it back with release() once nobody reads it any more (see
+    # LatestValue in pipeline.py). An array that is out is never handed out
+    # again; if all of them are out, another one is allocated.
+    def __init__(self, shape, count=3, dtype=float):
+        self.shape = shape
+        self.dtype = dtype
+        self.free = collections.deque(np.zeros(shape=shape, dtype=dtype) for _ in range(count))
+        self.allocated = count
+
+    def next(self):
+        try:
+            return self.free.popleft()
+        except IndexError:
+            self.allocated += 1
+            return np.zeros(shape=self.shape, dtype=self.dtype)
+
+    def release(self, buffer):
+        self.free.append(buffer)
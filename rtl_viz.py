@@ -13,6 +13,23 @@ from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds, Brai
 from brainflow.data_filter import DataFilter, FilterTypes, NoiseTypes, AggOperations, WindowFunctions, DetrendOperations
 from brainflow.ml_model import MLModel, BrainFlowMetrics, BrainFlowClassifiers, BrainFlowModelParams
 
+from pipeline import ProcessingThread, LoadShedder
+from ring_buffer import ScratchBuffers
+from acquisition import BoardReader
+from shared_ring import SharedBoard
+from render import PlotRenderer
+from filters import compile_chain, detrend_linear
+
+# 50 Hz noise removal and 1 Hz high pass over the whole window, then a 60 Hz
+# low pass over the displayed half
+EEG_VIEW_FILTERS = [
+    ('noise', NoiseTypes.FIFTY.value),
+    ('highpass', 1.0, 1),
+]
+EEG_LOWPASS = [
+    ('lowpass', 60.0, 1),
+]
+
 class Graph:
     def __init__(self, board_shim):
         self.board_id = board_shim.get_board_id()
@@ -20,21 +37,35 @@ class Graph:
         self.eeg_channels = BoardShim.get_eeg_channels(self.board_id)
         self.sampling_rate = BoardShim.get_sampling_rate(self.board_id)
         self.update_speed_ms = 100
+        self.processing_speed_ms = 100
         self.window_size = 4
         self.num_points = self.window_size * self.sampling_rate
         self.num_points_big = self.window_size * self.sampling_rate * 2
+        self.reader = BoardReader(board_shim, self.num_points_big)
+        self.eeg_window = np.zeros(shape=(len(self.eeg_channels), self.num_points_big), dtype=float)
+        self.eeg_chain = compile_chain(EEG_VIEW_FILTERS, self.sampling_rate)
+        self.lowpass_chain = compile_chain(EEG_LOWPASS, self.sampling_rate)
+        self.scratch = ScratchBuffers((19,1000))
 
         self.app = QtGui.QApplication([])
         self.win = pg.GraphicsWindow(title='BrainFlow Plot',size=(1600, 1200))
 
         # self.nfft = DataFilter.get_nearest_power_of_two(self.sampling_rate)
 
+        # only the plots can give way when the machine can't keep up
+        self.shedder = LoadShedder(self.processing_speed_ms, ['skip_render', 'reduce_channels'])
         self._init_timeseries()
 
+        self.last_rendered = 0
+        self.worker = ProcessingThread(self.process, self.processing_speed_ms, shedder=self.shedder,
+                                       release_fn=self.scratch.release)
+        self.worker.start()
+
         timer = QtCore.QTimer()
         timer.timeout.connect(self.update)
         timer.start(self.update_speed_ms)
         QtGui.QApplication.instance().exec_()
+        self.worker.stop()
 
 
     def _init_timeseries(self):
@@ -54,46 +85,44 @@ class Graph:
             self.curves.append(curve)
         print("Initialized Time series with", len(self.eeg_channels), "Channels")
         print("Rendering", len(self.curves), "Curves")
+        # refiltered from scratch every tick, so decimated in full
+        self.renderer = PlotRenderer(self.win, self.shedder)
+        self.renderer.add_group('eeg', self.plots, self.curves)
 
 
-    def update(self):
-        data = self.board_shim.get_current_board_data(self.num_points_big)
-        filtered_data = np.ndarray(shape=(19,1000), dtype=float)
+    def process(self):
+        # pull only the new samples, then copy just the EEG rows of the window
+        self.reader.poll()
+        data = np.take(self.reader.window(self.num_points_big), self.eeg_channels, axis=0, out=self.eeg_window)
+        filtered_data = self.scratch.next()
         avg_bands = [0, 0, 0, 0, 0]
         band_power_alpha = []
         band_power_beta = []
 
         # print("render")
-        for count, channel in enumerate(self.eeg_channels):
-            # plot timeseries
-            DataFilter.remove_environmental_noise(data[channel], self.sampling_rate, NoiseTypes.FIFTY.value)
-            DataFilter.perform_highpass(data[channel], self.sampling_rate, 1.0, 1,
-                                      FilterTypes.BUTTERWORTH.value, 1)
-            filtered_data[channel] = np.array(data[channel][-int(data[channel].size/2):])
-            print(f"asdasd: {type(filtered_data[channel])}")
-            DataFilter.perform_lowpass(filtered_data[channel], self.sampling_rate, 60.0, 1,
-                                      FilterTypes.BUTTERWORTH.value, 1)
-                        
-            # DataFilter.perform_bandpass(data[channel], self.sampling_rate, 31.0, 59.0, 2,
-            #                           FilterTypes.BUTTERWORTH.value, 1)
-            
-            DataFilter.perform_wavelet_denoising(filtered_data[channel], 'coif3', 2)
-            DataFilter.detrend(filtered_data[channel], DetrendOperations.LINEAR.value)
+        # all channels at once, same result as the DataFilter calls per channel
+        self.eeg_chain.apply(data, out=data)
+        latest = filtered_data[self.eeg_channels]
+        self.lowpass_chain.apply(data[:, -int(data.shape[1]/2):], out=latest)
+        # DataFilter.perform_bandpass(data[count], self.sampling_rate, 31.0, 59.0, 2,
+        #                           FilterTypes.BUTTERWORTH.value, 1)
+        for count in range(latest.shape[0]):
+            # no matrix version of the wavelet denoising
+            DataFilter.perform_wavelet_denoising(latest[count], 'coif3', 2)
+        filtered_data[self.eeg_channels] = detrend_linear(latest)
 
             # nfft = DataFilter.get_nearest_power_of_two(self.sampling_rate)
             # psd = DataFilter.get_psd_welch(filtered_data, nfft, nfft // 2, self.sampling_rate,
             #                        WindowFunctions.BLACKMAN_HARRIS.value)
             # band_power_alpha.append(DataFilter.get_band_power(psd, 7.0, 13.0))
             # band_power_beta.append(DataFilter.get_band_power(psd, 14.0, 30.0))
-            if filtered_data[channel].size == self.num_points:
-                self.curves[count].setData(filtered_data[channel])
 
         # print("aa")
         # print(f"{np.mean(band_power_alpha)} alpha, {np.mean(band_power_beta)}: {np.mean(band_power_beta) / np.mean(band_power_beta)}")
         # print(np.mean(band_power_beta))
         # print(band_power_beta)
         # print("aa")
-        bands = DataFilter.get_avg_band_powers(data, self.eeg_channels, self.sampling_rate, True)
+        bands = DataFilter.get_avg_band_powers(data, list(range(len(self.eeg_channels))), self.sampling_rate, True)
         # print("alpha/beta:%f", np.mean(band_power_alpha))
         print(bands)
         # feature_vector = np.concatenate((bands[0], bands[1]))
@@ -111,6 +140,21 @@ class Graph:
         # relaxation.prepare()
         # print('Relaxation: %f' % relaxation.predict(feature_vector))
         # relaxation.release()
+        return filtered_data
+
+    def update(self):
+        # held while rendering, the processing thread doesn't refill the array meanwhile
+        seq, filtered_data = self.worker.latest.hold()
+        try:
+            if seq != self.last_rendered:
+                self.last_rendered = seq
+                if not self.renderer.skip_frame():
+                    start = time.perf_counter()
+                    self.renderer.render('eeg', filtered_data[self.eeg_channels])
+                    self.renderer.frame_done(time.perf_counter() - start)
+        finally:
+            self.worker.latest.release()
+
         self.app.processEvents()
 
 
@@ -118,6 +162,10 @@ def main():
     BoardShim.enable_dev_board_logger()
     logging.basicConfig(level=logging.DEBUG)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shm', type=str, default=None, help='read from the shared ring of acquisition_daemon.py')
+    args = parser.parse_args()
+
     params = BrainFlowInputParams()
     params.other_info = '8'
     params.ip_address = '224.0.0.1'
@@ -126,8 +174,13 @@ def main():
     # params.other_info = '8'
     # params.file = '/home/a0n/Unicorn-Suite-Hybrid-Black/MNE-Testdump.gtec'
 
+    # stays None when SharedBoard fails, e.g. without a running acquisition daemon
+    board_shim = None
     try:
-        board_shim = BoardShim(-2, params)
+        if args.shm:
+            board_shim = SharedBoard(args.shm)
+        else:
+            board_shim = BoardShim(-2, params)
         board_shim.prepare_session()
         board_shim.start_stream(450000)
         g = Graph(board_shim)
@@ -135,7 +188,7 @@ def main():
         logging.warning('Exception', exc_info=True)
     finally:
         logging.info('End')
-        if board_shim.is_prepared():
+        if board_shim is not None and board_shim.is_prepared():
             logging.info('Releasing session')
             board_shim.release_session()
 
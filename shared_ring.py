@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+import logging
+import os
+import time
+
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+from brainflow.board_shim import BoardShim
+
+# Raw samples of one board in a shared memory ring buffer, written by
+# acquisition_daemon.py and read by any number of local processes (viewers,
+# recorder, feature service) without each of them opening its own BrainFlow
+# session and buffer.
+#
+# The block starts with a small int64 header followed by the samples
+# (num_rows x 2 * capacity float64). Like RingBuffer every sample is written
+# twice, at pos and pos + capacity, so any run of up to capacity consecutive
+# samples is one contiguous slice and readers get NumPy views instead of
+# copies. seq counts the samples written so far and is only advanced after
+# the samples are in place. The writer stores at most max_write samples per
+# step, so a view of samples [start, seq) stays intact as long as the writer
+# is less than capacity - max_write samples ahead of start.
+#
+# The writer stamps HEARTBEAT (CLOCK_MONOTONIC, shared by all processes of the
+# host) on every poll, with or without new samples, and sets CLOSED when it
+# stops. Readers only attach to blocks that are open with a recent
+# heartbeat, SharedBoard moves on to the block of the next daemon when its
+# writer closed it or stopped beating (e.g. was killed).
+MAGIC = 0x4246524e47000001
+MAGIC_FIELD, BOARD_ID, NUM_ROWS, CAPACITY, MAX_WRITE, SEQ, WRITER_PID, HEARTBEAT, CLOSED = range(9)
+HEADER_FIELDS = 16
+DEFAULT_NAME = 'brainflow_eeg'
+
+
+def _size(num_rows, capacity):
+    return (HEADER_FIELDS + num_rows * 2 * capacity) * 8
+
+
+def _arrays(buf, num_rows, capacity):
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=buf)
+    data = np.ndarray((num_rows, 2 * capacity), dtype=np.float64, buffer=buf, offset=HEADER_FIELDS * 8)
+    return header, data
+
+
+class SharedRingWriter:
+    def __init__(self, name, board_id, capacity, max_write=None):
+        self.name = name
+        self.board_id = board_id
+        self.num_rows = BoardShim.get_num_rows(board_id)
+        self.capacity = capacity
+        self.max_write = max_write or max(1, capacity // 8)
+        size = _size(self.num_rows, capacity)
+        try:
+            self.block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left over from a daemon that didn't shut down, readers still
+            # attached to it see CLOSED and reattach
+            stale = shared_memory.SharedMemory(name=name)
+            stale_header, _ = _arrays(stale.buf, 0, 0)
+            stale_header[CLOSED] = 1
+            del stale_header
+            stale.close()
+            stale.unlink()
+            self.block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.header, self.data = _arrays(self.block.buf, self.num_rows, capacity)
+        self.data.fill(0)
+        self.header[:] = 0
+        self.header[BOARD_ID] = board_id
+        self.header[NUM_ROWS] = self.num_rows
+        self.header[CAPACITY] = capacity
+        self.header[MAX_WRITE] = self.max_write
+        self.header[WRITER_PID] = os.getpid()
+        self.header[HEARTBEAT] = time.monotonic_ns()
+        # written last, readers refuse the block until it is there
+        self.header[MAGIC_FIELD] = MAGIC
+        self.seq = 0
+
+    def write(self, block):
+        for start in range(0, block.shape[1], self.max_write):
+            self._write(block[:, start:start + self.max_write])
+        self.beat()
+
+    def beat(self):
+        # tells the readers the writer is alive, also when the board is quiet
+        self.header[HEARTBEAT] = time.monotonic_ns()
+
+    def _write(self, block):
+        n = block.shape[1]
+        pos = self.seq % self.capacity
+        first = min(n, self.capacity - pos)
+        self.data[:, pos:pos + first] = block[:, :first]
+        self.data[:, pos + self.capacity:pos + self.capacity + first] = block[:, :first]
+        if first < n:
+            rest = n - first
+            self.data[:, :rest] = block[:, first:]
+            self.data[:, self.capacity:self.capacity + rest] = block[:, first:]
+        self.seq += n
+        self.header[SEQ] = self.seq
+
+    def close(self):
+        self.header[CLOSED] = 1
+        del self.header, self.data
+        self.block.close()
+        self.block.unlink()
+
+
+class SharedRingReader:
+    # Attaches to the ring of a running acquisition daemon. Nothing is copied:
+    # latest() and since() return views into the shared block, copy what has
+    # to outlive roughly capacity - max_write further samples. Blocks that are
+    # closed or whose writer didn't beat for stale_after seconds are waited out.
+    def __init__(self, name=DEFAULT_NAME, timeout=10.0, stale_after=5.0):
+        self.stale_after = stale_after
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.block = shared_memory.SharedMemory(name=name)
+                header, _ = _arrays(self.block.buf, 0, 0)
+                if header[MAGIC_FIELD] == MAGIC and self._alive(header):
+                    break
+                del header
+                self.block.close()
+            except FileNotFoundError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"no acquisition daemon writing to shared memory {name}")
+            time.sleep(0.1)
+        # Python < 3.13 unlinks every block a process attached to when it
+        # exits, the daemon owns this one
+        resource_tracker.unregister(self.block._name, 'shared_memory')
+        self.name = name
+        self.board_id = int(header[BOARD_ID])
+        self.num_rows = int(header[NUM_ROWS])
+        self.capacity = int(header[CAPACITY])
+        self.max_write = int(header[MAX_WRITE])
+        self.safe_span = self.capacity - self.max_write
+        del header
+        self.header, self.data = _arrays(self.block.buf, self.num_rows, self.capacity)
+
+    @property
+    def seq(self):
+        return int(self.header[SEQ])
+
+    @property
+    def closed(self):
+        return bool(self.header[CLOSED])
+
+    def heartbeat_age(self):
+        # seconds since the writer last polled its board
+        return (time.monotonic_ns() - int(self.header[HEARTBEAT])) / 1e9
+
+    def _alive(self, header):
+        return not header[CLOSED] and (time.monotonic_ns() - int(header[HEARTBEAT])) / 1e9 <= self.stale_after
+
+    def alive(self):
+        return self._alive(self.header)
+
+    def latest(self, n):
+        # (seq, view of the last n samples), zero padded at the front until filled
+        seq = self.seq
+        end = seq % self.capacity + self.capacity
+        return seq, self.data[:, end - n:end]
+
+    def since(self, start, limit=None):
+        # (seq, view of the samples [start, seq), samples lost). Samples the
+        # writer may already be overwriting are skipped and counted as lost.
+        seq = self.seq
+        lost = 0
+        if seq - start > self.safe_span:
+            lost = seq - self.safe_span - start
+            start = seq - self.safe_span
+        if limit is not None and seq - start > limit:
+            seq = start + limit
+        pos = start % self.capacity
+        return seq, self.data[:, pos:pos + seq - start], lost
+
+    def valid(self, start):
+        # whether views taken of samples from start on are still intact
+        return self.seq - start <= self.safe_span
+
+    def close(self):
+        del self.header, self.data
+        try:
+            self.block.close()
+        except BufferError:
+            # views handed out are still alive, the mapping goes with the process
+            pass
+
+
+class SharedBoard:
+    # Stands in for a BoardShim of the board the daemon reads, so scripts
+    # written against BoardShim run unchanged on the shared ring. BoardReader
+    # recognizes it and reads the ring directly instead of copying.
+    # When the daemon stops or dies, the next read waits up to timeout for a
+    # new daemon and goes on on its ring (TimeoutError if none comes up).
+    # samples_lost counts the samples the writer overwrote before they were read.
+    def __init__(self, name=DEFAULT_NAME, timeout=10.0, stale_after=5.0):
+        self.name = name
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.ring = SharedRingReader(name, timeout, stale_after)
+        self.next_seq = self.ring.seq
+        self.prepared = True
+        self.samples_lost = 0
+        self.reattached = 0
+
+    def check_writer(self):
+        # returns True when it had to reattach, readers holding on to the
+        # old ring have to take the new one
+        if self.ring.alive():
+            return False
+        reason = 'closed the ring' if self.ring.closed else f"silent for {self.ring.heartbeat_age():.1f} s"
+        logging.warning(f"acquisition daemon of {self.name} {reason}, waiting {self.timeout} s for a new one")
+        ring = SharedRingReader(self.name, self.timeout, self.stale_after)
+        self.ring.close()
+        self.ring = ring
+        # samples of the old daemon that were not read yet are gone with it,
+        # the new one's are all new to us
+        self.next_seq = max(ring.seq - ring.safe_span, 0)
+        self.reattached += 1
+        logging.info(f"reattached to {self.name}, board {ring.board_id}")
+        return True
+
+    def get_board_id(self):
+        return self.ring.board_id
+
+    def prepare_session(self):
+        pass
+
+    def start_stream(self, buffer_size=None):
+        # like BrainFlow, samples before the stream start are not handed out
+        self.next_seq = self.ring.seq
+
+    def stop_stream(self):
+        pass
+
+    def is_prepared(self):
+        return self.prepared
+
+    def get_board_data_count(self):
+        self.check_writer()
+        return min(self.ring.seq - self.next_seq, self.ring.safe_span)
+
+    def get_board_data(self, num_samples=None):
+        # copy of the samples since the last call, which are consumed
+        self.check_writer()
+        seq, view, lost = self.ring.since(self.next_seq, num_samples)
+        if lost:
+            self.samples_lost += lost
+            logging.warning(f"shared ring {self.ring.name}: {lost} samples overwritten before they were read, "
+                            f"{self.samples_lost} total")
+        data = np.array(view)
+        self.next_seq = seq
+        return data
+
+    def get_current_board_data(self, num_samples):
+        return np.array(self.ring.latest(num_samples)[1])
+
+    def release_session(self):
+        if self.prepared:
+            self.prepared = False
+            self.ring.close()
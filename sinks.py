@@ -0,0 +1,409 @@
+#!/usr/bin/python3
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from paho.mqtt.client import topic_matches_sub
+
+import mqtt_pool
+from metrics import Metrics
+from osc_output import OscControlOutput
+from output_throttle import OutputThrottle, TopicRule
+
+# Every output of the pipeline is a message (topic, value, sample timestamp)
+# handed to a SinkHub. The hub runs an asyncio loop on its own thread with one
+# task per sink. Each sink takes the topics matching its filters into its own
+# bounded queue (the oldest messages are dropped when it is full), so a slow
+# or unreachable sink never holds up the others or the caller.
+#
+# Topics used by FeaturePipeline (prefixed with /<name> in multi board mode):
+#   /mirror/<n>/position     feature vector
+#   /ctrl/<name>             Tidal control values
+#   /pipeline/stats          JSON stats
+#
+# sinks config file:
+# {
+#     "sinks": [
+#         {"name": "mirrors", "type": "mqtt", "host": "192.168.1.1", "float_format": "{:.2f}",
+#          "topics": ["/mirror/#", "/+/mirror/#", "/pipeline/stats", "/+/pipeline/stats"],
+#          "throttle": [{"topic": "#", "deadband_abs": 0.005, "min_interval": 0.05, "max_interval": 5.0}]},
+#         {"name": "tidal", "type": "osc", "host": "127.0.0.1", "port": 6010, "address": "/ctrl",
+#          "min_interval": 0.0, "max_interval": 5.0, "suppress_unchanged": true, "topics": ["/ctrl/#", "/+/ctrl/#"]},
+#         {"name": "browser", "type": "websocket", "host": "127.0.0.1", "port": 8765, "topics": ["#"]},
+#         {"name": "log", "type": "file", "path": "outputs.jsonl", "max_bytes": 10000000, "backup_count": 5,
+#          "topics": ["#"]}
+#     ]
+# }
+# Every sink also takes "max_queue" (default 1000).
+
+DEFAULT_SINKS = {
+    'sinks': [
+        {'name': 'broker', 'type': 'mqtt', 'host': '192.168.1.1', 'float_format': '{:.2f}',
+         'topics': ['/mirror/#', '/+/mirror/#', '/pipeline/stats', '/+/pipeline/stats',
+                    '/themotor/#', '/theground/#', '/thesun/#', '/thelight/#'],
+         # mirrors only get a new position once it moved by more than the 2
+         # decimals sent, at least every 5 s. min_interval stays well below
+         # the 100 ms tick, so jitter between ticks doesn't drop updates
+         'throttle': [{'topic': '/mirror/+/position', 'deadband_abs': 0.005, 'min_interval': 0.05, 'max_interval': 5.0},
+                      {'topic': '/+/mirror/+/position', 'deadband_abs': 0.005, 'min_interval': 0.05, 'max_interval': 5.0}]},
+        {'name': 'servos', 'type': 'mqtt', 'host': 'crystal.local', 'topics': ['/servos/#'],
+         'throttle': [{'topic': '#', 'deadband_abs': 0.005, 'min_interval': 0.05, 'max_interval': 5.0}]},
+        # unchanged controls are left out of the bundles, but resent every 5 s
+        {'name': 'tidal', 'type': 'osc', 'host': '127.0.0.1', 'port': 6010, 'address': '/ctrl', 'max_interval': 5.0,
+         'topics': ['/ctrl/#', '/+/ctrl/#']},
+    ]
+}
+
+
+class Sink:
+    def __init__(self, config):
+        self.name = config['name']
+        self.topics = config.get('topics', ['#'])
+        self.queue = collections.deque(maxlen=config.get('max_queue', 1000))
+        self.queue_lock = threading.Lock()
+        self.accepted = {}
+        self.wake = None
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.metrics = Metrics({'sink': self.name})
+
+    def accepts(self, topic):
+        accepted = self.accepted.get(topic)
+        if accepted is None:
+            accepted = any(topic_matches_sub(pattern, topic) for pattern in self.topics)
+            self.accepted[topic] = accepted
+        return accepted
+
+    def enqueue(self, messages):
+        # called from the producer thread, never blocks on the sink
+        with self.queue_lock:
+            overflow = len(self.queue) + len(messages) - self.queue.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self.queue.extend(messages)
+            self.received += len(messages)
+
+    def drain(self):
+        with self.queue_lock:
+            batch = list(self.queue)
+            self.queue.clear()
+        return batch
+
+    async def start(self):
+        pass
+
+    async def send(self, batch):
+        raise NotImplementedError
+
+    async def run(self):
+        await self.start()
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            batch = self.drain()
+            if not batch:
+                continue
+            try:
+                await self.send(batch)
+                self.sent += len(batch)
+                now = time.time()
+                newest = max((timestamp for _, _, timestamp, _ in batch if timestamp is not None), default=None)
+                if newest is not None:
+                    self.metrics.observe('sample_to_sink', max(now - newest, 0.0))
+                self.metrics.observe('queue_to_sink', max(now - batch[0][3], 0.0))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.errors += 1
+                logging.debug(f"sink {self.name} failed", exc_info=True)
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {'received': self.received, 'sent': self.sent, 'dropped': self.dropped, 'errors': self.errors,
+                'queued': len(self.queue)}
+
+
+class MqttSink(Sink):
+    # through the shared mqtt_pool client of the host, optionally throttled
+    def __init__(self, config):
+        super().__init__(config)
+        self.host = config['host']
+        self.port = config.get('port', 1883)
+        self.qos = config.get('qos', 0)
+        self.float_format = config.get('float_format')
+        rules = []
+        for rule in config.get('throttle', []):
+            rule = dict(rule)
+            rules.append((rule.pop('topic'), TopicRule(**rule)))
+        self.throttle = OutputThrottle(rules, default_rule=TopicRule(qos=self.qos)) if rules else None
+
+    async def start(self):
+        self.publisher = mqtt_pool.get_publisher(self.host, self.port)
+
+    def _payload(self, value):
+        if self.float_format and isinstance(value, float):
+            return self.float_format.format(value)
+        return value if isinstance(value, (str, bytes)) else str(value)
+
+    async def send(self, batch):
+        messages = []
+        if self.throttle is not None:
+            # a backed up queue holds several values of a topic, only the
+            # newest goes to the throttle, min_interval would keep the oldest
+            newest = {topic: index for index, (topic, value, _, _) in enumerate(batch) if not isinstance(value, str)}
+        for index, (topic, value, _, _) in enumerate(batch):
+            qos = self.qos
+            if self.throttle is not None and not isinstance(value, str):
+                if newest[topic] != index:
+                    continue
+                qos = self.throttle.check(topic, value)
+                if qos is None:
+                    continue
+            messages.append({'topic': topic, 'payload': self._payload(value), 'qos': qos})
+        if messages:
+            self.publisher.publish_multiple(messages)
+
+
+class OscSink(Sink):
+    # the last topic level is the control name, so /unicorn1/ctrl/alpha and
+    # /ctrl/alpha become unicorn1_alpha and alpha; one bundle per batch, at
+    # most every min_interval seconds whatever the tick rate. Values held back
+    # by min_interval (or a failed send) go out on a timer once it passed,
+    # also when no further batch comes.
+    def __init__(self, config):
+        super().__init__(config)
+        self.output = OscControlOutput(config.get('host', '127.0.0.1'), config.get('port', 6010),
+                                       config.get('address', '/ctrl'), min_interval=config.get('min_interval', 0.0),
+                                       suppress_unchanged=config.get('suppress_unchanged', True),
+                                       max_interval=config.get('max_interval', 0.0))
+        self.names = {}
+        self.retry = None
+
+    def _control(self, topic):
+        name = self.names.get(topic)
+        if name is None:
+            levels = [level for level in topic.split('/') if level]
+            name = '_'.join(levels[:-2] + levels[-1:]) if len(levels) > 2 else levels[-1]
+            self.names[topic] = name
+        return name
+
+    async def send(self, batch):
+        for topic, value, _, _ in batch:
+            self.output.set(self._control(topic), value)
+        self.output.flush()
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        if self.output.pending and self.retry is None:
+            delay = max(self.output.last_flush + self.output.min_interval - time.time(), 0.05)
+            self.retry = asyncio.get_running_loop().call_later(delay, self._retry)
+
+    def _retry(self):
+        self.retry = None
+        try:
+            self.output.flush()
+        except Exception:
+            self.errors += 1
+            logging.debug(f"sink {self.name} failed", exc_info=True)
+        self._schedule_retry()
+
+    async def close(self):
+        if self.retry is not None:
+            self.retry.cancel()
+        self.output.close()
+
+
+class WebSocketSink(Sink):
+    # Minimal local WebSocket server (RFC 6455, text frames to the browser
+    # only), every batch goes out as one JSON array of {topic, value, time}.
+    # Clients that can't keep up are disconnected.
+    GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.host = config.get('host', '127.0.0.1')
+        self.port = config.get('port', 8765)
+        self.send_timeout = config.get('send_timeout', 0.5)
+        self.clients = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handshake, self.host, self.port)
+
+    async def _handshake(self, reader, writer):
+        try:
+            headers = {}
+            await reader.readline()
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+            accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + self.GUID).encode()).digest()).decode()
+            writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+            await writer.drain()
+        except Exception:
+            writer.close()
+            return
+        self.clients.add(writer)
+        # incoming frames are ignored, the connection ends when the client goes away
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        self.clients.discard(writer)
+        writer.close()
+
+    @staticmethod
+    def _frame(payload):
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x81, length])
+        elif length < 65536:
+            header = bytes([0x81, 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x81, 127]) + length.to_bytes(8, 'big')
+        return header + payload
+
+    async def send(self, batch):
+        if not self.clients:
+            return
+        frame = self._frame(json.dumps([{'topic': topic, 'value': value, 'time': timestamp}
+                                        for topic, value, timestamp, _ in batch]).encode())
+        for writer in list(self.clients):
+            try:
+                writer.write(frame)
+                await asyncio.wait_for(writer.drain(), self.send_timeout)
+            except Exception:
+                self.clients.discard(writer)
+                writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+
+
+class FileSink(Sink):
+    # JSON lines, rotated to <path>.1 .. <path>.<backup_count> at max_bytes.
+    # Writes happen on the default executor so the loop never waits on disk.
+    def __init__(self, config):
+        super().__init__(config)
+        self.path = config['path']
+        self.max_bytes = config.get('max_bytes', 10000000)
+        self.backup_count = config.get('backup_count', 5)
+        self.file = None
+
+    def _write(self, lines):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        if self.file.tell() + len(lines) > self.max_bytes:
+            self.file.close()
+            for number in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{number}"):
+                    os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+            if self.backup_count:
+                os.replace(self.path, f"{self.path}.1")
+            self.file = open(self.path, 'w')
+        self.file.write(lines)
+        self.file.flush()
+
+    async def send(self, batch):
+        lines = ''.join(json.dumps({'topic': topic, 'value': value, 'time': timestamp}) + '\n'
+                        for topic, value, timestamp, _ in batch)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+    async def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+SINK_TYPES = {
+    'mqtt': MqttSink,
+    'osc': OscSink,
+    'websocket': WebSocketSink,
+    'file': FileSink,
+}
+
+
+class SinkHub:
+    def __init__(self, config=None):
+        config = config or DEFAULT_SINKS
+        self.sinks = [SINK_TYPES[sink['type']](sink) for sink in config['sinks']]
+        self.loop = asyncio.new_event_loop()
+        self.tasks = []
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, name='sinks', daemon=True)
+        self.thread.start()
+        self.started.wait(5.0)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        for sink in self.sinks:
+            sink.wake = asyncio.Event()
+            self.tasks.append(self.loop.create_task(sink.run()))
+        self.loop.call_soon(self.started.set)
+        self.loop.run_forever()
+
+    def publish(self, topic, value, timestamp=None):
+        self.publish_many([(topic, value, timestamp)])
+
+    def publish_many(self, messages):
+        # messages: (topic, value, sample timestamp or None)
+        queued = time.time()
+        for sink in self.sinks:
+            accepted = [(topic, value, timestamp, queued) for topic, value, timestamp in messages if sink.accepts(topic)]
+            if accepted:
+                sink.enqueue(accepted)
+                self.loop.call_soon_threadsafe(sink.wake.set)
+
+    def stats(self):
+        return {sink.name: sink.stats() for sink in self.sinks}
+
+    def metrics(self):
+        return [sink.metrics for sink in self.sinks]
+
+    def stop(self):
+        async def shutdown():
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            for sink in self.sinks:
+                await sink.close()
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(2.0)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(2.0)
+
+
+def load_sink_config(path=None):
+    if not path:
+        return DEFAULT_SINKS
+    with open(path) as f:
+        return json.load(f)
+
+
+_default_hub = None
+_default_lock = threading.Lock()
+
+def default_sinks():
+    # the outputs of every pipeline in the process that doesn't get its own hub
+    global _default_hub
+    with _default_lock:
+        if _default_hub is None:
+            _default_hub = SinkHub()
+        return _default_hub
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+
+from brainflow.data_filter import DataFilter
+
+from ring_buffer import RingBuffer
+
+# bands DataFilter.get_avg_band_powers actually integrates (its docstring says
+# 1-4, ..., 30-50), same order as its output
+AVG_BANDS = [
+    ('delta', 1.5, 4.0),
+    ('theta', 4.0, 8.0),
+    ('alpha', 7.5, 13.0),
+    ('beta', 13.0, 30.0),
+    ('gamma', 30.0, 45.0),
+]
+
+
+def avg_band_nfft(sampling_rate, window_size):
+    # the Welch segment length get_avg_band_powers uses: twice the power of two
+    # nearest to the sampling rate, halved until it fits into the window
+    nfft = 2 * DataFilter.get_nearest_power_of_two(sampling_rate)
+    while nfft > window_size:
+        nfft //= 2
+    return nfft
+
+
+class SlidingWelch:
+    # Welch PSD over a sliding window that is updated incrementally. The power
+    # spectrum of every Welch segment is computed once, when the segment is
+    # complete, and cached; the PSD of the window is the mean of the cached
+    # segments. Each tick therefore only FFTs the segments that completed since
+    # the last tick, for all channels in one batched call.
+    #
+    # The defaults are the Welch of get_avg_band_powers (periodic Hann window,
+    # overlap 4/5 of nfft, no detrending per segment). Its segments start at
+    # the beginning of the window, these at multiples of hop in the stream, so
+    # the two only agree exactly when the window starts on a segment boundary.
+    def __init__(self, num_channels, sampling_rate, nfft, window_size, overlap=None, window='hann'):
+        if overlap is None:
+            overlap = 4 * nfft // 5
+        self.num_channels = num_channels
+        self.sampling_rate = sampling_rate
+        self.nfft = nfft
+        self.hop = nfft - overlap
+        self.num_segments = max(1, (window_size - nfft) // self.hop + 1)
+        self.window = signal.get_window(window, nfft)
+        self.scale = 1.0 / (sampling_rate * np.sum(self.window ** 2))
+        self.freqs = np.fft.rfftfreq(nfft, 1.0 / sampling_rate)
+
+        self.input = RingBuffer(num_channels, window_size + 2 * nfft)
+        self.segments = np.zeros(shape=(self.num_segments, num_channels, self.freqs.size), dtype=float)
+        self.total = 0
+        self.completed = 0
+        self._band_weights = {}
+
+    def push(self, block):
+        n = block.shape[1]
+        if n == 0:
+            return 0
+        self.input.append(block)
+        self.total += n
+        completed = (self.total - self.nfft) // self.hop + 1 if self.total >= self.nfft else 0
+        new_segments = min(completed - self.completed, self.num_segments)
+        if new_segments > 0:
+            # segment k covers samples [k * hop, k * hop + nfft) of the stream
+            first = completed - new_segments
+            end_offset = self.total - (first * self.hop + self.nfft)
+            region = self.input.latest(end_offset + self.nfft)
+            power = self.segment_power(region, new_segments)
+            slots = np.arange(first, completed) % self.num_segments
+            self.segments[slots] = power
+        self.completed = completed
+        return max(new_segments, 0)
+
+    def segment_power(self, region, count):
+        # one sided power spectral density of the first count segments of
+        # region (channels x samples, starting on a segment boundary),
+        # returned as (segments x channels x freqs)
+        segments = sliding_window_view(region, self.nfft, axis=1)[:, ::self.hop][:, :count]
+        spectrum = np.fft.rfft(segments * self.window, axis=2)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        power[:, :, 1:-1] *= 2.0
+        return power.transpose(1, 0, 2)
+
+    def psd(self):
+        filled = min(self.completed, self.num_segments)
+        if filled == 0:
+            return np.zeros(shape=(self.num_channels, self.freqs.size), dtype=float)
+        if filled < self.num_segments:
+            slots = np.arange(self.completed - filled, self.completed) % self.num_segments
+            return self.segments[slots].mean(axis=0)
+        return self.segments.mean(axis=0)
+
+    def band_weights(self, bands):
+        # DataFilter.get_band_power as a matrix: a trapezoid from every bin
+        # inside the band to the next bin, so the bin after the band counts half
+        key = tuple(bands)
+        weights = self._band_weights.get(key)
+        if weights is None:
+            df = self.freqs[1] - self.freqs[0]
+            weights = np.zeros(shape=(self.freqs.size, len(bands)), dtype=float)
+            for count, (_, low, high) in enumerate(bands):
+                idx = np.nonzero((self.freqs[:-1] >= low) & (self.freqs[:-1] <= high))[0]
+                np.add.at(weights[:, count], idx, df / 2.0)
+                np.add.at(weights[:, count], idx + 1, df / 2.0)
+            self._band_weights[key] = weights
+        return weights
+
+    def band_powers(self, bands, psd=None):
+        if psd is None:
+            psd = self.psd()
+        return psd @ self.band_weights(bands)
+
+    def avg_band_powers(self, bands=AVG_BANDS, psd=None):
+        # (avg, std) as DataFilter.get_avg_band_powers computes them, see
+        # relative_band_stats. psd may also carry leading dimensions (e.g.
+        # windows x channels x freqs) to do many at once.
+        return relative_band_stats(self.band_powers(bands, psd))
+
+
+def relative_band_stats(powers):
+    # the statistics of get_avg_band_powers, powers is (... x channels x bands):
+    # avg is the mean band power across channels relative to the sum of the
+    # means, std the std across channels relative to the band's mean
+    mean = powers.mean(axis=-2)
+    std = powers.std(axis=-2)
+    total = mean.sum(axis=-1, keepdims=True)
+    total[total == 0] = 1.0
+    avg = mean / total
+    mean[mean == 0] = 1.0
+    return avg, std / mean